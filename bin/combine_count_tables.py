@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+
+import argparse
+import heapq
+import itertools
+from array import array
+from operator import itemgetter
+import numpy as np
+import count_table_io
+import utilities
+
+'''
+This script merges the binary (.npz) count tables of all the samples into one run-level sparse
+abundance matrix: rows are the unique sequences (deduplicated across samples), and columns are
+the (sample, primer) pairs. Check count_table_io.py for the format of the matrix, and for slicing
+it by sample or by primer.
+
+The per-sample count tables have their rows sorted by sequence (make_count_table.py -f), so they
+are merged in a single streaming k-way pass.
+
+This script requires the count tables be listed in a manifest file, one 'count_table<tab>file name' per line.
+'''
+
+def parse_argument():
+
+    parser = argparse.ArgumentParser(prog = 'combine_count_tables.py')
+    parser.add_argument('-o', '--output', metavar = '', required = True, help = 'Specify output run matrix (.npz) file')
+    parser.add_argument('-m', '--manifest', metavar = '', required = True, help = 'Specify a manifest file (tab delimited) listing the '
+                        'binary (.npz) count tables, one per line as: count_table <tab> file name')
+
+    return parser.parse_args()
+
+
+def build_columns(tables):
+    '''
+    this method collects the (sample, primer) columns of all the count tables
+
+    Parameters
+    ----------
+    tables: list of loaded binary count tables
+
+    Returns: tuple of (sorted samples, sorted primers, column sample index array, column primer index array,
+             list of arrays mapping each table's columns to the run matrix columns)
+    ----------
+    '''
+    pairs = sorted({(str(sample), str(primer)) for table in tables
+                    for sample, primer in zip(table['samples'], table['primers'])})
+    samples = sorted({sample for sample, _ in pairs})
+    primers = sorted({primer for _, primer in pairs})
+
+    sample_ind = {sample: ind for ind, sample in enumerate(samples)}
+    primer_ind = {primer: ind for ind, primer in enumerate(primers)}
+    col_ind = {pair: ind for ind, pair in enumerate(pairs)}
+
+    col_sample = [sample_ind[sample] for sample, _ in pairs]
+    col_primer = [primer_ind[primer] for _, primer in pairs]
+    col_maps = [np.array([col_ind[(str(sample), str(primer))] for sample, primer in zip(table['samples'], table['primers'])],
+                         dtype=np.int32)
+                for table in tables]
+
+    return samples, primers, col_sample, col_primer, col_maps
+
+
+def iter_sorted_rows(table, table_ind, count_table):
+    '''
+    this method iterates over the rows of a count table in the order of their sequence
+
+    Parameters
+    ----------
+    table: loaded binary count table
+    table_ind: int, index of the table
+    count_table: String name of the count table file (for the error message)
+
+    Returns: generator of (sequence, table index, row index) tuples
+    ----------
+    '''
+    # the row names (seqs) are per-sample read labels, so the rows can only be merged by their actual sequence
+    if 'sequences' not in table:
+        raise ValueError(f'{count_table} has no sequences, make it with make_count_table.py -f (the unique fasta file)')
+    keys = table['sequences']
+    if len(keys) > 1 and not np.all(keys[:-1] <= keys[1:]):
+        order = np.argsort(keys, kind='stable')
+    else:
+        order = range(len(keys))
+
+    for row in order:
+        yield bytes(keys[row]), table_ind, row
+
+
+def merge_tables(count_tables):
+    '''
+    this method merges the count tables in a single k-way pass over their (sorted) rows: the rows of the same
+    sequence come out of the merge together, so the counts of a sequence are summed up and appended to the
+    columns as soon as the merge moves on to the next sequence (the rows of each column are then in order,
+    and the CSC arrays are just the columns put end to end)
+
+    Parameters
+    ----------
+    count_tables: list of binary count table file names
+
+    Returns: tuple of (sorted unique sequences, samples, primers, col_sample, col_primer, indptr, indices, data)
+    ----------
+    '''
+    tables = [count_table_io.load_count_npz(count_table) for count_table in count_tables]
+    samples, primers, col_sample, col_primer, col_maps = build_columns(tables)
+
+    sequences = []
+    col_rows = [array('q') for _ in col_sample]
+    col_counts = [array('q') for _ in col_sample]
+    merged = heapq.merge(*[iter_sorted_rows(table, ind, count_table)
+                           for ind, (table, count_table) in enumerate(zip(tables, count_tables))])
+    for seq, rows in itertools.groupby(merged, key=itemgetter(0)):
+        row_counts = {}
+        for _, table_ind, row in rows:
+            table = tables[table_ind]
+            start, end = table['indptr'][row], table['indptr'][row + 1]
+            for col, count in zip(col_maps[table_ind][table['indices'][start:end]].tolist(),
+                                  table['data'][start:end].tolist()):
+                row_counts[col] = row_counts.get(col, 0) + count
+        for col, count in row_counts.items():
+            col_rows[col].append(len(sequences))
+            col_counts[col].append(count)
+        sequences.append(seq)
+
+    indptr = np.zeros(len(col_sample) + 1, dtype=np.int64)
+    np.cumsum([len(rows) for rows in col_rows], out=indptr[1:])
+    indices = np.concatenate([np.frombuffer(rows, dtype=np.int64) for rows in col_rows] or [np.zeros(0, np.int64)])
+    data = np.concatenate([np.frombuffer(counts, dtype=np.int64) for counts in col_counts] or [np.zeros(0, np.int64)])
+
+    return sequences, samples, primers, col_sample, col_primer, indptr, indices, data
+
+
+if __name__ == "__main__":
+
+    args = parse_argument()
+
+    sequences, samples, primers, col_sample, col_primer, indptr, indices, data = merge_tables(utilities.read_manifest(args.manifest).get('count_table', []))
+    count_table_io.save_run_matrix(args.output, sequences, samples, primers, col_sample, col_primer, indptr, indices, data)
+
+    print (f"{len(sequences)} unique sequences across {len(samples)} samples and {len(primers)} primers " \
+           f"({len(data)} non-zero counts)")
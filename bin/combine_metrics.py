@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+
+import argparse
+import itertools
+import os
+import metrics
+import utilities
+
+'''
+This script reads the metrics (json lines) files and the pear/vsearch stage logs ({sample}_{stage}.log)
+of all the samples (check metrics.py) in a single pass,
+and writes the MultiQC custom content table of every stage ({stage}_mqc.out: pear, qfilter, dereplication
+and denoise), one row per sample, in the order of the files and of the records.
+
+It replaces the four combine_logs.py runs (one per stage), and makes the same tables: as pandas did,
+a column with a missing value (n/a) has its numbers written as floats, and the missing values left empty.
+
+This script requires the files be listed in a manifest file, one 'metrics<tab>file name' or 'log<tab>file name'
+per line.
+'''
+
+# the values read as missing (the default NA values of pandas.read_csv)
+NA_VALUES = {'', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN', '-nan', '1.#IND', '1.#QNAN',
+             '<NA>', 'N/A', 'NA', 'NULL', 'NaN', 'None', 'n/a', 'nan', 'null'}
+
+
+def parse_argument():
+
+    parser = argparse.ArgumentParser(prog = 'combine_metrics.py')
+    parser.add_argument('-m', '--manifest', metavar = '', required = True, help = 'Specify a manifest file (tab delimited) listing the '
+                        'metrics files and stage logs, one per line as: metrics (or log) <tab> file name')
+    parser.add_argument('-o', '--outdir', metavar = '', default = '.', help = 'Specify output folder (default: .)')
+    return parser.parse_args()
+
+
+def parse_value(value):
+    '''
+    Returns a value as an int, a float, a string or None (missing)
+    '''
+    text = str(value)
+    if value is None or text.strip() in NA_VALUES:
+        return None
+    for kind in (int, float):
+        try:
+            return kind(text)
+        except ValueError:
+            pass
+    return text
+
+
+def format_column(values):
+    '''
+    this method formats the values of a table column the way pandas writes them
+
+    Returns: list of strings
+    '''
+    parsed = [parse_value(value) for value in values]
+    if any(isinstance(value, str) for value in parsed):
+        return ['' if value is None else str(original) for value, original in zip(parsed, values)]
+    if any(value is None or isinstance(value, float) for value in parsed):
+        return ['' if value is None else repr(float(value)) for value in parsed]
+    return [str(value) for value in parsed]
+
+
+def write_table(output_file, stage, records):
+    '''
+    this method writes the MultiQC table (tab delimited) of a stage, one row per sample record
+    '''
+    columns = metrics.STAGES[stage]
+    formatted = [format_column([record['metrics'].get(column) for record in records]) for column in columns]
+    with open(output_file, 'w') as f:
+        f.write('\t'.join([metrics.SAMPLE_COLUMN] + columns) + '\n')
+        for ind, record in enumerate(records):
+            f.write('\t'.join([str(record['sample'])] + [column[ind] for column in formatted]) + '\n')
+
+
+def combine(metrics_files, log_files=(), outdir='.'):
+    '''
+    this method groups the records of all the metrics files and stage logs by stage and writes the table
+    of every stage
+
+    Parameters
+    ----------
+    metrics_files: list of the metrics (json lines) file names
+    log_files: list of the stage log file names ({sample}_{stage}.log)
+    outdir: String name of the output folder
+
+    Returns: dictionary of stage: # of records
+    ----------
+    '''
+    records = {stage: [] for stage in metrics.STAGES}
+    for record in itertools.chain((record for metrics_file in metrics_files for record in metrics.read_records(metrics_file)),
+                                  (metrics.parse_log(log_file) for log_file in log_files)):
+        if record['stage'] in records:
+            records[record['stage']].append(record)
+
+    for stage, stage_records in records.items():
+        write_table(os.path.join(outdir, f'{stage}_mqc.out'), stage, stage_records)
+    return {stage: len(stage_records) for stage, stage_records in records.items()}
+
+
+if __name__ == "__main__":
+
+    args = parse_argument()
+
+    manifest = utilities.read_manifest(args.manifest)
+    counts = combine(manifest.get('metrics', []), manifest.get('log', []), args.outdir)
+    print (', '.join(f'{count} {stage} records' for stage, count in counts.items()))
@@ -1,15 +1,65 @@
 #!/usr/bin/env python3
 
 import pandas as pd
+import numpy as np
 import argparse
 import os
 import re
-import yaml
+import mqc_content
 import utilities
+import run_catalog
 import ast
 
 
-def make_genus_primer_matrix_yaml(output_file, primer_stats, keyword="typhi"):
+def read_tables(files, sep=',', threads=1):
+    '''
+    this method reads the per-sample report files (csv/tsv, 1 row per sample) concurrently, 
+    and concatenates them once
+
+    Parameters
+    ----------
+    files: list of file names
+    sep: String, the delimiter
+    threads: int, number of reader threads
+
+    Returns: DataFrame (index: sample)
+    ----------
+    '''
+    df_list = utilities.parallel_map(lambda report: pd.read_csv(report, index_col=0, sep=sep), files, threads)
+    return pd.concat(df_list)
+
+
+def primer_stats_matrix(combined_df, pnames):
+    '''
+    this method turns the concatenated per-sample primer_stats into one sample x primer matrix,
+    with the columns aligned to the order of our primer panel
+
+    Output matrix format:
+
+                primerA   primerB   primerC
+    sample_1       10        20        NaN
+    sample_2       20        NaN       40
+
+    Parameters
+    ----------
+    combined_df: DataFrame, the concatenated primer_stats of all the samples, each primer_stats has 
+                 the following format (it has only 1 row)
+                 #                            primer1 primer2 primer3
+                 #sample(abundance count)     10      20      30
+    pnames: list of primer names of our primer panel
+
+    Returns: DataFrame (NaN if the sample has no reads for the primer)
+    ----------
+    '''
+    # primers in our panel first (in the panel order), followed by any other primer found in the stats
+    panel = list(pnames)
+    panel_set = set(panel)
+    columns = panel + [col for col in combined_df.columns if col not in panel_set]
+
+    return combined_df.reindex(columns=columns)
+
+
+def make_genus_primer_matrix_yaml(output_file, stats_df, keyword="typhi"):
     """
     Generate a MultiQC YAML table showing read counts for primers
     containing a specific keyword across all samples.
@@ -23,10 +73,10 @@ def make_genus_primer_matrix_yaml(output_file, primer_stats, keyword="typhi"):
     Parameters
     ----------
     output_file : str
-        Output YAML file name
+        Output MultiQC custom content (*_mqc.json or *_mqc.yaml) file name
 
-    primer_stats : str
-        Space-separated list of per-sample primer stats CSV files
+    stats_df : pandas.DataFrame
+        sample × primer matrix of read counts, as returned by primer_stats_matrix()
 
     keyword : str
         Keyword used to filter primers (e.g. "typhi")
@@ -38,24 +88,15 @@ def make_genus_primer_matrix_yaml(output_file, primer_stats, keyword="typhi"):
     """
 
     # -----------------------------
-    # Build combined dataframe
-    # -----------------------------
-    df_list = [
-        pd.read_csv(report, index_col=0, sep="\t")
-        for report in primer_stats.split()
-    ]
-
-    combined_df = pd.concat(df_list)
-
-    # -----------------------------
-    # Filter primers by keyword
+    # Filter primers by keyword (which have reads in at least one sample)
     # -----------------------------
+    present = stats_df.notna().any()
     subset_cols = [
-        col for col in combined_df.columns
-        if keyword.lower() in col.lower()
+        col for col in stats_df.columns
+        if keyword.lower() in col.lower() and present[col]
     ]
 
-    subset_df = combined_df[subset_cols].fillna(0)
+    subset_df = stats_df[subset_cols].fillna(0).astype(int)
 
     # -----------------------------
     # Build MultiQC headers
@@ -69,13 +110,8 @@ def make_genus_primer_matrix_yaml(output_file, primer_stats, keyword="typhi"):
         for col in subset_df.columns
     }
 
-    # -----------------------------
-    # Convert dataframe to YAML format
-    # -----------------------------
-    data_yaml = subset_df.to_dict(orient="index")
-
-    # MultiQC YAML dictionary
-    yaml_dict = {
+    # MultiQC section config (the data part is streamed from the dataframe)
+    section = {
         "id": f"genus_primer_matrix",
         "section_name": f"Genus Primer Read Count Report",
         "description": f"Read counts per Salmonella genus-specific primer pair per sample.",
@@ -87,14 +123,12 @@ def make_genus_primer_matrix_yaml(output_file, primer_stats, keyword="typhi"):
             "no_violin": True,
         },
         "headers": headers,
-        "data": data_yaml
     }
 
     # -----------------------------
-    # Write YAML file
+    # Write MultiQC custom content file
     # -----------------------------
-    with open(output_file, "w") as file:
-        yaml.dump(yaml_dict, file, sort_keys=False)
+    mqc_content.write_custom_content(output_file, section, subset_df)
 
     # -----------------------------
     # Return dataframe for reuse
@@ -102,65 +136,39 @@ def make_genus_primer_matrix_yaml(output_file, primer_stats, keyword="typhi"):
     return subset_df
 
 
-def make_primer_stats_yaml(output_file, primer_stats, oligos_file):
+def make_primer_stats_yaml(output_file, stats_df, pnames):
     '''
     this method generates a custom content yaml file specific for the multiqc report
     this yaml file is for the primer pair performance report
 
     Parameters
     ----------
-    output_file: String, output file (yaml) name
-    primer_stats: String, concatenated names of each primer_stats csv file (per sample)
-    oligos_file: String, oligo file name(which contains the primer information)
+    output_file: String, output file (*_mqc.json or *_mqc.yaml) name
+    stats_df: DataFrame, sample x primer matrix of read counts, as returned by primer_stats_matrix()
+    pnames: list of primer names of our primer panel
 
     Returns: None
     ----------
     '''   
-    def create_df(primer_stats, oligos_file):
-        oligo_primers = utilities.Primers(oligos_file)
-        # our primer panel as a dictionary, its value is a list of 3 items
-        # running total: int
-        # (min read count, sample name), tuple
-        # (max read count, sample name), tuple
-        primer_dict = {primer: [] for primer in oligo_primers.pnames}
-
-        #read each report csv file as a df
-        df_list = [pd.read_csv(report, index_col=[0], sep='\t') for report in primer_stats.split()]
-        # each df has the following format (it has only 1 row)
-        #                            primer1 primer2 primer3
-        #sample(abundance count)     10      20      30
-        for df in df_list:
-            df_dict = df.to_dict(orient='list')
-            sample = df.index.to_list()[0]
-            #go through each primer in our original primer panel
-            #check if it exists in the current primer_stats
-            for primer in primer_dict:
-                if primer in df_dict:
-                    read_count = df_dict[primer][0]
-                    if len(primer_dict[primer]) <= 0: #first timer
-                        primer_dict[primer].append(read_count) #running total
-                        primer_dict[primer].append((read_count,sample)) #min 
-                        primer_dict[primer].append((read_count,sample)) #max
-                    else:
-                        primer_dict[primer][0] = primer_dict[primer][0] + read_count
-                        if read_count < primer_dict[primer][1][0]:
-                            primer_dict[primer][1] = (read_count,sample)
-                        elif read_count > primer_dict[primer][2][0]:
-                            primer_dict[primer][2] = (read_count,sample)
-
-        #go through our primer panel again
+    def create_df(stats_df, pnames):
+        # column reductions over the sample x primer matrix, for each primer in our panel:
+        # mean read count (over all the samples), (min read count, sample name), (max read count, sample name)
+        # (if there is a tie, only the first sample is shown)
+        panel_df = stats_df.reindex(columns=list(pnames))
+        present = panel_df.columns[panel_df.notna().any()]
+        samples = panel_df.index.to_numpy()
+
+        counts = panel_df[present]
+        means = counts.sum() / len(panel_df)
+        values = counts.to_numpy()
+        min_samples = samples[np.nanargmin(values, axis=0)] if len(present) else []
+        max_samples = samples[np.nanargmax(values, axis=0)] if len(present) else []
+
         #if one primer has no associated reads at all, mark as 'n/a'
-        #otherwise, calculate the mean reads count, and conver the min/max tuples to String
-        for primer in primer_dict:
-            if len(primer_dict[primer]) <= 0:
-                primer_dict[primer].extend(['n/a']*3)
-            else:
-                primer_dict[primer][0] = primer_dict[primer][0]/len(df_list)
-                primer_dict[primer][1] = f'{primer_dict[primer][1][0]} / {primer_dict[primer][1][1]}'
-                primer_dict[primer][2] = f'{primer_dict[primer][2][0]} / {primer_dict[primer][2][1]}'
-
-        df = pd.DataFrame(primer_dict).transpose()
-        df.columns = ['p_col1', 'p_col2', 'p_col3']
+        df = pd.DataFrame('n/a', index=panel_df.columns, columns=['p_col1', 'p_col2', 'p_col3'], dtype=object)
+        df.loc[present, 'p_col1'] = [float(mean) for mean in means]
+        df.loc[present, 'p_col2'] = [f'{int(count)} / {sample}' for count, sample in zip(counts.min(), min_samples)]
+        df.loc[present, 'p_col3'] = [f'{int(count)} / {sample}' for count, sample in zip(counts.max(), max_samples)]
 
         return df
 
@@ -183,11 +191,8 @@ def make_primer_stats_yaml(output_file, primer_stats, oligos_file):
         },
     }
 
-    # Convert the DataFrame to the required format
-    data_yaml = create_df(primer_stats, oligos_file).to_dict(orient='index')
-
-    # Create the full YAML dictionary
-    yaml_dict = {
+    # Create the section config (the data part is streamed from the DataFrame)
+    section = {
         'id': 'primer_report',
         'section_name': 'Primer performance report',
         'description': 'reads count report per primer pair across all samples in this run',
@@ -199,34 +204,33 @@ def make_primer_stats_yaml(output_file, primer_stats, oligos_file):
             "no_violin": True,
         },
         'headers': headers,
-        'data': data_yaml
     }
 
-    # Write to a YAML file
-    with open(output_file, 'w') as file:
-        yaml.dump(yaml_dict, file, sort_keys=False)
+    # Write to a MultiQC custom content file
+    mqc_content.write_custom_content(output_file, section, create_df(stats_df, pnames))
 
         
-def make_read_length_yaml(output, read_length, noshow_samples):
+def make_read_length_yaml(output, report_df, noshow_samples):
     '''
     this method generates a custom content yaml file specific for the multiqc report
     this yaml file is for the final combined reads length report
 
     Parameters
     ----------
-    output: String, output file (yaml) name
-    read_length: String, concatenated names of each read_length csv file
+    output: String, output file (*_mqc.json or *_mqc.yaml) name
+    report_df: DataFrame, the concatenated read_length reports of all the samples
     noshow_samples: List, a list of sample names which does not generate any valid sequences
 
     Returns: None
     ----------
     '''   
-    df_list = [pd.read_csv(report, index_col=[0], sep='\t') for report in read_length.split()]
-    report_df = pd.concat(df_list)
-    report_df.columns = ['l_col0','l_col1','l_col2','l_col3', 'l_col4']
+    # object dtype, as the depth columns have NaN (n/a) for the samples run without the depth cap (i.e. in the run catalog)
+    report_df = report_df.astype(object)
+    # the raw and the capped depth columns are only there with the depth cap (check create_report.py)
+    report_df.columns = [f'l_col{ind}' for ind in range(len(report_df.columns))]
     report_df.fillna('n/a', inplace=True)
     for sample in noshow_samples:
-        report_df.loc[f'{sample}'] = [0, 0,'n/a', 'n/a', 'n/a']
+        report_df.loc[f'{sample}'] = [0, 0] + ['n/a'] * (len(report_df.columns) - 2)
 
 
     # Create headers dictionary
@@ -259,13 +263,21 @@ def make_read_length_yaml(output, read_length, noshow_samples):
             "scale": False,
             "format": "{:,.0f}"
         },
+        'l_col5': {
+            'title': 'raw depth',
+            'description': 'reads count per sample before the per-primer depth cap of the denoising',
+            "format": "{:,.0f}",
+        },
+        'l_col6': {
+            'title': 'capped depth',
+            'description': 'reads count per sample after the per-primer depth cap, the non-unique count is out of it',
+            "format": "{:,.0f}",
+        },
     }
+    headers = {col: header for col, header in headers.items() if col in report_df.columns}
 
-    # Convert the DataFrame to the required format
-    data_yaml = report_df.to_dict(orient='index')
-
-    # Create the full YAML dictionary
-    yaml_dict = {
+    # Create the section config (the data part is streamed from the DataFrame)
+    section = {
         'id': 'read_length_report',
         'section_name': 'Sample read length report',
         'description': 'reads length report per sample across all primer pairs in this run',
@@ -275,12 +287,10 @@ def make_read_length_yaml(output, read_length, noshow_samples):
             'sort_rows': False,
         },
         'headers': headers,
-        'data': data_yaml
     }
 
-    # Write to a YAML file
-    with open(output, 'w') as file:
-        yaml.dump(yaml_dict, file, sort_keys=False)
+    # Write to a MultiQC custom content file
+    mqc_content.write_custom_content(output, section, report_df)
 
 
 def make_report_yaml(output_file, data_df):
@@ -290,7 +300,7 @@ def make_report_yaml(output_file, data_df):
 
     Parameters
     ----------
-    output_file: output file (yaml) name
+    output_file: output file (*_mqc.json or *_mqc.yaml) name
     data_df: data part of the yaml file in the format of dataframe
 
     Returns: None
@@ -316,11 +326,8 @@ def make_report_yaml(output_file, data_df):
         },
     }
 
-    # Convert the DataFrame to the required format
-    data_yaml = data_df.to_dict(orient='index')
-
-    # Create the full YAML dictionary
-    yaml_dict = {
+    # Create the section config (the data part is streamed from the DataFrame)
+    section = {
         'id': 'hmas_run_report',
         'section_name': 'HMAS run report',
         'description': "Combined summary statistics for all the samples in the run, "
@@ -332,12 +339,10 @@ def make_report_yaml(output_file, data_df):
             'sort_rows': False
         },
         'headers': headers,
-        'data': data_yaml
     }
 
-    # Write to a YAML file
-    with open(output_file, 'w') as file:
-        yaml.dump(yaml_dict, file, sort_keys=False)
+    # Write to a MultiQC custom content file
+    mqc_content.write_custom_content(output_file, section, data_df)
 
 def extract_base_name(file_name, pattern):
     """
@@ -354,32 +359,59 @@ def parse_argument():
     parser = argparse.ArgumentParser(prog = 'create_report.py')
     parser.add_argument('-o', '--output', metavar = '', required = True, help = 'Specify output file')
     parser.add_argument('-y', '--yaml', metavar = '', required = True, help = 'Specify output mqc report file')
-    #passed in as a string (space delimited) from command line
-    parser.add_argument('-p', '--reports', metavar = '', required = True, help = 'Specify reports')
-    parser.add_argument('-i', '--sample_ids', metavar = '', required = True, help = 'Specify a string list of sample IDs, coming from nextflow')
+    #passed in as a string (space delimited) from command line, or listed in the manifest file
+    parser.add_argument('-p', '--reports', metavar = '', help = 'Specify reports')
+    parser.add_argument('-i', '--sample_ids', metavar = '', help = 'Specify a string list of sample IDs, coming from nextflow')
     
     parser.add_argument('-z', '--pyaml', metavar = '', required = True, help = 'Specify output primer_stats mqc report file')
-    parser.add_argument('-q', '--primer_stats', metavar = '', required = True, help = 'Specify input primer_stats')  
+    parser.add_argument('-q', '--primer_stats', metavar = '', help = 'Specify input primer_stats')  
     parser.add_argument('-l', '--primers', metavar = '', required = True, help = 'Specify primers')  
 
     parser.add_argument('-x', '--lyaml', metavar = '', required = True, help = 'Specify output read_length mqc report file')
-    parser.add_argument('-r', '--read_length', metavar = '', required = True, help = 'Specify input read_length file')  
+    parser.add_argument('-r', '--read_length', metavar = '', help = 'Specify input read_length file')  
     parser.add_argument('-g', '--gyaml', metavar = '', required = True, help = 'Specify output genus primer_stats mqc report file')
     parser.add_argument('-c', '--gcsv', metavar = '', required = True, help = 'Specify genus primer stats output file')
+    parser.add_argument('-d', '--catalog', metavar = '', help = 'Specify a (sqlite) run catalog file, only new or changed samples '
+                        'are read, and the reports are made from all the samples in the catalog (optional)')
+    parser.add_argument('-m', '--manifest', metavar = '', help = 'Specify a manifest file (tab delimited) listing the inputs, '
+                        'one per line as: report/primer_stats/read_length/sample <tab> file name/sample ID. '
+                        'It replaces the -p, -q, -r and -i arguments')
+    parser.add_argument('-t', '--threads', metavar = '', type = int, default = 1, help = 'Specify number of threads to read the inputs')
+
+    args = parser.parse_args()
+
+    if args.manifest:
+        manifest = utilities.read_manifest(args.manifest)
+        args.reports = manifest.get('report', [])
+        args.primer_stats = manifest.get('primer_stats', [])
+        args.read_length = manifest.get('read_length', [])
+        args.sample_ids = manifest.get('sample', [])
+    elif None in (args.reports, args.primer_stats, args.read_length, args.sample_ids):
+        parser.error('either -m/--manifest or all of -p, -q, -r and -i are required')
+    else:
+        args.reports = args.reports.split()
+        args.primer_stats = args.primer_stats.split()
+        args.read_length = args.read_length.split()
+        args.sample_ids = ast.literal_eval(args.sample_ids)
 
-    return parser.parse_args()
+    return args
 
 if __name__ == "__main__":
 
     args = parse_argument()
+
+    catalog = run_catalog.RunCatalog(args.catalog) if args.catalog else None
+
+    def load(kind, files, sep):
+        #with a run catalog, only the new or changed files are read, and all the catalog rows are returned
+        if catalog:
+            return catalog.sync(kind, files, lambda report: read_tables([report], sep))
+        return read_tables(files, sep, args.threads)
     
     #read each report csv file as a df
-    df_list = [pd.read_csv(report, index_col=[0]) for report in args.reports.split()]
-        
-    report_df = pd.concat(df_list)
+    report_df = load('report', args.reports, ',')
 
-    original_samples = ast.literal_eval(args.sample_ids)
-    noshow_samples = set(original_samples) - set(report_df.index)
+    noshow_samples = set(args.sample_ids) - set(report_df.index)
 
     #remove 'undetermined' sample name from our report
     noshow_samples = {sample for sample in noshow_samples if not (isinstance(sample, str) and 
@@ -399,9 +431,12 @@ if __name__ == "__main__":
     #update empty cell to n/a
     report_df.fillna('n/a', inplace=True)
     make_report_yaml(args.yaml, report_df)
-    make_primer_stats_yaml(args.pyaml, args.primer_stats, args.primers)
-    make_read_length_yaml(args.lyaml, args.read_length, noshow_samples)
+    # read all the primer_stats once, and share the sample x primer matrix with the primer reports
+    pnames = utilities.Primers(args.primers).pnames
+    stats_df = primer_stats_matrix(load('primer_stats', args.primer_stats, '\t'), pnames)
+    make_primer_stats_yaml(args.pyaml, stats_df, pnames)
+    make_read_length_yaml(args.lyaml, load('read_length', args.read_length, '\t'), noshow_samples)
     # generate 9 genus marker primers report
-    genus_primer_df = make_genus_primer_matrix_yaml(args.gyaml, args.primer_stats, 'typhi')
+    genus_primer_df = make_genus_primer_matrix_yaml(args.gyaml, stats_df, 'typhi')
     if genus_primer_df is not None and not genus_primer_df.empty:
         genus_primer_df.to_csv(f"{args.gcsv}")
\ No newline at end of file
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+
+import bz2
+import gzip
+import io
+import lzma
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+'''
+This module opens the (fasta, fastq and match) files of the pipeline transparently, compressed or not,
+based on the file extension:
+  .gz: gzip (with pigz, multi-threaded, if it's on the PATH; otherwise python's gzip)
+  .bz2: bzip2
+  .xz, .lzma: lzma
+  anything else: plain text
+
+Every file written is logged to stderr (i.e. the .command.err of the Nextflow task), with the bytes written
+(uncompressed), the size of the file on disk and the time spent, so the effect of compressing the intermediate
+files can be measured stage by stage; set HMAS_IO_LOG=0 to turn it off.
+
+The number of pigz threads is $HMAS_IO_THREADS (default: 4), and the gzip compression level is
+$HMAS_IO_LEVEL (default: 6, 1 is much faster for the temp files).
+'''
+
+GZIP_EXTS = ('.gz',)
+BZ2_EXTS = ('.bz2',)
+LZMA_EXTS = ('.xz', '.lzma')
+
+# buffer size of the (uncompressed) streams
+BUFFER_SIZE = 1 << 22
+
+
+def is_compressed(name):
+    return str(name).endswith(GZIP_EXTS + BZ2_EXTS + LZMA_EXTS)
+
+
+def io_threads():
+    return max(1, int(os.environ.get('HMAS_IO_THREADS', 4)))
+
+
+def gzip_level():
+    return min(9, max(1, int(os.environ.get('HMAS_IO_LEVEL', 6))))
+
+
+class TrackedStream(io.RawIOBase):
+    '''
+    Binary stream over a (compressed) file object or a pigz pipe, which counts the (uncompressed) bytes
+    read or written, waits for pigz (if any) when it's closed, and logs the bytes/time of the written files
+    '''
+
+    def __init__(self, name, stream, writing, process=None):
+        super().__init__()
+        self.name = str(name)
+        self.stream = stream
+        self.writing = writing
+        self.process = process
+        self.nbytes = 0
+        self.eof = False
+        self.start = time.perf_counter()
+
+    def readable(self):
+        return not self.writing
+
+    def writable(self):
+        return self.writing
+
+    def readinto(self, buffer):
+        count = self.stream.readinto(buffer)
+        self.nbytes += count or 0
+        self.eof = self.eof or count == 0
+        return count
+
+    def write(self, buffer):
+        self.stream.write(buffer)
+        count = len(buffer)
+        self.nbytes += count
+        return count
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            self.stream.close()
+            if self.process is not None:
+                returncode = self.process.wait()
+                # a reader may stop before the end of the file (pigz is then killed by SIGPIPE)
+                if returncode != 0 and (self.writing or self.eof):
+                    raise OSError(f'pigz failed ({returncode}) on {self.name}')
+        finally:
+            super().close()
+        if self.writing and os.environ.get('HMAS_IO_LOG', '1') != '0':
+            on_disk = os.path.getsize(self.name) if os.path.exists(self.name) else 0
+            print(f"[io] {os.path.basename(sys.argv[0]) or 'python'}: wrote {self.name} " \
+                  f"{self.nbytes:,} bytes ({on_disk:,} bytes on disk) in {time.perf_counter() - self.start:.2f} s",
+                  file=sys.stderr)
+
+
+def open_binary(name, writing):
+    '''
+    Returns a tuple of (binary file object, pigz process or None) of a file, compressed based on its extension
+    '''
+    name = str(name)
+    if name.endswith(GZIP_EXTS):
+        pigz = shutil.which('pigz')
+        if pigz and writing:
+            out = open(name, 'wb')
+            process = subprocess.Popen([pigz, '-c', f'-{gzip_level()}', '-p', str(io_threads())],
+                                       stdin=subprocess.PIPE, stdout=out)
+            out.close()
+            return process.stdin, process
+        if pigz:
+            open(name, 'rb').close() # raise the usual error if the file can't be read
+            process = subprocess.Popen([pigz, '-dc', '-p', str(io_threads()), name], stdout=subprocess.PIPE)
+            return process.stdout, process
+        return gzip.open(name, 'wb' if writing else 'rb', compresslevel=gzip_level()), None
+    if name.endswith(BZ2_EXTS):
+        return bz2.open(name, 'wb' if writing else 'rb'), None
+    if name.endswith(LZMA_EXTS):
+        return lzma.open(name, 'wb' if writing else 'rb'), None
+    return open(name, 'wb' if writing else 'rb'), None
+
+
+def open_file(name, mode='r', errors=None, newline=None):
+    '''
+    this method opens a file (compressed or not, based on its extension) for reading or writing
+
+    Parameters
+    ----------
+    name: String name of the file
+    mode: String, 'r'/'rt' or 'w'/'wt' (text), 'rb' or 'wb' (binary)
+    errors: String, how the text decoding errors are handled (as in open())
+    newline: String, as in open()
+
+    Returns a file object
+    ----------
+    '''
+    writing = 'w' in mode or 'a' in mode
+    if 'a' in mode and is_compressed(name):
+        raise ValueError(f'{name}: can not append to a compressed file')
+    if 'a' in mode:
+        stream, process = open(str(name), 'ab'), None
+    else:
+        stream, process = open_binary(name, writing)
+
+    raw = TrackedStream(name, stream, writing, process)
+    buffered = io.BufferedWriter(raw, BUFFER_SIZE) if writing else io.BufferedReader(raw, BUFFER_SIZE)
+    if 'b' in mode:
+        return buffered
+    return io.TextIOWrapper(buffered, errors=errors, newline=newline)
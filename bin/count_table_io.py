@@ -0,0 +1,289 @@
+#!/usr/bin/env python3
+
+import argparse
+import numpy as np
+import struct
+import zipfile
+
+'''
+This module reads/writes the compact columnar (binary) count table, a NumPy .npz archive holding:
+
+seqs:     the unique representative seqs (row names), as bytes
+sequences: (optional) the actual sequence of each row, as bytes. If present, the rows are sorted by it
+columns:  the sample.primer pairs (column names, sorted)
+samples:  the sample name of each column
+primers:  the primer name of each column
+indptr, indices, data:  the counts in compressed sparse row (CSR) format, i.e. the non-zero
+          counts of row i are data[indptr[i]:indptr[i+1]], in the columns indices[indptr[i]:indptr[i+1]]
+
+The run-level abundance matrix (check combine_count_tables.py) is the same kind of .npz archive, holding:
+
+sequences: the unique sequences across all the samples (rows, sorted), as bytes
+samples, primers: the (sorted) unique sample names and primer names
+col_sample, col_primer: the sample index and the primer index of each (sample, primer) column,
+          the columns are sorted by sample then primer
+sample_indptr: the columns of sample i are sample_indptr[i]:sample_indptr[i+1]
+primer_columns, primer_indptr: the columns of primer j are primer_columns[primer_indptr[j]:primer_indptr[j+1]]
+indptr, indices, data: the counts in compressed sparse column (CSC) format, i.e. the non-zero
+          counts of column j are data[indptr[j]:indptr[j+1]], in the rows indices[indptr[j]:indptr[j+1]]
+
+The archives are written uncompressed, so every array can be memory-mapped straight from the file.
+'''
+
+NPZ_EXTENSION = '.npz'
+FORMAT_VERSION = 1
+
+
+def is_count_npz(count_file):
+    '''
+    Returns True if the given count table file is a binary (.npz) count table
+    '''
+    return str(count_file).endswith(NPZ_EXTENSION)
+
+
+def save_count_npz(output_file, seqs, columns, samples, primers, indptr, indices, data, sequences=None):
+    '''
+    this method writes a binary (.npz) count table
+
+    Parameters
+    ----------
+    output_file: String, output file name (should end with .npz)
+    seqs: list of unique representative seqs (row names)
+    columns: list of sample.primer pairs (column names)
+    samples: list of sample name of each column
+    primers: list of primer name of each column
+    indptr, indices, data: list (or array) of the CSR counts
+    sequences: list of the actual sequence of each row, optional
+
+    Returns: None
+    ----------
+    '''
+    arrays = dict(format_version=np.array([FORMAT_VERSION]),
+                  seqs=np.array([seq.encode() for seq in seqs], dtype=bytes),
+                  columns=np.array(columns, dtype=str),
+                  samples=np.array(samples, dtype=str),
+                  primers=np.array(primers, dtype=str),
+                  indptr=np.asarray(indptr, dtype=np.int64),
+                  indices=np.asarray(indices, dtype=np.int32),
+                  data=np.asarray(data, dtype=np.int32))
+    if sequences is not None:
+        arrays['sequences'] = np.array([seq.encode() for seq in sequences], dtype=bytes)
+
+    # np.savez (not savez_compressed), so the arrays can be memory-mapped when loading
+    with open(output_file, 'wb') as f:
+        np.savez(f, **arrays)
+
+
+def _mmap_member(f, count_file, info):
+    '''
+    memory-maps one (uncompressed) .npy member of the .npz archive, returns None if it can't
+    '''
+    if info.compress_type != zipfile.ZIP_STORED:
+        return None
+
+    # skip the zip local file header: 30 bytes + file name + extra field
+    f.seek(info.header_offset)
+    header = f.read(30)
+    name_len, extra_len = struct.unpack('<HH', header[26:30])
+    f.seek(info.header_offset + 30 + name_len + extra_len)
+
+    version = np.lib.format.read_magic(f)
+    if version == (1, 0):
+        shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+    else:
+        shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+
+    if dtype.hasobject:
+        return None
+    if 0 in shape:
+        return np.empty(shape, dtype=dtype)
+
+    return np.memmap(count_file, dtype=dtype, mode='r', offset=f.tell(), shape=shape,
+                     order='F' if fortran_order else 'C')
+
+
+def load_count_npz(count_file, mmap=True):
+    '''
+    this method loads a binary (.npz) count table, memory-mapping the arrays by default
+
+    Parameters
+    ----------
+    count_file: String, the .npz count table file name
+    mmap: boolean, memory-map the arrays instead of reading them into memory
+
+    Returns: dictionary of {array name: numpy array}
+    ----------
+    '''
+    arrays = {}
+    with zipfile.ZipFile(count_file) as zf, open(count_file, 'rb') as f:
+        for info in zf.infolist():
+            name = info.filename[:-len('.npy')]
+            array = _mmap_member(f, count_file, info) if mmap else None
+            if array is None:
+                with zf.open(info) as member:
+                    array = np.lib.format.read_array(member, allow_pickle=False)
+            arrays[name] = array
+
+    return arrays
+
+
+def column_sums(arrays):
+    '''
+    this method sums up the counts of each column (sample.primer pair) of a loaded binary count table
+
+    Parameters
+    ----------
+    arrays: dictionary of arrays, as returned by load_count_npz()
+
+    Returns: numpy array of int64, one total per column
+    ----------
+    '''
+    sums = np.bincount(arrays['indices'], weights=arrays['data'], minlength=len(arrays['columns']))
+    return sums.astype(np.int64)
+
+
+def iter_rows(arrays):
+    '''
+    this method iterates over the rows of a loaded binary count table
+
+    Parameters
+    ----------
+    arrays: dictionary of arrays, as returned by load_count_npz()
+
+    Returns: generator of (seq, column indices, counts) tuples
+    ----------
+    '''
+    seqs, indptr, indices, data = arrays['seqs'], arrays['indptr'], arrays['indices'], arrays['data']
+    for row, seq in enumerate(seqs):
+        start, end = indptr[row], indptr[row + 1]
+        yield seq.decode(), indices[start:end], data[start:end]
+
+
+def export_tsv(arrays, output_file):
+    '''
+    this method exports a loaded binary count table as a mothur_equivalent full format count_table file
+
+    Parameters
+    ----------
+    arrays: dictionary of arrays, as returned by load_count_npz()
+    output_file: String, output count_table file name
+
+    Returns: None
+    ----------
+    '''
+    columns = [str(col) for col in arrays['columns']]
+    with open(output_file, 'w') as f:
+        f.write('\t'.join(['seq'] + columns) + '\n')
+        for seq, cols, counts in iter_rows(arrays):
+            row = np.zeros(len(columns), dtype=np.int64)
+            row[cols] = counts
+            f.write(f"{seq}\t" + '\t'.join(map(str, row.tolist())) + '\n')
+
+
+def save_run_matrix(output_file, sequences, samples, primers, col_sample, col_primer, indptr, indices, data):
+    '''
+    this method writes the run-level sequence x (sample, primer) abundance matrix
+
+    Parameters
+    ----------
+    output_file: String, output file name (should end with .npz)
+    sequences: list of unique sequences (rows, as bytes)
+    samples, primers: list of unique sample names and primer names
+    col_sample, col_primer: array of sample index and primer index of each column (sorted by sample, primer)
+    indptr, indices, data: array of the CSC counts
+
+    Returns: None
+    ----------
+    '''
+    col_sample = np.asarray(col_sample, dtype=np.int32)
+    col_primer = np.asarray(col_primer, dtype=np.int32)
+    sample_indptr = np.searchsorted(col_sample, np.arange(len(samples) + 1))
+    primer_columns = np.argsort(col_primer, kind='stable').astype(np.int32)
+    primer_indptr = np.searchsorted(col_primer[primer_columns], np.arange(len(primers) + 1))
+
+    with open(output_file, 'wb') as f:
+        np.savez(f,
+                 format_version=np.array([FORMAT_VERSION]),
+                 sequences=np.array(sequences, dtype=bytes),
+                 samples=np.array(samples, dtype=str),
+                 primers=np.array(primers, dtype=str),
+                 col_sample=col_sample,
+                 col_primer=col_primer,
+                 sample_indptr=sample_indptr.astype(np.int64),
+                 primer_columns=primer_columns,
+                 primer_indptr=primer_indptr.astype(np.int64),
+                 indptr=np.asarray(indptr, dtype=np.int64),
+                 indices=np.asarray(indices, dtype=np.int32),
+                 data=np.asarray(data, dtype=np.int32))
+
+
+def _column_entries(arrays, columns):
+    '''
+    Returns the (rows, columns, counts) arrays of the non-zero counts of the given columns of a run matrix
+    '''
+    indptr = arrays['indptr']
+    rows, cols, counts = [np.empty(0, dtype=np.int32)], [np.empty(0, dtype=np.int32)], [np.empty(0, dtype=np.int32)]
+    for col in columns:
+        start, end = indptr[col], indptr[col + 1]
+        rows.append(arrays['indices'][start:end])
+        cols.append(np.full(end - start, col, dtype=np.int32))
+        counts.append(arrays['data'][start:end])
+
+    return np.concatenate(rows), np.concatenate(cols), np.concatenate(counts)
+
+
+def slice_sample(arrays, sample):
+    '''
+    this method gets the counts of one sample out of a loaded run-level abundance matrix
+
+    Parameters
+    ----------
+    arrays: dictionary of arrays, as returned by load_count_npz()
+    sample: String, sample name
+
+    Returns: tuple of (rows, columns, counts) arrays of the non-zero counts, the primer of
+    the columns is arrays['primers'][arrays['col_primer'][columns]]
+    ----------
+    '''
+    ind = np.searchsorted(arrays['samples'], sample)
+    if ind >= len(arrays['samples']) or arrays['samples'][ind] != sample:
+        raise KeyError(f'{sample} is not in the run matrix')
+
+    sample_indptr = arrays['sample_indptr']
+    return _column_entries(arrays, range(sample_indptr[ind], sample_indptr[ind + 1]))
+
+
+def slice_primer(arrays, primer):
+    '''
+    this method gets the counts of one primer (across all samples) out of a loaded run-level abundance matrix
+
+    Parameters
+    ----------
+    arrays: dictionary of arrays, as returned by load_count_npz()
+    primer: String, primer name
+
+    Returns: tuple of (rows, columns, counts) arrays of the non-zero counts, the sample of
+    the columns is arrays['samples'][arrays['col_sample'][columns]]
+    ----------
+    '''
+    ind = np.searchsorted(arrays['primers'], primer)
+    if ind >= len(arrays['primers']) or arrays['primers'][ind] != primer:
+        raise KeyError(f'{primer} is not in the run matrix')
+
+    primer_indptr = arrays['primer_indptr']
+    return _column_entries(arrays, arrays['primer_columns'][primer_indptr[ind]:primer_indptr[ind + 1]])
+
+
+def parse_argument():
+
+    parser = argparse.ArgumentParser(prog = 'count_table_io.py')
+    parser.add_argument('-i', '--input', metavar = '', required = True, help = 'Specify input binary (.npz) count table')
+    parser.add_argument('-o', '--output', metavar = '', required = True, help = 'Specify output (text) count_table file')
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+
+    # export a binary count table as the mothur_equivalent text count_table
+    args = parse_argument()
+    export_tsv(load_count_npz(args.input), args.output)
@@ -1,25 +1,63 @@
 #!/usr/bin/env python3
 
-import pandas as pd
+import csv
 import utilities
+import count_table_io
+import compressed_io
 import argparse
-from Bio import SeqIO
 
 
 def parse_argument():
 
     parser = argparse.ArgumentParser(prog = 'create_report.py')
     parser.add_argument('-s', '--sample', metavar = '', required = True, help = 'Specify sample name')
-    parser.add_argument('-c', '--count_table', metavar = '', required = True, help = 'Specify count table file')
+    parser.add_argument('-c', '--count_table', metavar = '', required = True, help = 'Specify count table file (count_table or binary .npz)')
     parser.add_argument('-p', '--primers', metavar = '', required = True, help = 'Specify oligos/(primer) file')
     parser.add_argument('-o', '--output', metavar = '', required = True, help = 'Specify output file')
     parser.add_argument('-q', '--primer_stats', metavar = '', required = True, help = 'Specify primer_stats file')
     parser.add_argument('-f', '--fasta', metavar = '', required = True, help = 'Specify fasta file')
     parser.add_argument('-l', '--read_length', metavar = '', required = True, help = 'Specify output read_length file')
+    parser.add_argument('-d', '--depth_log', metavar = '', help = 'Specify the per-primer denoising log ({sample}_denoise_primer_log.tsv), '
+                        'to add the raw and the capped depth of the sample to the read_length file (with the depth cap, optional)')
     return parser.parse_args()
 
 
-def generate_primer_stats(sample, count_file, primer_stats):
+def round_half_even(value, ndigits):
+    '''
+    round the same way as numpy/pandas do (scale, round half to even, unscale), 
+    so the reports are the same as the ones made with pandas before
+    '''
+    scale = 10 ** ndigits
+    return round(value * scale) / scale
+
+
+def count_sums(count_file):
+    '''
+    this method reads the count table (only once), either the (text) count_table or the binary (.npz) one, 
+    and sums up the abundance count of each sample.primer column
+
+    Parameters
+    ----------
+    count_file: original count_table file
+
+    Returns: tuple of (list of sample.primer columns, list of abundance counts)
+    ----------
+    '''
+    if count_table_io.is_count_npz(count_file):
+        arrays = count_table_io.load_count_npz(count_file)
+        return [str(col) for col in arrays['columns']], count_table_io.column_sums(arrays).tolist()
+
+    with compressed_io.open_file(count_file) as f:
+        columns = f.readline().rstrip('\n').split('\t')[1:]
+        sums = [0] * len(columns)
+        for line in f:
+            counts = line.rstrip('\n').split('\t')[1:]
+            sums = [total + int(count) for total, count in zip(sums, counts)]
+
+    return columns, sums
+
+
+def generate_primer_stats(sample, sums, primer_stats):
     '''
     this method calculates primer stats for the given sample 
     and generate a report (tsv file) 
@@ -29,77 +67,108 @@ def generate_primer_stats(sample, count_file, primer_stats):
     Parameters
     ----------
     sample: sample name
-    count_file: original count_table file
+    sums: tuple of (sample.primer columns, abundance counts), as returned by count_sums()
     primer_stats: the output file
 
-    Returns: DataFrame
+    Returns: dictionary (key: primer; value: abundance count)
     ----------
     '''   
-    raw_df = pd.read_csv(count_file, sep='\t')
-    raw_df.drop(['seq'], axis=1, inplace=True)
-    
-    #convert to the format of:
-    #                            primer1 primer2 primer3
-    #sample(abundance count)     10      20      30
-    report_df = raw_df.sum().to_frame(name=sample).T
+    columns, counts = sums
 
     # to update the column name
     # from 2014K_0979.OG0000348primerGroup3 to OG0000348primerGroup3
     def rename_column(col):
         return col.split('.', 1)[1] if '.' in col else col
 
-    # Rename columns using a function directly
-    report_df = report_df.rename(columns=rename_column)
+    primers = [rename_column(col) for col in columns]
 
-    report_df.to_csv(f'{primer_stats}', sep='\t')
+    with open(f'{primer_stats}', 'w', newline='') as f:
+        writer = csv.writer(f, delimiter='\t', lineterminator='\n')
+        writer.writerow([''] + primers)
+        writer.writerow([sample] + counts)
     
-    return report_df
+    return dict(zip(primers, counts))
 
 
-def generate_read_length(sample, fasta_file, output):
+def read_depths(depth_log):
+    '''
+    this method sums up the raw and the capped depth (reads) of the sample over all the primers, from the
+    per-primer log of the denoising (check denoise_primers.py)
+
+    Parameters
+    ----------
+    depth_log: the {sample}_denoise_primer_log.tsv file name
+
+    Returns: tuple of (raw depth, capped depth)
+    ----------
+    '''
+    raw_depth, capped_depth = 0, 0
+    with open(depth_log, 'r', newline='') as f:
+        for row in csv.DictReader(f, delimiter='\t'):
+            raw_depth += int(row['abundance'])
+            capped_depth += int(row['capped_abundance'])
+    return raw_depth, capped_depth
+
+
+def generate_read_length(sample, fasta_file, output, depths=None):
     '''
     this method calculates read length stats for the given sample 
     and generate a report (tsv file) 
     #                            num_seqs   min_len avg_len max_len
     #sample                      10         150 175 200
 
+    The total (non-unique) count is the sum of the size= of the final unique seqs, i.e. of the reads the denoising
+    saw: with the depth cap, it's out of the capped depth, so the raw and the capped depth are added if given
+
     Parameters
     ----------
     sample: sample name
     fasta_file: the fasta file name
     output: the output read_length file name
+    depths: tuple of (raw depth, capped depth) of the sample, as returned by read_depths() (optional)
 
-    Returns: DataFrame
+    Returns: dictionary of the stats
     ----------
     '''   
-    # Read the sequences from the FASTA file
-    sequences = list(SeqIO.parse(fasta_file, "fasta"))
+    # a single streaming pass over the fasta file (sequences can span multiple lines)
+    lengths = []
     # total count of non-unique sequences
-    total_count = [int(record.id.lower().split("size=")[1]) for record in sequences if "size=" in record.id.lower() and record.id.lower().split("size=")[1].isdigit()]
+    total_count = 0
+    with compressed_io.open_file(fasta_file) as f:
+        for line in f:
+            if line.startswith('>'):
+                lengths.append(0)
+                seq_id = line[1:].split(None, 1)[0].lower() if line[1:].strip() else ''
+                if "size=" in seq_id and seq_id.split("size=")[1].isdigit():
+                    total_count += int(seq_id.split("size=")[1])
+            elif lengths:
+                lengths[-1] += len(line.strip())
     
     # Calculate the statistics
-    num_seqs = len(sequences)
-    lengths = [len(seq.seq) for seq in sequences]
+    num_seqs = len(lengths)
     min_length = min(lengths)
     avg_length = round(sum(lengths) / num_seqs, 1)
     max_length = max(lengths)
 
     stats = {
-        "num_total_seqs": [sum(total_count)],
-        "num_seqs": [num_seqs],
-        "avg_len": [avg_length],
-        "min_len": [min_length],
-        "max_len": [max_length]
+        "num_total_seqs": total_count,
+        "num_seqs": num_seqs,
+        "avg_len": avg_length,
+        "min_len": min_length,
+        "max_len": max_length
     }
+    if depths is not None:
+        stats["raw_depth"], stats["capped_depth"] = depths
     
-    # Convert to DataFrame
-    df = pd.DataFrame(stats, index=[sample])
-    df.to_csv(f'{output}', sep='\t')
+    with open(f'{output}', 'w', newline='') as f:
+        writer = csv.writer(f, delimiter='\t', lineterminator='\n')
+        writer.writerow([''] + list(stats))
+        writer.writerow([sample] + list(stats.values()))
     
-    return df
+    return stats
 
 
-def report(sample, count_file, oligos_file, report_file):
+def report(sample, sums, total_primer_count, report_file):
     '''
     this method calculates metrics like: Mean read depth, # of failed primer pairs and 
     generate a report (csv file) for state public health lab
@@ -108,52 +177,43 @@ def report(sample, count_file, oligos_file, report_file):
     Parameters
     ----------
     sample: sample name
-    count_file: original count_table file
-    oligos_file: oligo file (which contains the primer information)
+    sums: tuple of (sample.primer columns, abundance counts), as returned by count_sums()
+    total_primer_count: number of primer pairs in the oligo file (which contains the primer information)
     report_file: the output file name
 
-    Returns: DataFrame
+    Returns: list of the report values
     ----------
     '''   
-    raw_df = pd.read_csv(count_file, sep='\t')
-    raw_df.drop(['seq'], axis=1, inplace=True)
-    
-    #convert to the format of:
-    #                            primer1 primer2 primer3
-    #sample(abundance count)     10      20      30
-    report_df = raw_df.sum().to_frame(name=sample).T
-    
-    oligo_primers = utilities.Primers(oligos_file)
-    total_primer_count = len(oligo_primers.pnames)
-    
+    columns, counts = sums
+
     #this is failed primer pairs (common denominator) for all the samples
-    all_failed_pp_count = total_primer_count - len(raw_df.columns)
-    
-    #including those empty cell while calculating the mean
-    report_df['mean'] = report_df.fillna(0).mean(axis=1).apply(lambda x:(round(x,1)))
-    report_df['failed_pp'] = report_df.isna().sum(axis=1).apply(lambda x: x+all_failed_pp_count)
-    report_df['perc_successful_pp'] = round(1 - report_df['failed_pp']/total_primer_count, 3)
-    # report_df['failed_pp'] = report_df['failed_pp'].apply(lambda x: f" {x} / {total_primer_count}")
-    report_df['good_pp'] = report_df['failed_pp'].apply(lambda x: f" {total_primer_count-x} / {total_primer_count}")
+    #(every sample.primer column in the count table has at least one read)
+    failed_pp = total_primer_count - len(columns)
     
-    report_df = report_df[['mean','perc_successful_pp','good_pp']]
-    #add 'Mean read depth across entire run' as a separate line at the end
-    ### don't need this for this single sample report
-    # report_df.loc['Mean read depth across entire run'] = [int(round(report_df['mean'].mean(),0)),None,None]
+    mean = round_half_even(sum(counts) / len(counts), 1) if counts else ''
+    perc_successful_pp = round_half_even(1 - failed_pp/total_primer_count, 3)
+    good_pp = f" {total_primer_count-failed_pp} / {total_primer_count}"
     
     report_columns = [f'Mean read depth',
                       f'% of successful primer-pairs\n(has at least 2 amplicons in the sample)',
                       f'# of primer pairs with more than 2 amplicons mapping\nover total primer-pairs']
-    report_df.columns = report_columns
-    
-    report_df.to_csv(f'{report_file}')
+    values = [mean, perc_successful_pp, good_pp]
+
+    with open(f'{report_file}', 'w', newline='') as f:
+        writer = csv.writer(f, lineterminator='\n')
+        writer.writerow([''] + report_columns)
+        writer.writerow([sample] + values)
     
-    return report_df
+    return values
     
     
 if __name__ == "__main__":
 
     args = parse_argument()
-    report(args.sample, args.count_table, args.primers, args.output)
-    generate_primer_stats(args.sample, args.count_table, args.primer_stats)
-    generate_read_length(args.sample, args.fasta, args.read_length)
\ No newline at end of file
+    # load the count table and the primer file only once, and share them with all the reports
+    sums = count_sums(args.count_table)
+    total_primer_count = len(utilities.Primers(args.primers).pnames)
+
+    report(args.sample, sums, total_primer_count, args.output)
+    generate_primer_stats(args.sample, sums, args.primer_stats)
+    generate_read_length(args.sample, args.fasta, args.read_length, read_depths(args.depth_log) if args.depth_log else None)
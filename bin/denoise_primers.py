@@ -0,0 +1,314 @@
+#!/usr/bin/env python3
+
+import argparse
+import os
+import csv
+import heapq
+import shutil
+import subprocess
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+import utilities
+import partition_primers
+
+'''
+This script denoises the (dereplicated) reads of one sample primer by primer (it replaces run_cluster_unoise.sh):
+1. the reads are split into one fasta per primer in a single pass (check partition_primers.py)
+2. vsearch --cluster_unoise runs on each primer partition, in a pool of worker threads;
+   the largest partitions (by abundance) are scheduled first, so a few very deep primers don't finish last
+3. the centroids of all the primers are k-way merged in the order of vsearch --sortbysize: by decreasing size=,
+   then by label (the ties of the size), then in the input order, as if they were concatenated (in the order of
+   the oligo file) and sorted with vsearch --sortbysize
+
+Optionally (-f), the chimeras are removed (vsearch --uchime3_denovo) within each primer's centroids, in the same
+worker right after the clustering, as a chimera can only be made of the amplicons of the same primer. The
+non-chimeric centroids are merged the same way into the final fasta file, and the per-primer counts of the
+centroids and the chimeras are added to the per-primer log.
+
+Optionally (-s, off by default), the small partitions (at most -s unique reads above minsize) are denoised in
+process, without a vsearch launch, when their result is certain: UNOISE (vsearch --cluster_unoise) only merges
+a read into a more abundant centroid if their skew (abundance ratio) is at most 1/2^(alpha*d+1), d being the
+number of differences in the alignment. The terminal gaps are not counted in d (a read which is a prefix or a
+suffix of the centroid has no difference), so d can be 0 for any pair of reads, and the skew rule can only rule
+a merge out if the skew is above 1/2: if every read is more than half as abundant as each more abundant read,
+every read is a centroid of its own. Otherwise (or if there are ties in the abundance) vsearch is used. As vsearch
+does, the reads shorter than 32 bp (--minseqlength) are dropped, and the centroids are written 80 bases a line.
+Besides, there is no need to search for chimeras in less than 3 centroids (a chimera needs 2 more abundant parents).
+
+Optionally (-d), the depth of the over-represented primers is capped before the denoising (check partition_primers.py),
+the raw and the capped counts of each primer are both in the per-primer log.
+'''
+
+
+DEFAULT_SMALL = 0
+
+# the vsearch defaults: --minseqlength of the clustering, and --fasta_width of its fasta outputs
+MIN_SEQ_LENGTH = 32
+FASTA_WIDTH = 80
+
+
+def parse_argument():
+
+    parser = argparse.ArgumentParser(prog = 'denoise_primers.py')
+    parser.add_argument('-i', '--input', metavar = '', required = True, help = 'Specify input (dereplicated) fasta file')
+    parser.add_argument('-p', '--primers', metavar = '', required = True, help = 'Specify oligos/(primer) file')
+    parser.add_argument('-o', '--output', metavar = '', required = True, help = 'Specify output (sorted) fasta file')
+    parser.add_argument('-m', '--minsize', metavar = '', required = True, help = 'Specify vsearch --minsize')
+    parser.add_argument('-a', '--alpha', metavar = '', required = True, help = 'Specify vsearch --unoise_alpha')
+    parser.add_argument('-t', '--threads', metavar = '', type = int, default = 1, help = 'Specify number of threads')
+    parser.add_argument('-f', '--final', metavar = '', help = 'Specify output (sorted) fasta file of the non-chimeric centroids, '
+                        'the chimeras are removed per primer if it is given')
+    parser.add_argument('-s', '--small', metavar = '', type = int, default = DEFAULT_SMALL,
+                        help = f'Specify the max number of unique reads (above minsize) of a partition to denoise '
+                        f'in process, 0 to always use vsearch (default: {DEFAULT_SMALL})')
+    parser.add_argument('-d', '--max_depth', metavar = '', type = int, default = 0,
+                        help = 'Specify the max abundance (reads) of a primer before the denoising, '
+                        'the deeper primers are downsampled (default: 0, no cap)')
+    parser.add_argument('-e', '--seed', metavar = '', type = int, default = 0, help = 'Specify the seed of the downsampling (default: 0)')
+    parser.add_argument('-l', '--log', metavar = '', help = 'Specify output per-primer log (tsv) file '
+                        '(default: the output file name with .primer_counts.tsv)')
+    return parser.parse_args()
+
+
+def cluster_unoise(subset, centroids, minsize, alpha):
+    '''
+    this method runs vsearch --cluster_unoise (single threaded) on one primer partition
+    '''
+    subprocess.run(['vsearch', '--cluster_unoise', subset,
+                    '--minsize', str(minsize),
+                    '--unoise_alpha', str(alpha),
+                    '--centroids', centroids,
+                    '--sizein', '--sizeout',
+                    '--threads', '1',
+                    '--quiet'], check=True)
+
+
+def uchime3_denovo(centroids, nonchimeras):
+    '''
+    this method runs vsearch --uchime3_denovo on the centroids of one primer
+
+    Returns: tuple of (# of centroids, # of chimeras)
+    '''
+    subprocess.run(['vsearch', '--uchime3_denovo', centroids,
+                    '--nonchimeras', nonchimeras,
+                    '--quiet'], check=True)
+    total, kept = count_records(centroids), count_records(nonchimeras)
+    return total, total - kept
+
+
+def count_records(fasta_file):
+    if not os.path.exists(fasta_file):
+        return 0
+    with open(fasta_file, 'r') as f:
+        return sum(1 for line in f if line.startswith('>'))
+
+
+def read_records(fasta_file):
+    '''
+    Returns a list of (abundance, sequence, record text) of a fasta file
+    '''
+    records = []
+    with open(fasta_file, 'r') as f:
+        for line in f:
+            if line.startswith('>'):
+                records.append([partition_primers.abundance(line[1:]), '', line])
+            elif records:
+                records[-1][1] += line.strip().upper()
+                records[-1][2] += line
+    return records
+
+
+def unoise_in_process(subset, centroids, minsize, alpha, small):
+    '''
+    this method denoises a small primer partition in process, if the result is certain (check the top of the script)
+
+    Parameters
+    ----------
+    subset: String name of the partition fasta file (sorted by decreasing abundance)
+    centroids: String name of the output centroids fasta file
+    minsize: int, min abundance of a read
+    alpha: float, the unoise alpha (the result is only certain if it does not matter)
+    small: int, max number of reads (above minsize) to denoise in process
+
+    Returns: True if the centroids file was written, False if vsearch should be used
+    '''
+    # the reads vsearch drops before the clustering: below minsize, or shorter than its --minseqlength
+    records = [record for record in read_records(subset) if record[0] >= minsize and len(record[1]) >= MIN_SEQ_LENGTH]
+    if len(records) > small:
+        return False
+
+    records.sort(key=lambda record: record[0], reverse=True)
+    sizes = [size for size, _, _ in records]
+    if len(set(sizes)) < len(sizes):
+        return False
+
+    # the skew rule fails even at d = 0 (skew > 1/2) for every pair iff it fails for the least and the most abundant
+    # reads; alpha doesn't matter then, as d may be 0 for any pair (the terminal gaps are not counted)
+    if len(sizes) > 1 and sizes[-1] / sizes[0] <= 0.5:
+        return False
+
+    with open(centroids, 'w') as out:
+        for _, _, text in records:
+            header, *lines = text.splitlines()
+            seq = ''.join(line.strip() for line in lines)
+            out.write(f'{header}\n')
+            out.writelines(f'{seq[start:start + FASTA_WIDTH]}\n' for start in range(0, len(seq), FASTA_WIDTH))
+    return True
+
+
+def denoise_primer(subset, centroids, nonchimeras, minsize, alpha, small=DEFAULT_SMALL):
+    '''
+    this method clusters one primer partition and (if nonchimeras is given) removes the chimeras from its centroids
+
+    Returns: tuple of (# of centroids, # of chimeras), the chimeras are 'n/a' if they were not removed
+    '''
+    if small > 0 and unoise_in_process(subset, centroids, int(minsize), float(alpha), small):
+        print (f"{os.path.basename(subset)} denoised in process")
+    else:
+        cluster_unoise(subset, centroids, minsize, alpha)
+    total = count_records(centroids)
+    if nonchimeras is None:
+        return total, 'n/a'
+    if total == 0:
+        return 0, 0
+    if total < 3:
+        shutil.copyfile(centroids, nonchimeras)
+        return total, 0
+    return uchime3_denovo(centroids, nonchimeras)
+
+
+def write_log(log_file, counts, capped, results):
+    '''
+    this method writes the per-primer log: records and abundance of each primer partition (raw and capped), 
+    and the number of centroids and chimeras of each primer
+    '''
+    with open(log_file, 'w', newline='') as f:
+        writer = csv.writer(f, delimiter='\t', lineterminator='\n')
+        writer.writerow(['primer', 'records', 'abundance', 'capped_records', 'capped_abundance', 'centroids', 'chimeras'])
+        for primer, (records, total) in counts.items():
+            writer.writerow([primer, records, total, *capped[primer], *results[primer]])
+
+
+def read_sorted_records(fasta_file, primer_ind):
+    '''
+    this method reads the records of a centroids fasta file and sorts them as vsearch --sortbysize does:
+    by decreasing size=, then by label (the whole header line, compared as strcmp does), then in the input order
+
+    Parameters
+    ----------
+    fasta_file: String name of the fasta file
+    primer_ind: int, index of the primer in the oligo file (the input order of the concatenated files)
+
+    Returns: list of (-size, label, primer index, record index, record text) tuples
+    ----------
+    '''
+    records = []
+    with open(fasta_file, 'r') as f:
+        for line in f:
+            if line.startswith('>'):
+                records.append([partition_primers.abundance(line[1:]), line[1:].rstrip('\r\n'), line])
+            elif records:
+                records[-1][2] += line
+    return sorted((-size, label, primer_ind, ind, text) for ind, (size, label, text) in enumerate(records))
+
+
+def merge_centroids(centroid_files, output_file):
+    '''
+    this method k-way merges the centroids of all the primers in the order of vsearch --sortbysize
+    (decreasing size=, then label, then the order of the primers in the oligo file and within each file)
+
+    Parameters
+    ----------
+    centroid_files: list of centroids fasta files, in the order of the oligo file
+    output_file: String name of the output fasta file
+
+    Returns: int, number of the records
+    ----------
+    '''
+    count = 0
+    with open(output_file, 'w') as out:
+        for *_, text in heapq.merge(*[read_sorted_records(centroid_file, ind)
+                                      for ind, centroid_file in enumerate(centroid_files)]):
+            out.write(text)
+            count += 1
+    return count
+
+
+def denoise(input_fasta, oligos_file, output_file, minsize, alpha, threads=1, final_file=None, log_file=None,
+            small=DEFAULT_SMALL, max_depth=0, seed=0):
+    '''
+    this method partitions the reads by primer, runs UNOISE (and optionally the chimera removal) on the 
+    partitions in parallel and merges the sorted centroids into the output file(s)
+
+    Parameters
+    ----------
+    input_fasta: String name of the input (dereplicated) fasta file
+    oligos_file: String name of the oligos/(primer) file
+    output_file: String name of the output fasta file (centroids)
+    minsize, alpha: vsearch --minsize and --unoise_alpha
+    threads: int, number of the worker threads
+    final_file: String name of the output fasta file of the non-chimeric centroids, None to skip the chimera removal
+    log_file: String name of the per-primer log file
+    small: int, max number of reads (above minsize) of a partition to denoise in process
+    max_depth: int, max abundance of a primer (0: no cap)
+    seed: int, seed of the downsampling
+
+    Returns: tuple of (# of the records in the output file, # of the records in the final file)
+    ----------
+    '''
+    pnames = list(utilities.Primers(oligos_file).pnames)
+    if log_file is None:
+        log_file = f'{os.path.splitext(output_file)[0]}.primer_counts.tsv'
+    tmpdir = tempfile.mkdtemp(prefix='tmp.', dir='.')
+    try:
+        counts, _ = partition_primers.partition(input_fasta, pnames, tmpdir)
+        capped = partition_primers.cap_depth(tmpdir, counts, max_depth, seed)
+
+        primers = [primer for primer in pnames if counts[primer][0]]
+        subset = {primer: os.path.join(tmpdir, f'{primer}.fasta') for primer in primers}
+        centroids = {primer: os.path.join(tmpdir, f'{primer}.final.fasta') for primer in primers}
+        nonchimeras = {primer: os.path.join(tmpdir, f'{primer}.nonchimeras.fasta') if final_file else None
+                       for primer in primers}
+
+        # largest partitions first
+        schedule = sorted(primers, key=lambda primer: capped[primer][1], reverse=True)
+        with ThreadPoolExecutor(max_workers=max(1, threads)) as executor:
+            jobs = {primer: executor.submit(denoise_primer, subset[primer], centroids[primer], nonchimeras[primer],
+                                            minsize, alpha, small)
+                    for primer in schedule}
+            # the empty partitions have no centroids (and no chimeras)
+            results = {primer: (0, 0 if final_file else 'n/a') for primer in pnames}
+            results.update({primer: job.result() for primer, job in jobs.items()})
+        write_log(log_file, counts, capped, results)
+
+        def merge(files, output):
+            files = [fasta for fasta in files if fasta and os.path.exists(fasta)]
+            return merge_centroids(files, output) if files else 0
+
+        output_count = merge([centroids[primer] for primer in primers], output_file)
+        final_count = merge([nonchimeras[primer] for primer in primers], final_file) if final_file else 0
+        return output_count, final_count
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+
+    args = parse_argument()
+
+    if not os.path.exists(args.input) or os.path.getsize(args.input) == 0:
+        print ("Input fasta is empty or missing. Exiting.")
+    else:
+        count, final_count = denoise(args.input, args.primers, args.output, args.minsize, args.alpha,
+                                     args.threads, args.final, args.log, args.small,
+                                     args.max_depth, args.seed)
+        if count:
+            print (f"All primers processed. {count} centroids merged and sorted into: {args.output}")
+            if args.final:
+                print (f"{count - final_count} chimeras removed, {final_count} non-chimeric centroids in: {args.final}")
+        else:
+            print ("No sequences were processed, nothing to merge or sort.")
+        # no (empty) output files, same as running vsearch on an empty input
+        for output, records in [(args.output, count), (args.final, final_count)]:
+            if output and not records and os.path.exists(output):
+                os.remove(output)
@@ -0,0 +1,340 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import re
+import sys
+from collections import Counter
+from itertools import product, zip_longest
+import utilities
+import compressed_io
+
+'''
+This script removes the primers of paired-end reads (and assigns the reads to their primer) the same way
+our cutadapt command (check run_cutadapt.py) does, for the zero-error mode (cutadapt_maxerror = 0):
+  cutadapt -a name=^FWD...RC_REV -A name=^REV...RC_FWD  (or -g name=^FWD -G name=^REV for short reads)
+           -e 0 -m min_length --discard-untrimmed --rename '{id}  adapter={adapter_name}=sample {comment}'
+
+As the 5' primers are anchored and matched exactly, the primer of a read is looked up (in O(1)) in a hash of
+the read prefix: the forward (R1) and reverse (R2) primers are indexed by their first k bases (k is the length
+of the shortest primer), with their IUPAC codes (i.e. the R in GRCGGGG...) expanded. The linked 3' primer is
+then searched (exactly) in the rest of the read; as cutadapt does, the leftmost full match is trimmed,
+otherwise the longest partial match (at least 3 bases) at the end of the read.
+
+The same as cutadapt, if several primers match a read, the one with the most matching bases (5' and 3') wins,
+the ties go to the primer listed first on the cutadapt command line (the last one in the oligo file);
+a read pair is discarded if either read is shorter than min_length, or else if either read is untrimmed
+(cutadapt's default --pair-filter=any, with adapters on both reads).
+A cutadapt compatible (schema 0.3) json report is written for MultiQC, with the cutadapt version of our
+environment (bin/hmas.yaml) as its cutadapt_version, and exact_demux.py as its demultiplexer.
+'''
+
+IUPAC = utilities.IUPAC
+
+# cutadapt default --overlap (min overlap of a partial 3' match)
+MIN_OVERLAP = 3
+
+# the cutadapt version (bin/hmas.yaml) whose json report (and trimmed reads) we reproduce
+CUTADAPT_VERSION = '4.8'
+
+
+def parse_argument():
+
+    parser = argparse.ArgumentParser(prog = 'exact_demux.py')
+    parser.add_argument('-f', '--read1', metavar = '', required = True, help = 'Specify R1 read')
+    parser.add_argument('-r', '--read2', metavar = '', required = True, help = 'Specify R2 read')
+    parser.add_argument('-o', '--out_dir', metavar = '', required = True, help = 'Specify output folder')
+    parser.add_argument('-s', '--sample', metavar = '', required = True, help = 'Specify sample name')
+    parser.add_argument('-p', '--oligo_file', metavar = '', required = True, help = 'Specify oligo file')
+    parser.add_argument('-l', '--min_length', metavar = '', type = int, default = 1, help = 'min length')
+    parser.add_argument('-b', '--mode', metavar = '', default = 'true', help = 'boolean value if reads are longer than amplicons')
+    return parser.parse_args()
+
+
+def iupac_pattern(seq):
+    '''
+    Returns the regex pattern of a primer sequence, with its IUPAC codes as character classes
+    '''
+    return ''.join(IUPAC[base] if len(IUPAC[base]) == 1 else f'[{IUPAC[base]}]' for base in seq.upper())
+
+
+class Adapter:
+    'An anchored 5\' primer, optionally linked to a (non-anchored, optional) 3\' primer'
+
+    def __init__(self, name, front, back=None):
+        self.name = name
+        self.front = front.upper()
+        self.back = back.upper() if back else None
+        self.front_re = re.compile(iupac_pattern(self.front))
+        if self.back:
+            self.back_re = re.compile(iupac_pattern(self.back))
+            self.back_sets = [IUPAC[base] for base in self.back]
+
+    def find_back(self, rest):
+        '''
+        this method finds the 3' primer in the rest of the read (after the 5' primer)
+
+        Returns: tuple of (start of the match, # of matching bases), or None
+        '''
+        match = self.back_re.search(rest)
+        if match:
+            return match.start(), len(self.back)
+
+        # a partial match at the end of the read, the longest one first
+        for overlap in range(min(len(self.back) - 1, len(rest)), MIN_OVERLAP - 1, -1):
+            start = len(rest) - overlap
+            if all(base in bases for base, bases in zip(rest[start:], self.back_sets)):
+                return start, overlap
+        return None
+
+
+class PrimerIndex:
+    'Hash of the (IUPAC expanded) prefixes of the 5\' primers of one read of the pair'
+
+    def __init__(self, adapters):
+        self.adapters = adapters
+        self.k = min(len(adapter.front) for adapter in adapters)
+        self.index = {}
+        for ind, adapter in enumerate(adapters):
+            for prefix in product(*[IUPAC[base] for base in adapter.front[:self.k]]):
+                self.index.setdefault(''.join(prefix), []).append(ind)
+
+    def match(self, seq):
+        '''
+        this method finds the best primer match of a read
+
+        Returns: tuple of (adapter index, end of the 5' primer, (start, # of matching bases) of the 3' primer or None),
+                 or None if no primer matches
+        '''
+        best, best_matches = None, -1
+        for ind in self.index.get(seq[:self.k], ()):
+            adapter = self.adapters[ind]
+            if not adapter.front_re.match(seq):
+                continue
+            end = len(adapter.front)
+            back = adapter.find_back(seq[end:]) if adapter.back else None
+            matches = end + (back[1] if back else 0)
+            # the first adapter (on the cutadapt command line) wins the ties
+            if matches > best_matches:
+                best, best_matches = (ind, end, back), matches
+        return best
+
+
+class AdapterStats:
+    'Per-adapter statistics of one read of the pair, for the cutadapt json report'
+
+    def __init__(self, adapters):
+        self.adapters = adapters
+        self.total = Counter()
+        self.back_lengths = [Counter() for _ in adapters]
+        self.adjacent = [Counter() for _ in adapters]
+
+    def add(self, ind, rest, back):
+        self.total[ind] += 1
+        if back:
+            start, _ = back
+            self.back_lengths[ind][len(rest) - start] += 1
+            self.adjacent[ind][rest[start - 1] if start > 0 and rest[start - 1] in 'ACGT' else ''] += 1
+
+    def report(self, n_reads):
+        adapters = []
+        for ind, adapter in enumerate(self.adapters):
+            total = self.total[ind]
+            front = end_report('anchored_five_prime', adapter.front, total,
+                               [{'len': len(adapter.front), 'expect': round(n_reads * 0.25 ** len(adapter.front), 1),
+                                 'counts': [total]}] if total else [], None, None)
+            back = None
+            if adapter.back:
+                lengths = self.back_lengths[ind]
+                back = end_report('regular_three_prime', adapter.back, sum(lengths.values()),
+                                  [{'len': length, 'expect': round(n_reads * 0.25 ** min(length, len(adapter.back)), 1),
+                                    'counts': [lengths[length]]} for length in sorted(lengths)],
+                                  {base: self.adjacent[ind][base] for base in ['A', 'C', 'G', 'T', '']},
+                                  [len(adapter.back)])
+            # as cutadapt does, the matches of both ends of a linked adapter are added up
+            adapters.append({'name': adapter.name, 'total_matches': total + (back['matches'] if back else 0),
+                             'on_reverse_complement': None, 'linked': adapter.back is not None,
+                             'five_prime_end': front, 'three_prime_end': back})
+        return adapters
+
+
+def end_report(end_type, sequence, matches, trimmed_lengths, adjacent_bases, error_lengths):
+    '''
+    Returns the cutadapt json statistics of one end of an adapter; the adjacent bases are None without matches,
+    and the dominant one is the base before more than 80% of the (at least 20) matches, as in cutadapt
+    '''
+    dominant = None
+    if adjacent_bases is not None and matches:
+        dominant = next((base for base in ['A', 'C', 'G', 'T'] if adjacent_bases[base] / matches > 0.8), None) \
+                   if matches >= 20 else None
+    else:
+        adjacent_bases = None
+    return {'type': end_type, 'sequence': sequence, 'error_rate': 0.0, 'indels': True, 'error_lengths': error_lengths,
+            'matches': matches, 'adjacent_bases': adjacent_bases, 'dominant_adjacent_base': dominant,
+            'trimmed_lengths': trimmed_lengths}
+
+
+def build_adapters(oligo_file, linked=True):
+    '''
+    this method builds the R1 and R2 adapters of all the primers, in the order of our cutadapt command line
+    (the last primer of the oligo file first)
+
+    Returns: tuple of (list of R1 adapters, list of R2 adapters)
+    '''
+    panel = utilities.load_panel(oligo_file)
+    read1, read2 = [], []
+    for key in reversed(panel.pnames):
+        fprimer = panel.forward[key]
+        rc_fprimer = panel.rc_forward[key]
+        rc_rprimer = panel.reverse[key] # by default we use reverse complement of reverse_primer in primer file
+        rprimer = panel.rc_reverse[key]
+        read1.append(Adapter(key, fprimer, rc_rprimer if linked else None))
+        read2.append(Adapter(key, rprimer, rc_fprimer if linked else None))
+    return read1, read2
+
+
+def read_fastq(f):
+    '''
+    Returns a generator of (header, sequence, plus line, quality) of the fastq records, without the line ends
+    '''
+    while True:
+        header = f.readline()
+        if not header:
+            return
+        seq, plus, qual = f.readline(), f.readline(), f.readline()
+        if not header.startswith('@') or not plus.startswith('+') or not qual:
+            raise ValueError(f'invalid fastq record: {header.rstrip()}')
+        yield header[1:].rstrip('\r\n'), seq.rstrip('\r\n'), plus.rstrip('\r\n'), qual.rstrip('\r\n')
+
+
+def read_id(header):
+    read_id = header.split(None, 1)[0] if header.strip() else ''
+    return read_id[:-2] if read_id.endswith(('/1', '/2')) else read_id
+
+
+def trim(record, index, stats):
+    '''
+    this method removes the primers of a read
+
+    Returns: tuple of (adapter name or None, trimmed sequence, trimmed quality)
+    '''
+    _, seq, _, qual = record
+    match = index.match(seq)
+    if match is None:
+        return None, seq, qual
+
+    ind, end, back = match
+    rest = seq[end:]
+    stats.add(ind, rest, back)
+    stop = end + back[0] if back else len(seq)
+    return index.adapters[ind].name, seq[end:stop], qual[end:stop]
+
+
+def write_fastq(f, record, name, seq, qual, sample):
+    header = record[0]
+    fields = header.split(None, 1) if header.strip() else ['']
+    comment = fields[1] if len(fields) > 1 else ''
+    new_header = f"{fields[0]}  adapter={name if name else 'no_adapter'}={sample} {comment}"
+    f.write(f"@{new_header}\n{seq}\n{'+' if record[2] == '+' else '+' + new_header}\n{qual}\n")
+
+
+def demultiplex(read1, read2, out1, out2, oligo_file, sample, min_length=1, linked=True, json_file=None):
+    '''
+    this method removes the primers of all the read pairs, writes the trimmed reads and the json report
+
+    Parameters
+    ----------
+    read1, read2: String names of the R1 and R2 fastq (or fastq.gz) files
+    out1, out2: String names of the output (trimmed) R1 and R2 fastq files
+    oligo_file: String name of the oligo file
+    sample: String, sample name
+    min_length: int, min length of a (trimmed) read
+    linked: boolean, if the reads are longer than amplicons (the 3' primers are trimmed as well)
+    json_file: String name of the json report file (optional)
+
+    Returns: dictionary of the json report
+    ----------
+    '''
+    adapters1, adapters2 = build_adapters(oligo_file, linked)
+    index1, index2 = PrimerIndex(adapters1), PrimerIndex(adapters2)
+    stats1, stats2 = AdapterStats(adapters1), AdapterStats(adapters2)
+
+    n_pairs = too_short = untrimmed = written = 0
+    with1 = with2 = 0
+    bp_in1 = bp_in2 = bp_out1 = bp_out2 = 0
+    with compressed_io.open_file(read1) as f1, compressed_io.open_file(read2) as f2, \
+         compressed_io.open_file(out1, 'w') as o1, compressed_io.open_file(out2, 'w') as o2:
+        for record1, record2 in zip_longest(read_fastq(f1), read_fastq(f2)):
+            if record1 is None or record2 is None:
+                raise ValueError(f'Reads are improperly paired. There are more reads in file {1 if record2 is None else 2}')
+            if read_id(record1[0]) != read_id(record2[0]):
+                raise ValueError(f'Reads are improperly paired. Read name {record1[0]} in file 1 does not match '
+                                 f'{record2[0]} in file 2')
+            n_pairs += 1
+            bp_in1 += len(record1[1])
+            bp_in2 += len(record2[1])
+
+            name1, seq1, qual1 = trim(record1, index1, stats1)
+            name2, seq2, qual2 = trim(record2, index2, stats2)
+            with1 += name1 is not None
+            with2 += name2 is not None
+
+            if len(seq1) < min_length or len(seq2) < min_length:
+                too_short += 1
+            elif name1 is None or name2 is None:
+                untrimmed += 1
+            else:
+                write_fastq(o1, record1, name1, seq1, qual1, sample)
+                write_fastq(o2, record2, name2, seq2, qual2, sample)
+                written += 1
+                bp_out1 += len(seq1)
+                bp_out2 += len(seq2)
+
+    report = {
+        'tag': 'Cutadapt report',
+        'schema_version': [0, 3],
+        'cutadapt_version': CUTADAPT_VERSION,
+        'demultiplexer': 'exact_demux.py',
+        'python_version': sys.version.split()[0],
+        'command_line_arguments': sys.argv[1:],
+        'cores': 1,
+        'input': {'path1': read1, 'path2': read2, 'paired': True},
+        'read_counts': {
+            'input': n_pairs,
+            'filtered': {'too_short': too_short, 'too_long': None, 'too_many_n': None, 'too_many_expected_errors': None,
+                         'casava_filtered': None, 'discard_trimmed': None, 'discard_untrimmed': untrimmed},
+            'output': written,
+            'reverse_complemented': None,
+            'read1_with_adapter': with1,
+            'read2_with_adapter': with2,
+        },
+        'basepair_counts': {
+            'input': bp_in1 + bp_in2, 'input_read1': bp_in1, 'input_read2': bp_in2,
+            'quality_trimmed': None, 'quality_trimmed_read1': None, 'quality_trimmed_read2': None,
+            'poly_a_trimmed': None, 'poly_a_trimmed_read1': None, 'poly_a_trimmed_read2': None,
+            'output': bp_out1 + bp_out2, 'output_read1': bp_out1, 'output_read2': bp_out2,
+        },
+        'adapters_read1': stats1.report(n_pairs),
+        'adapters_read2': stats2.report(n_pairs),
+        'poly_a_trimmed_read1': None,
+        'poly_a_trimmed_read2': None,
+    }
+    if json_file:
+        with open(json_file, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    return report
+
+
+if __name__ == "__main__":
+
+    args = parse_argument()
+
+    report = demultiplex(args.read1, args.read2,
+                         f'{args.out_dir}/{args.sample}.trimmed.1.fastq', f'{args.out_dir}/{args.sample}.trimmed.2.fastq',
+                         args.oligo_file, args.sample, args.min_length, args.mode.lower() == 'true',
+                         f'{args.out_dir}/{args.sample}.cutadapt.json')
+
+    counts = report['read_counts']
+    print (f"{counts['input']} read pairs processed, {counts['output']} written " \
+           f"({counts['filtered']['too_short']} too short, {counts['filtered']['discard_untrimmed']} untrimmed)")
@@ -1,25 +1,57 @@
 #!/usr/bin/env python3
 
-import pandas as pd
-import datetime
 import argparse
+import resource
 import os, sys
+from collections import Counter
+from itertools import islice
+import count_table_io
+import compressed_io
+import utilities
 
 '''
 This script will generat a mothur_equivalent full format count_table file.
 The only difference is that it does have the 2nd column (total) of mothur's count table, and the name of
 the first columns is 'seq' instead of 'Representative_Sequence'
+
+The counts come either from the vsearch --search_exact match file (-m), or (-q) straight from the
+quality-filtered reads: as the match is exact, it's a hash join of every read sequence with the final unique
+seqs (-f), which replaces the search_exact step and its (huge) match file.
 '''
 
+#the shortest sequence vsearch searches with (--minseqlength default of the search commands)
+MIN_SEQ_LENGTH = 32
+
+#number of match file lines read (and folded into the running counts) at a time
+DEFAULT_CHUNK_SIZE = 500000
+
 def parse_argument():
     # note
     # the script can be run as: python3 make_count_table.py -o fina.count_table -m output.match.final.txt 
+    # and/or with -b final.count_table.npz for the binary count table
     #
     parser = argparse.ArgumentParser(prog = 'make_count_table.py')
-    parser.add_argument('-o', '--output_file', metavar = '', required = True, help = 'Specify output file name')
-    parser.add_argument('-m', '--match_file', metavar = '', required = True, help = 'Specify the matched file')
+    parser.add_argument('-o', '--output_file', metavar = '', help = 'Specify output (mothur_equivalent text count_table) file name')
+    parser.add_argument('-b', '--binary_output', metavar = '', help = 'Specify output binary (.npz) count table file name')
+    parser.add_argument('-m', '--match_file', metavar = '', help = 'Specify the matched file')
+    parser.add_argument('-q', '--query_fasta', metavar = '', help = 'Specify the (quality-filtered) reads fasta file, '
+                        'to count the exact matches of its reads to the unique seqs (-f) instead of reading a matched file')
+    parser.add_argument('-f', '--fasta_file', metavar = '', help = 'Specify the fasta file of the unique seqs, '
+                        'to save their sequences in the binary count table (optional, required with -q)')
+    parser.add_argument('-k', '--chunk_size', '--chunk-size', metavar = '', type = int, default = DEFAULT_CHUNK_SIZE,
+                        help = f'Specify number of match file lines read at a time (default: {DEFAULT_CHUNK_SIZE})')
+
+    args = parser.parse_args()
+    if not args.output_file and not args.binary_output:
+        parser.error('at least one of -o/--output_file and -b/--binary_output is required')
+    if bool(args.match_file) == bool(args.query_fasta):
+        parser.error('exactly one of -m/--match_file and -q/--query_fasta is required')
+    if args.query_fasta and not args.fasta_file:
+        parser.error('-f/--fasta_file is required with -q/--query_fasta')
+    if args.chunk_size < 1:
+        parser.error('-k/--chunk_size must be at least 1')
 
-    return parser.parse_args()
+    return args
 
 
 def get_sample_primer(row):
@@ -28,95 +60,274 @@ def get_sample_primer(row):
     primer = row.split(sep)[1]
 
     return f"{sample}.{primer}"
-    
-def main():
-    
-    args = parse_argument()
-    
-    # file_dir = '/scicomp/home-pure/qtl7/test/hmas_test/024_demulx_data/output'
-    # file_dir = args.output_dir
-    # matched_file = 'output.match.final.txt'
-    matched_file = args.match_file
-    output_file = args.output_file
-    #fasta_file = 'output.fasta'
-    
-    if os.path.getsize(matched_file) <= 0:
-        print (f"{matched_file} is empty" \
-            	", indicating the raw reads are most likely bad" \
-                 ", and all generated seqs has abundance less than 10")
-        sys.exit()
 
-    # df = pd.read_csv(f'{file_dir}/{matched_file}', sep='\t', names = ['target', 'query'])
-    df = pd.read_csv(f'{matched_file}', sep='\t', names = ['target', 'query'])
-    total_seqs = df['query'].to_list()
-    unique_seqs = list(set(df['target'].to_list()))
 
-    df['query'] = df.groupby(['target'])['query'].transform(lambda x: ','.join(x))
-    # print (df.head())
-    # print (df.shape)
+class SparseCountTable:
+    '''
+    Running read counts of each unique representative seq (target) per sample.primer pair.
+    The =primer=sample tag of each query is decoded only once into an integer code, and the counts
+    are kept in a sparse structure (one dictionary of {sample.primer code: count} per target), so
+    the memory depends on the number of unique targets, not on the number of reads
+    '''
+
+    def __init__(self):
+        self.target_codes = {} # key: target (unique seq); value: its row index
+        self.tag_codes = {}    # key: =primer=sample tag of the query; value: its sample.primer code
+        self.sp_codes = {}     # key: sample.primer; value: its code
+        self.sp_parts = []     # (sample, primer) of each sample.primer code
+        self.counts = []       # one sparse dictionary per target
+
+    def fold(self, lines):
+        '''
+        fold a chunk of match file lines (target<tab>query) into the running counts
+        '''
+        #collapse the chunk into (target, tag) pairs first, so each distinct pair is decoded once
+        pairs = Counter()
+        for line in lines:
+            target, query = line.rstrip('\n').split('\t')
+            pairs[target, query[query.find('='):]] += 1
+
+        self.fold_pairs(pairs)
+
+    def fold_pairs(self, pairs):
+        '''
+        fold a Counter of (target, =primer=sample tag) pairs into the running counts
+        '''
+        for (target, tag), count in pairs.items():
+            sp = self.tag_codes.get(tag)
+            if sp is None:
+                label = get_sample_primer(tag)
+                sp = self.sp_codes.get(label)
+                if sp is None:
+                    sp = self.sp_codes[label] = len(self.sp_parts)
+                    self.sp_parts.append((tag.split('=')[2], tag.split('=')[1]))
+                self.tag_codes[tag] = sp
+
+            row = self.target_codes.get(target)
+            if row is None:
+                row = self.target_codes[target] = len(self.counts)
+                self.counts.append({})
+            row_counts = self.counts[row]
+            row_counts[sp] = row_counts.get(sp, 0) + count
+
+    @property
+    def targets(self):
+        return list(self.target_codes)
+
+    @property
+    def sps(self):
+        return list(self.sp_codes)
+
+    def to_csr(self):
+        '''
+        convert the running counts into the compressed sparse row (CSR) format, with the columns
+        (sample.primer pairs) sorted by name, as in the count_table file
+
+        Returns: tuple of (list of column codes in sorted order, indptr, indices, data)
+        '''
+        sps = self.sps
+        order = sorted(range(len(sps)), key=sps.__getitem__)
+        column = {sp: col for col, sp in enumerate(order)}
+
+        indptr, indices, data = [0], [], []
+        for row_counts in self.counts:
+            for col, count in sorted((column[sp], count) for sp, count in row_counts.items()):
+                indices.append(col)
+                data.append(count)
+            indptr.append(len(indices))
 
-    #dictionary (key: unique representative seqs; value: list of its represented seqs)
-    seq_seq_dict = dict(df.values)
-    # print (len(seq_seq_dict))
-    # for key in list(seq_seq_dict.keys())[:2]:
-    #     print (seq_seq_dict[key])
+        return order, indptr, indices, data
 
-    #dictionary (key: unique representative seqs; value: list of the sample.primer pairs of its represented seqs)
-    seq_sp_dict = {key:[get_sample_primer(seq) for seq in seq_seq_dict[key].split(',')] for key in seq_seq_dict}
-    # print (len(seq_sp_dict))
-    # for key in list(seq_sp_dict.keys())[:2]:
-    #     print (seq_sp_dict[key])
 
-    # seq_sp_dict.values()
-    # def get_set_union(set_list):
-    #     return set.union(*set_list)
+def read_chunks(matched_file, chunk_size):
+    '''
+    this method streams the vsearch match file in chunks of (at most) chunk_size lines
 
-    #list of sets (of sample-primer for each unique seqs)
-    sp_sets = [set(item) for item in seq_sp_dict.values()]
-    # print (len(sp_sets))
-    # for ss in sp_sets[:2]:
-    #     print (ss)
+    Parameters
+    ----------
+    matched_file: String name of the vsearch match file
+    chunk_size: int, number of lines per chunk
 
-    #this is the total sample-primer pairs in the count_table
-    sps = list(set.union(*sp_sets))
-    sps.sort()
-    # print (len(sps))
+    Returns: generator of lists of lines
+    ----------
+    '''
+    with compressed_io.open_file(matched_file) as f:
+        while True:
+            chunk = list(islice(f, chunk_size))
+            if not chunk:
+                break
+            yield chunk
 
 
-    # print (f"before start...{datetime.datetime.now()}")
-    #making the rows of the count_table, which is a dictionary of:
-    #key: unique seqs; value: list of counts for each sample-primer pair
-    occurrence = {seq: [seq_sp_dict[seq].count(sp) for sp in sps] 
-                for seq in unique_seqs}
+def count_matches(matched_file, chunk_size=DEFAULT_CHUNK_SIZE):
+    '''
+    this method reads the vsearch match file (target<tab>query per line) in fixed-size chunks and 
+    folds each chunk into the running counts of each unique representative seq per sample.primer pair
 
-    # print (len(occurrence))
-    # print (unique_seqs[:20])
-    # print (occurrence.keys())
-    # for key in list(occurrence.keys())[:20]:
-    #     print (key, occurrence[key])
+    Parameters
+    ----------
+    matched_file: String name of the vsearch match file
+    chunk_size: int, number of lines read per chunk (trade speed against RAM)
 
-    df = pd.DataFrame.from_dict(occurrence, orient='index')
-    df.columns = sps
+    Returns: SparseCountTable
+    ----------
+    '''
+    table = SparseCountTable()
+    for chunk in read_chunks(matched_file, chunk_size):
+        table.fold(chunk)
 
+    return table
 
 
+def count_exact(query_fasta, unique_fasta, chunk_size=DEFAULT_CHUNK_SIZE):
+    '''
+    this method counts the reads of the query fasta file which exactly match a unique representative seq,
+    per sample.primer pair (a hash join on the sequence, the same as vsearch --search_exact), 
+    the reads are folded into the running counts in chunks of chunk_size reads
 
-    # df = pd.read_pickle(f"{file_dir}/024_not_mothur_count_table.pkl")
+    Parameters
+    ----------
+    query_fasta: String name of the (quality-filtered) reads fasta file
+    unique_fasta: String name of the fasta file of the unique representative seqs
+    chunk_size: int, number of reads per chunk
 
+    Returns: SparseCountTable
+    ----------
+    '''
+    #key: sequence; value: label of its unique representative seq (the first one, if a sequence repeats)
+    targets = {}
+    for header, seq in utilities.iter_fasta(unique_fasta):
+        seq = seq.upper()
+        if len(seq) >= MIN_SEQ_LENGTH and header.strip():
+            targets.setdefault(seq, header.split()[0])
 
-    df.reset_index(inplace=True)
-    df.rename(columns={'index':'seq'}, inplace=True)
-    df['seq'] = df['seq'].apply(str)
+    table = SparseCountTable()
+    reads = iter(utilities.iter_fasta(query_fasta))
+    while True:
+        chunk = list(islice(reads, chunk_size))
+        if not chunk:
+            break
+        pairs = Counter()
+        for header, seq in chunk:
+            target = targets.get(seq.upper())
+            if target is not None and header.strip():
+                query = header.split()[0]
+                pairs[target, query[query.find('='):]] += 1
+        table.fold_pairs(pairs)
 
-    # print (df.head().iloc[:5,:5])
+    return table
 
 
-    # print (df.shape)
-    # print (f"after done... {datetime.datetime.now()}")
+def write_count_table(output_file, table):
+    '''
+    this method writes the sparse counts into a mothur_equivalent full format count_table file
+
+    Parameters
+    ----------
+    output_file: String name of the output count_table file
+    table: SparseCountTable
+
+    Returns: None
+    ----------
+    '''
+    order, indptr, indices, data = table.to_csr()
+    #this is the total sample-primer pairs in the count_table (sorted)
+    sps = table.sps
+    sorted_sps = [sps[sp] for sp in order]
+
+    with open(output_file, 'w') as f:
+        f.write('\t'.join(['seq'] + sorted_sps) + '\n')
+        for ind, target in enumerate(table.target_codes):
+            row = [0] * len(sorted_sps)
+            for pos in range(indptr[ind], indptr[ind + 1]):
+                row[indices[pos]] = data[pos]
+            f.write(f"{target}\t" + '\t'.join(map(str, row)) + '\n')
+
+
+def write_count_npz(output_file, table, fasta_file=None):
+    '''
+    this method writes the sparse counts into a compact columnar (binary .npz) count table,
+    check count_table_io.py for the format.
+    If the fasta file of the unique representative seqs is given, their actual sequences are saved
+    as well, and the rows are sorted by sequence (so the count tables of all the samples can be 
+    merged in a single pass, check combine_count_tables.py)
+
+    Parameters
+    ----------
+    output_file: String name of the output .npz file
+    table: SparseCountTable
+    fasta_file: String name of the fasta file of the unique representative seqs, optional (ValueError if
+                a unique seq of the table is not in it)
+
+    Returns: None
+    ----------
+    '''
+    order, indptr, indices, data = table.to_csr()
+    sps = table.sps
+    targets = table.targets
+    sequences = None
+
+    if fasta_file:
+        seq_dict = {header.split()[0]: seq.upper() for header, seq in utilities.iter_fasta(fasta_file)}
+        missing = [target for target in targets if target not in seq_dict]
+        if missing:
+            # an empty sequence would merge unrelated rows of the samples into one (check combine_count_tables.py)
+            raise ValueError(f'{len(missing)} unique seqs of the count table are not in {fasta_file}, e.g. {missing[0]}')
+        sequences = [seq_dict[target] for target in targets]
+        rows = sorted(range(len(targets)), key=lambda row: (sequences[row], targets[row]))
+
+        targets = [targets[row] for row in rows]
+        sequences = [sequences[row] for row in rows]
+        sorted_indptr, sorted_indices, sorted_data = [0], [], []
+        for row in rows:
+            sorted_indices.extend(indices[indptr[row]:indptr[row + 1]])
+            sorted_data.extend(data[indptr[row]:indptr[row + 1]])
+            sorted_indptr.append(len(sorted_indices))
+        indptr, indices, data = sorted_indptr, sorted_indices, sorted_data
+
+    count_table_io.save_count_npz(output_file, targets,
+                                  [sps[sp] for sp in order],
+                                  [table.sp_parts[sp][0] for sp in order],
+                                  [table.sp_parts[sp][1] for sp in order],
+                                  indptr, indices, data, sequences)
+
+
+def peak_memory():
+    '''
+    Returns the peak resident memory (in MB) of the current process
+    '''
+    # ru_maxrss is in kilobytes on Linux, but in bytes on macOS
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss / 1024 / 1024 if sys.platform == 'darwin' else maxrss / 1024
+
+
+def main():
+    
+    args = parse_argument()
+    
+    matched_file = args.match_file or args.query_fasta
+    output_file = args.output_file
+    
+    if os.path.getsize(matched_file) <= 0:
+        print (f"{matched_file} is empty" \
+            	", indicating the raw reads are most likely bad" \
+                 ", and all generated seqs has abundance less than 10")
+        sys.exit()
+
+    if args.query_fasta:
+        table = count_exact(args.query_fasta, args.fasta_file, args.chunk_size)
+        if not table.counts:
+            print (f"no read of {args.query_fasta} matches the unique seqs of {args.fasta_file}")
+            sys.exit()
+    else:
+        table = count_matches(matched_file, args.chunk_size)
+    if output_file:
+        write_count_table(output_file, table)
+    if args.binary_output:
+        write_count_npz(args.binary_output, table, args.fasta_file)
 
-    # pd.to_pickle(df, f"{file_dir}/024_not_mothur_count_table_2.pkl") 
-    # pd.to_pickle(df, f"{output_file}.pkl") 
-    df.to_csv(f"{output_file}", index=False, sep='\t')
+    print (f"{len(table.counts)} unique seqs across {len(table.sp_codes)} sample.primer pairs, " \
+           f"peak memory: {peak_memory():.1f} MB")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+
+import argparse
+import csv
+import json
+import os
+import parse_pear_log
+import parse_qfilter_log
+import parse_derep_log
+
+'''
+This script (and module) collects the per-sample counters of the pipeline stages (pear, qfilter, dereplication
+and denoise) as structured records, one json object per line (json lines) like:
+{"sample": "S1", "stage": "pear", "metrics": {"Assembled reads": 29907, "Discarded reads": 0, "Un-assembled reads": 12}}
+
+The python stages (quality_filter.py, stream_merge_filter.py, postmerge.py and pool_denoise.py) append their
+records themselves. The logs of the other ones (pear and vsearch, named {sample}_{stage}.log) are parsed by
+combine_metrics.py directly, which turns all the records of a run into the MultiQC tables in a single pass,
+so no script is run per sample for them. This script makes the record of a sample from a stage log, or from
+the reads before/after the (vsearch) denoising, and appends it to a metrics file (and optionally writes the
+legacy per-sample log csv file).
+'''
+
+SAMPLE_COLUMN = 'Sample name'
+
+# the columns of each stage (the same as the per-sample log csv files and the MultiQC tables)
+STAGES = {
+    'pear': ['Assembled reads', 'Discarded reads', 'Un-assembled reads'],
+    'qfilter': ['Total reads', 'Discarded reads'],
+    'dereplication': ['Total Sequencess', 'Unique Sequences'],
+    'denoise': [' Total Reads', ' Removed Reads'],
+}
+
+LOG_PARSERS = {
+    'pear': parse_pear_log.parse_input,
+    'qfilter': parse_qfilter_log.parse_input,
+    'dereplication': parse_derep_log.parse_input,
+}
+
+
+def parse_argument():
+
+    parser = argparse.ArgumentParser(prog = 'metrics.py')
+    parser.add_argument('-s', '--sample', metavar = '', required = True, help = 'Specify sample name')
+    parser.add_argument('-k', '--stage', metavar = '', required = True, choices = list(STAGES),
+                        help = f'Specify the stage ({", ".join(STAGES)})')
+    parser.add_argument('-o', '--output', metavar = '', required = True, help = 'Specify output metrics (json lines) file, '
+                        'the record is appended to it')
+    parser.add_argument('-p', '--log', metavar = '', help = 'Specify the log file of the stage (pear, qfilter and dereplication)')
+    parser.add_argument('-b', '--before', metavar = '', help = 'Specify the input (dereplicated) fasta file of the denoising')
+    parser.add_argument('-a', '--after', metavar = '', help = 'Specify the final unique fasta file of the denoising')
+    parser.add_argument('-c', '--csv', metavar = '', help = 'Specify output per-sample log csv file (optional)')
+
+    args = parser.parse_args()
+    if args.stage in LOG_PARSERS and not args.log:
+        parser.error(f'-p/--log is required for the {args.stage} stage')
+    if args.stage == 'denoise' and not (args.before and args.after):
+        parser.error('-b/--before and -a/--after are required for the denoise stage')
+    return args
+
+
+def make_record(sample, stage, values):
+    '''
+    Returns the metrics record (dictionary) of a sample at a stage, from the values of the stage's columns
+    (the counts parsed from a log are stored as numbers)
+    '''
+    values = [int(value) if str(value).isdigit() else value for value in values]
+    return {'sample': sample, 'stage': stage, 'metrics': dict(zip(STAGES[stage], values))}
+
+
+def parse_log(log_file, sample=None, stage=None):
+    '''
+    this method parses a stage log (pear, qfilter or dereplication) into a metrics record, the sample and
+    the stage are taken from the log file name ({sample}_{stage}.log) unless they are given
+
+    Returns: dictionary of the record
+    '''
+    name = os.path.basename(log_file)
+    if stage is None:
+        stage = next((key for key in LOG_PARSERS if name.endswith(f'_{key}.log')), None)
+        if stage is None:
+            raise ValueError(f'{log_file}: not a {{sample}}_{{stage}}.log file of {", ".join(LOG_PARSERS)}')
+    if sample is None:
+        sample = name[:-len(f'_{stage}.log')]
+    with open(log_file, 'r') as f:
+        return make_record(sample, stage, LOG_PARSERS[stage](f.read()))
+
+
+def write_records(metrics_file, records):
+    '''
+    this method appends the records to a metrics (json lines) file
+    '''
+    with open(metrics_file, 'a') as f:
+        for record in records:
+            f.write(json.dumps(record) + '\n')
+
+
+def read_records(metrics_file):
+    '''
+    Returns a generator of the records of a metrics (json lines) file
+    '''
+    with open(metrics_file, 'r') as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def write_csv(record, csv_file):
+    '''
+    this method writes a record into a per-sample log csv file (the same as the parse_*_log.py scripts)
+    '''
+    with open(csv_file, 'w', newline='') as f:
+        writer = csv.writer(f, lineterminator='\n')
+        writer.writerow([SAMPLE_COLUMN] + STAGES[record['stage']])
+        writer.writerow([record['sample']] + [record['metrics'][column] for column in STAGES[record['stage']]])
+
+
+def count_reads(fasta_file):
+    '''
+    Returns the number of records of a fasta file, None if it's empty or missing
+    '''
+    if not os.path.exists(fasta_file) or os.path.getsize(fasta_file) == 0:
+        return None
+    with open(fasta_file, 'r') as f:
+        return sum(1 for line in f if '>' in line)
+
+
+def denoise_values(before_fasta, after_fasta):
+    '''
+    Returns the [total, removed] unique reads of the denoising (n/a if its input is empty)
+    '''
+    before = count_reads(before_fasta)
+    if before is None:
+        return ['n/a', 'n/a']
+    return [before, before - (count_reads(after_fasta) or 0)]
+
+
+if __name__ == "__main__":
+
+    args = parse_argument()
+
+    if args.stage == 'denoise':
+        record = make_record(args.sample, args.stage, denoise_values(args.before, args.after))
+    else:
+        record = parse_log(args.log, args.sample, args.stage)
+    write_records(args.output, [record])
+    if args.csv:
+        write_csv(record, args.csv)
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+
+import json
+import math
+import yaml
+
+'''
+This module writes the MultiQC custom content files (tables) of our reports.
+
+The data rows are streamed out one at a time (no nested dictionary of the whole table is built):
+- for a *_mqc.json file, each row is serialised with the (C accelerated) json module
+- for a *_mqc.yaml file, each row is serialised with the libyaml (C) dumper when it is available
+Both make the same MultiQC section.
+'''
+
+# the libyaml based dumper is much faster than the pure python one
+YAML_DUMPER = getattr(yaml, 'CDumper', yaml.Dumper)
+
+
+def _native(value):
+    '''
+    Returns the value as a native python type (numpy scalars are converted)
+    '''
+    return value.item() if hasattr(value, 'item') else value
+
+
+def _iter_rows(data_df):
+    '''
+    Returns a generator of (row name, {column: value}) tuples of the DataFrame
+    '''
+    columns = [_native(col) for col in data_df.columns]
+    for index, row in zip(data_df.index, data_df.itertuples(index=False, name=None)):
+        yield _native(index), {col: _native(value) for col, value in zip(columns, row)}
+
+
+def _json_value(value):
+    '''
+    NaN is not valid JSON, write it as null
+    '''
+    return None if isinstance(value, float) and math.isnan(value) else value
+
+
+def _write_json(f, section, data_df):
+    f.write('{\n')
+    for key, value in section.items():
+        f.write(f'  {json.dumps(key)}: {json.dumps(value)},\n')
+    f.write('  "data": {')
+    for ind, (index, row) in enumerate(_iter_rows(data_df)):
+        row = {col: _json_value(value) for col, value in row.items()}
+        f.write(f'{"," if ind else ""}\n    {json.dumps(str(index))}: {json.dumps(row)}')
+    f.write('\n  }\n}\n')
+
+
+def _write_yaml(f, section, data_df):
+    yaml.dump(section, f, Dumper=YAML_DUMPER, sort_keys=False)
+    if data_df.empty:
+        f.write('data: {}\n')
+        return
+
+    f.write('data:\n')
+    for index, row in _iter_rows(data_df):
+        text = yaml.dump({index: row}, Dumper=YAML_DUMPER, sort_keys=False)
+        f.write(''.join(f'  {line}\n' for line in text.splitlines()))
+
+
+def write_custom_content(output_file, section, data_df):
+    '''
+    this method writes a MultiQC custom content file, in JSON or YAML format based on the file extension
+
+    Parameters
+    ----------
+    output_file: String, output file name (*_mqc.json or *_mqc.yaml)
+    section: dictionary of the section config (id, section_name, description, plot_type, pconfig, headers, ...)
+    data_df: DataFrame, the data part of the file (one row per table row)
+
+    Returns: None
+    ----------
+    '''
+    with open(output_file, 'w') as f:
+        if output_file.endswith('.json'):
+            _write_json(f, section, data_df)
+        else:
+            _write_yaml(f, section, data_df)
@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+
+import argparse
+import os
+import csv
+import zlib
+import numpy as np
+from collections import OrderedDict
+import utilities
+import compressed_io
+
+'''
+This script splits a (dereplicated) fasta file of one sample into one fasta file per primer, in a single pass.
+
+The reads are labelled as seq_id=primer=sample(;size=N), so each record is routed to its primer's partition
+by an exact lookup of the primer tag (a primer name never matches another one, i.e. OG0000348primerGroup1
+vs OG0000348primerGroup10). The records keep the order of the input file within each partition.
+
+At most max_open partition files are kept open at a time (the least recently used one is closed first),
+and a tsv file of the records and the abundance (sum of size=) of each primer is written as a by-product,
+in the order of the primers in the oligo file.
+
+Optionally (-d), the depth of the over-represented primers is capped: the reads of a primer whose abundance
+is above max_depth are downsampled (without replacement, seeded) to max_depth reads, by a multivariate
+hypergeometric draw over the size= of its records. The records left with no reads are dropped, and both
+the raw and the capped counts are written to the tsv file.
+'''
+
+DEFAULT_MAX_OPEN = 64
+
+
+def parse_argument():
+
+    parser = argparse.ArgumentParser(prog = 'partition_primers.py')
+    parser.add_argument('-i', '--input', metavar = '', required = True, help = 'Specify input fasta file')
+    parser.add_argument('-p', '--primers', metavar = '', required = True, help = 'Specify oligos/(primer) file')
+    parser.add_argument('-o', '--outdir', metavar = '', required = True, help = 'Specify output folder of the partitions ({primer}.fasta)')
+    parser.add_argument('-c', '--counts', metavar = '', required = True, help = 'Specify output per-primer counts (tsv) file')
+    parser.add_argument('-d', '--max_depth', metavar = '', type = int, default = 0,
+                        help = 'Specify the max abundance (reads) of a primer, the deeper primers are downsampled (default: 0, no cap)')
+    parser.add_argument('-e', '--seed', metavar = '', type = int, default = 0, help = 'Specify the seed of the downsampling (default: 0)')
+    parser.add_argument('-n', '--max_open', metavar = '', type = int, default = DEFAULT_MAX_OPEN,
+                        help = f'Specify the max number of partition files open at a time (default: {DEFAULT_MAX_OPEN})')
+    return parser.parse_args()
+
+
+def primer_tag(header):
+    '''
+    Returns the primer of a read label like seq_id=primer=sample;size=N (None if it has no primer tag)
+    '''
+    fields = header.split('=', 2)
+    return fields[1] if len(fields) > 2 else None
+
+
+def abundance(header):
+    '''
+    Returns the abundance (size=) of a read label, 1 if it has no size annotation
+    '''
+    for field in header.rstrip().split(';'):
+        if field.startswith('size=') and field[5:].isdigit():
+            return int(field[5:])
+    return 1
+
+
+def set_abundance(header, size):
+    '''
+    Returns the read label (a header line) with its abundance (size=) set to the given size
+    '''
+    label = header.rstrip('\r\n')
+    fields = label.split(';')
+    for ind, field in enumerate(fields):
+        if field.startswith('size=') and field[5:].isdigit():
+            fields[ind] = f'size={size}'
+            return ';'.join(fields) + header[len(label):]
+    return f'{label.rstrip(";")};size={size}' + header[len(label):]
+
+
+class PartitionWriters:
+    'Bounded pool of the open partition files, the least recently used one is closed first'
+
+    def __init__(self, outdir, max_open=DEFAULT_MAX_OPEN):
+        self.outdir = outdir
+        self.max_open = max(1, max_open)
+        self.handles = OrderedDict()
+        self.created = set()
+
+    def path(self, primer):
+        return os.path.join(self.outdir, f'{primer}.fasta')
+
+    def get(self, primer):
+        if primer in self.handles:
+            self.handles.move_to_end(primer)
+            return self.handles[primer]
+
+        if len(self.handles) >= self.max_open:
+            _, handle = self.handles.popitem(last=False)
+            handle.close()
+
+        # truncate the partition when it's first opened, append to it when it's reopened
+        handle = open(self.path(primer), 'a' if primer in self.created else 'w')
+        self.created.add(primer)
+        self.handles[primer] = handle
+        return handle
+
+    def close(self):
+        for handle in self.handles.values():
+            handle.close()
+        self.handles.clear()
+
+
+def partition(fasta_file, pnames, outdir, max_open=DEFAULT_MAX_OPEN):
+    '''
+    this method routes every record of the fasta file to its primer's partition file
+
+    Parameters
+    ----------
+    fasta_file: String name of the input fasta file
+    pnames: list of the primer names (in the order of the oligo file)
+    outdir: String name of the output folder
+    max_open: int, max number of partition files open at a time
+
+    Returns: tuple of (dictionary of primer: [# of records, abundance], # of records without a known primer)
+    ----------
+    '''
+    counts = {primer: [0, 0] for primer in pnames}
+    unassigned = 0
+    writers = PartitionWriters(outdir, max_open)
+    handle = None
+    try:
+        with compressed_io.open_file(fasta_file) as f:
+            for line in f:
+                if line.startswith('>'):
+                    primer = primer_tag(line[1:])
+                    if primer in counts:
+                        handle = writers.get(primer)
+                        counts[primer][0] += 1
+                        counts[primer][1] += abundance(line[1:])
+                    else:
+                        handle = None
+                        unassigned += 1
+                if handle is not None:
+                    handle.write(line)
+    finally:
+        writers.close()
+
+    return counts, unassigned
+
+
+def cap_partition(partition_file, max_depth, rng):
+    '''
+    this method downsamples the reads of a primer partition to max_depth reads (without replacement),
+    and rewrites the partition file with the new size= of the records (the records with no reads are dropped)
+
+    Parameters
+    ----------
+    partition_file: String name of the partition fasta file
+    max_depth: int, the number of reads to keep
+    rng: numpy random Generator
+
+    Returns: tuple of (# of records, abundance) after the capping
+    ----------
+    '''
+    records = []
+    with open(partition_file, 'r') as f:
+        for line in f:
+            if line.startswith('>'):
+                records.append([line])
+            elif records:
+                records[-1].append(line)
+
+    sizes = np.array([abundance(record[0][1:]) for record in records], dtype=np.int64)
+    capped = rng.multivariate_hypergeometric(sizes, max_depth)
+
+    with open(partition_file, 'w') as f:
+        for record, size in zip(records, capped.tolist()):
+            if size:
+                f.write(set_abundance(record[0], size))
+                f.writelines(record[1:])
+
+    return int(np.count_nonzero(capped)), int(capped.sum())
+
+
+def cap_depth(outdir, counts, max_depth, seed=0):
+    '''
+    this method caps the depth (abundance) of every primer partition above max_depth
+
+    Parameters
+    ----------
+    outdir: String name of the folder of the partitions
+    counts: dictionary of primer: [# of records, abundance], as returned by partition()
+    max_depth: int, max abundance of a primer (0: no cap)
+    seed: int, seed of the downsampling (each primer has its own random stream, derived from the seed 
+          and the primer name, so the result doesn't depend on the order the primers are processed)
+
+    Returns: dictionary of primer: (# of records, abundance) after the capping
+    ----------
+    '''
+    capped = {}
+    for primer, (records, total) in counts.items():
+        if max_depth > 0 and total > max_depth:
+            rng = np.random.default_rng([seed, zlib.crc32(primer.encode())])
+            capped[primer] = cap_partition(os.path.join(outdir, f'{primer}.fasta'), max_depth, rng)
+        else:
+            capped[primer] = (records, total)
+    return capped
+
+
+def write_counts(counts_file, counts, capped=None):
+    '''
+    this method writes the raw (and the capped, if given) record and abundance counts of each primer
+    '''
+    with open(counts_file, 'w', newline='') as f:
+        writer = csv.writer(f, delimiter='\t', lineterminator='\n')
+        writer.writerow(['primer', 'records', 'abundance'] + (['capped_records', 'capped_abundance'] if capped else []))
+        for primer, (records, total) in counts.items():
+            writer.writerow([primer, records, total] + (list(capped[primer]) if capped else []))
+
+
+if __name__ == "__main__":
+
+    args = parse_argument()
+
+    os.makedirs(args.outdir, exist_ok=True)
+    pnames = list(utilities.Primers(args.primers).pnames)
+    counts, unassigned = partition(args.input, pnames, args.outdir, args.max_open)
+    capped = cap_depth(args.outdir, counts, args.max_depth, args.seed) if args.max_depth else None
+    write_counts(args.counts, counts, capped)
+
+    print (f"{sum(records for records, _ in counts.values())} records in " \
+           f"{sum(1 for records, _ in counts.values() if records)} primer partitions " \
+           f"({unassigned} records without a known primer)")
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+
+import argparse
+import os
+import hashlib
+import utilities
+import denoise_primers
+import metrics
+
+'''
+This script denoises the reads of all the samples of a run together, primer by primer (pooled denoising):
+1. the dereplicated reads of all the samples are pooled and dereplicated again (the abundance of a unique sequence
+   is the sum of its abundance in every sample), and labelled as {sha1 of the sequence}=primer=pooled;size=N
+2. the pooled reads are denoised once per primer (check denoise_primers.py), instead of once per (sample, primer)
+3. the (non-chimeric) centroids are mapped back to the samples: the final unique fasta of a sample has the centroids
+   found (as an exact sequence) in that sample, with the sample's own label and abundance, sorted by abundance
+
+So the amplicon sequence variants are the same across the run, and the per-sample outputs (final unique fasta
+and denoise log csv) are the same files the per-sample denoising makes.
+
+This script requires the dereplicated fasta files be listed in a manifest file, one 'fasta<tab>file name' per line,
+the file names are {sample}.unique.fasta
+'''
+
+FASTA_WIDTH = 80
+FASTA_SUFFIX = '.unique.fasta'
+
+
+def parse_argument():
+
+    parser = argparse.ArgumentParser(prog = 'pool_denoise.py')
+    parser.add_argument('-m', '--manifest', metavar = '', required = True, help = 'Specify a manifest file (tab delimited) listing the '
+                        'dereplicated fasta files, one per line as: fasta <tab> file name')
+    parser.add_argument('-p', '--primers', metavar = '', required = True, help = 'Specify oligos/(primer) file')
+    parser.add_argument('-n', '--minsize', metavar = '', required = True, help = 'Specify vsearch --minsize')
+    parser.add_argument('-a', '--alpha', metavar = '', required = True, help = 'Specify vsearch --unoise_alpha')
+    parser.add_argument('-t', '--threads', metavar = '', type = int, default = 1, help = 'Specify number of threads')
+    parser.add_argument('-c', '--chimera_per_primer', action = 'store_true', help = 'Remove the chimeras within each primer\'s centroids '
+                        '(instead of all the centroids at once)')
+    parser.add_argument('-s', '--small', metavar = '', type = int, default = denoise_primers.DEFAULT_SMALL,
+                        help = f'Specify the max number of unique reads (above minsize) of a partition to denoise '
+                        f'in process, 0 to always use vsearch (default: {denoise_primers.DEFAULT_SMALL})')
+    parser.add_argument('-d', '--max_depth', metavar = '', type = int, default = 0,
+                        help = 'Specify the max (pooled) abundance (reads) of a primer before the denoising (default: 0, no cap)')
+    parser.add_argument('-e', '--seed', metavar = '', type = int, default = 0, help = 'Specify the seed of the downsampling (default: 0)')
+    parser.add_argument('-j', '--metrics', metavar = '', help = 'Specify output metrics (json lines) file, '
+                        'the denoise records of the samples are appended to it (optional)')
+    parser.add_argument('-o', '--output', metavar = '', default = 'pooled', help = 'Specify the prefix of the pooled output files (default: pooled)')
+    return parser.parse_args()
+
+
+def sample_name(fasta_file):
+    name = os.path.basename(fasta_file)
+    return name[:-len(FASTA_SUFFIX)] if name.endswith(FASTA_SUFFIX) else os.path.splitext(name)[0]
+
+
+def pool_samples(fasta_files):
+    '''
+    this method reads the dereplicated fasta files of all the samples
+
+    Parameters
+    ----------
+    fasta_files: list of the dereplicated fasta files ({sample}.unique.fasta)
+
+    Returns: tuple of (dictionary of (primer, sequence): pooled abundance,
+                       dictionary of sample: {(primer, sequence): (header, abundance)},
+                       dictionary of sample: # of records, None if the fasta file is empty)
+    ----------
+    '''
+    pooled, samples, totals = {}, {}, {}
+    for fasta_file in fasta_files:
+        sample = sample_name(fasta_file)
+        records = samples.setdefault(sample, {})
+        if os.path.getsize(fasta_file) == 0:
+            totals[sample] = None
+            continue
+
+        totals[sample] = 0
+        for header, seq in utilities.iter_fasta(fasta_file):
+            totals[sample] += 1
+            primer = denoise_primers.partition_primers.primer_tag(header)
+            if primer is None:
+                continue
+            size = denoise_primers.partition_primers.abundance(header)
+            key = (primer, seq.upper())
+            records[key] = (header, size)
+            pooled[key] = pooled.get(key, 0) + size
+
+    return pooled, samples, totals
+
+
+def write_record(f, header, seq):
+    f.write(f'>{header}\n')
+    for start in range(0, len(seq), FASTA_WIDTH):
+        f.write(f'{seq[start:start + FASTA_WIDTH]}\n')
+
+
+def write_pooled_fasta(pooled_file, pooled):
+    '''
+    this method writes the pooled unique reads, sorted by decreasing abundance (then by label)
+    '''
+    labelled = [(-size, f'{hashlib.sha1(seq.encode()).hexdigest()}={primer}=pooled;size={size}', seq)
+                for (primer, seq), size in pooled.items()]
+    with open(pooled_file, 'w') as f:
+        for _, header, seq in sorted(labelled):
+            write_record(f, header, seq)
+
+
+def map_back(centroids_file, samples, totals, metrics_file=None):
+    '''
+    this method writes the final unique fasta file and the denoise log csv file of every sample,
+    from the pooled centroids
+
+    Parameters
+    ----------
+    centroids_file: String name of the pooled (non-chimeric) centroids fasta file (None if there are none)
+    samples: dictionary of sample: {(primer, sequence): (header, abundance)}, as returned by pool_samples()
+    totals: dictionary of sample: # of records, as returned by pool_samples()
+    metrics_file: String name of the metrics (json lines) file the denoise records are appended to (optional)
+    ----------
+    '''
+    centroids = []
+    if centroids_file and os.path.exists(centroids_file):
+        centroids = [(denoise_primers.partition_primers.primer_tag(header), seq.upper())
+                     for header, seq in utilities.iter_fasta(centroids_file)]
+
+    denoise_records = []
+    for sample, records in samples.items():
+        # the records in centroid order, then sorted by decreasing abundance (stable)
+        found = sorted(((*records[key], key[1]) for key in centroids if key in records), key=lambda record: -record[1])
+        if found:
+            with open(f'{sample}.final.unique.fasta', 'w') as f:
+                for header, _, seq in found:
+                    write_record(f, header, seq)
+
+        before = totals[sample]
+        record = metrics.make_record(sample, 'denoise', ['n/a', 'n/a'] if before is None else [before, before - len(found)])
+        metrics.write_csv(record, f'{sample}_denoise_log.csv')
+        denoise_records.append(record)
+
+    if metrics_file:
+        metrics.write_records(metrics_file, denoise_records)
+
+
+if __name__ == "__main__":
+
+    args = parse_argument()
+
+    fasta_files = utilities.read_manifest(args.manifest).get('fasta', [])
+    pooled, samples, totals = pool_samples(fasta_files)
+    print (f"{len(pooled)} pooled unique sequences from {len(samples)} samples")
+
+    pooled_file = f'{args.output}.unique.fasta'
+    centroids_file = f'{args.output}.unique.unoise.fasta'
+    final_file = f'{args.output}.final.unique.fasta'
+    write_pooled_fasta(pooled_file, pooled)
+
+    count, _ = denoise_primers.denoise(pooled_file, args.primers, centroids_file, args.minsize, args.alpha,
+                                       args.threads, final_file if args.chimera_per_primer else None,
+                                       f'{args.output}_denoise_primer_log.tsv', args.small,
+                                       args.max_depth, args.seed)
+    if count and not args.chimera_per_primer:
+        #remove potential chimeras (of all the primers at once)
+        denoise_primers.uchime3_denovo(centroids_file, final_file)
+
+    print (f"{count} pooled centroids")
+    map_back(final_file if count else None, samples, totals, args.metrics)
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+
+import argparse
+import os
+import subprocess
+import quality_filter
+import parse_qfilter_log
+import parse_derep_log
+import denoise_primers
+import make_count_table
+import create_report
+import utilities
+import metrics
+
+'''
+This script runs the whole post-merge chain of one sample in a single task (fused mode), instead of the
+quality_filtering -> dereplication -> denoising -> search_exact -> make_count_table processes:
+1. quality filtering of the merged reads (check quality_filter.py), skipped with -q if the input is already
+   the quality filtered fasta file (i.e. from the streaming mode)
+2. dereplication (vsearch --derep_fulllength)
+3. denoising primer by primer, and chimera removal (check denoise_primers.py)
+4. exact matching of the filtered reads to the final unique seqs: an in-process hash join with -j (check
+   make_count_table.py), otherwise vsearch --search_exact
+5. count table and reports (check make_count_table.py and create_report.py)
+
+Each step hands its output to the next one in the task folder, and the files (and log csv files) are named
+and made the same way as by the separate processes.
+'''
+
+
+def parse_argument():
+
+    parser = argparse.ArgumentParser(prog = 'postmerge.py')
+    parser.add_argument('-i', '--input', metavar = '', required = True, help = 'Specify input (merged reads) fastq file')
+    parser.add_argument('-s', '--sample', metavar = '', required = True, help = 'Specify sample name')
+    parser.add_argument('-p', '--primers', metavar = '', required = True, help = 'Specify oligos/(primer) file')
+    parser.add_argument('-q', '--filtered', action = 'store_true', help = 'The input is the quality filtered fasta file '
+                        '(skip the quality filtering)')
+    parser.add_argument('-z', '--compress', action = 'store_true', help = 'Write the filtered reads compressed ({sample}.fasta.gz)')
+    parser.add_argument('-m', '--minsize', metavar = '', required = True, help = 'Specify vsearch --minsize')
+    parser.add_argument('-a', '--alpha', metavar = '', required = True, help = 'Specify vsearch --unoise_alpha')
+    parser.add_argument('-t', '--threads', metavar = '', type = int, default = 1, help = 'Specify number of threads')
+    parser.add_argument('-c', '--chimera_per_primer', action = 'store_true', help = 'Remove the chimeras within each primer\'s centroids '
+                        '(instead of all the centroids at once)')
+    parser.add_argument('-w', '--small', metavar = '', type = int, default = denoise_primers.DEFAULT_SMALL,
+                        help = f'Specify the max number of unique reads (above minsize) of a partition to denoise '
+                        f'in process, 0 to always use vsearch (default: {denoise_primers.DEFAULT_SMALL})')
+    parser.add_argument('-d', '--max_depth', metavar = '', type = int, default = 0,
+                        help = 'Specify the max abundance (reads) of a primer before the denoising (default: 0, no cap)')
+    parser.add_argument('-e', '--seed', metavar = '', type = int, default = 0, help = 'Specify the seed of the downsampling (default: 0)')
+    parser.add_argument('-j', '--hash_join', action = 'store_true', help = 'Count the exact matches in process, '
+                        'instead of vsearch --search_exact')
+    parser.add_argument('-k', '--chunk_size', metavar = '', type = int, default = make_count_table.DEFAULT_CHUNK_SIZE,
+                        help = f'Specify number of reads/match file lines counted at a time (default: {make_count_table.DEFAULT_CHUNK_SIZE})')
+    parser.add_argument('-o', '--metrics', metavar = '', help = 'Specify output metrics (json lines) file, '
+                        'the qfilter, dereplication and denoise records are appended to it (optional)')
+    parser.add_argument('-x', '--export_count_table', action = 'store_true', help = 'Export the text count_table as well')
+    args = parser.parse_args()
+    if args.chunk_size < 1:
+        parser.error('-k/--chunk_size must be at least 1')
+    return args
+
+
+def filter_reads(sample, fastq_file, compress=False):
+    '''
+    step 1: quality filtering, into {sample}.fasta(.gz) and {sample}_qfilter_log.csv
+
+    Returns: tuple of (String name of the filtered reads fasta file, metrics record)
+    '''
+    fasta_file = f"{sample}.fasta{'.gz' if compress else ''}"
+    kept, discarded = quality_filter.quality_filter(fastq_file, fasta_file)
+    print (f"{kept} sequences kept (of which 0 truncated), {discarded} sequences discarded.")
+    parse_qfilter_log.write_to_csv(sample, [kept, discarded], f'{sample}_qfilter_log.csv')
+    return fasta_file, metrics.make_record(sample, 'qfilter', [kept, discarded])
+
+
+def dereplicate(sample, fasta_file):
+    '''
+    step 2: dereplication, into {sample}.unique.fasta and {sample}_dereplication_log.csv
+
+    Returns: tuple of (String name of the dereplicated fasta file, metrics record)
+    '''
+    unique_file = f'{sample}.unique.fasta'
+    subprocess.run(['vsearch', '--derep_fulllength', fasta_file, '--output', unique_file, '--sizeout',
+                    '--relabel_keep', '--log', f'{sample}_dereplication.log'], check=True)
+    with open(f'{sample}_dereplication.log', 'r') as f:
+        values = parse_derep_log.parse_input(f.read())
+    parse_derep_log.write_to_csv(sample, values, f'{sample}_dereplication_log.csv')
+    return unique_file, metrics.make_record(sample, 'dereplication', values)
+
+
+def denoise(sample, unique_file, args):
+    '''
+    step 3: denoising and chimera removal, into {sample}.final.unique.fasta, {sample}_denoise_primer_log.tsv
+    and {sample}_denoise_log.csv
+
+    Returns: tuple of (String name of the final unique fasta file, None if there are no final unique seqs,
+                       metrics record)
+    '''
+    unoise_file = f'{sample}.unique.unoise.fasta'
+    final_file = f'{sample}.final.unique.fasta'
+
+    if os.path.exists(unique_file) and os.path.getsize(unique_file) > 0:
+        count, final_count = denoise_primers.denoise(unique_file, args.primers, unoise_file, args.minsize, args.alpha,
+                                                     args.threads, final_file if args.chimera_per_primer else None,
+                                                     f'{sample}_denoise_primer_log.tsv', args.small,
+                                                     args.max_depth, args.seed)
+        for output, records in [(unoise_file, count), (final_file, final_count if args.chimera_per_primer else 0)]:
+            if not records and os.path.exists(output):
+                os.remove(output)
+        #remove potential chimeras (of all the primers at once)
+        if not args.chimera_per_primer and count:
+            denoise_primers.uchime3_denovo(unoise_file, final_file)
+
+    #the denoise log (n/a if there was nothing to denoise)
+    record = metrics.make_record(sample, 'denoise', metrics.denoise_values(unique_file, final_file))
+    metrics.write_csv(record, f'{sample}_denoise_log.csv')
+
+    return final_file if os.path.exists(final_file) else None, record
+
+
+def count(sample, fasta_file, final_file, args):
+    '''
+    steps 4 and 5: exact matching, count table and reports ({sample}.final.count_table.npz, {sample}.csv,
+    {sample}.primer_stats.tsv and {sample}.read_length.tsv)
+    '''
+    if args.hash_join:
+        query = fasta_file
+    else:
+        query = f'{sample}.output.match.final.txt'
+        subprocess.run(['vsearch', '--search_exact', fasta_file, '-db', final_file,
+                        '--userfields', 'target+query', '--userout', query], check=True)
+
+    if not os.path.exists(query) or os.path.getsize(query) == 0:
+        print (f"{query} is empty !")
+        return
+
+    if args.hash_join:
+        table = make_count_table.count_exact(fasta_file, final_file, args.chunk_size)
+    else:
+        table = make_count_table.count_matches(query, args.chunk_size)
+    if not table.counts:
+        print (f"no read of {fasta_file} matches the unique seqs of {final_file}")
+        return
+
+    count_npz = f'{sample}.final.count_table.npz'
+    if args.export_count_table:
+        make_count_table.write_count_table(f'{sample}.final.count_table', table)
+    make_count_table.write_count_npz(count_npz, table, final_file)
+
+    sums = create_report.count_sums(count_npz)
+    create_report.report(sample, sums, len(utilities.Primers(args.primers).pnames), f'{sample}.csv')
+    create_report.generate_primer_stats(sample, sums, f'{sample}.primer_stats.tsv')
+    depth_log = f'{sample}_denoise_primer_log.tsv'
+    depths = create_report.read_depths(depth_log) if args.max_depth > 0 and os.path.exists(depth_log) else None
+    create_report.generate_read_length(sample, final_file, f'{sample}.read_length.tsv', depths)
+
+
+if __name__ == "__main__":
+
+    args = parse_argument()
+    sample = args.sample
+
+    records = []
+    if args.filtered:
+        fasta_file = args.input
+    else:
+        fasta_file, record = filter_reads(sample, args.input, args.compress)
+        records.append(record)
+    unique_file, record = dereplicate(sample, fasta_file)
+    records.append(record)
+    final_file, record = denoise(sample, unique_file, args)
+    records.append(record)
+    if args.metrics:
+        metrics.write_records(args.metrics, records)
+
+    if final_file:
+        count(sample, fasta_file, final_file, args)
+    else:
+        print (f"no final unique seqs for {sample}")
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+
+import argparse
+import math
+from itertools import islice
+import numpy as np
+import remove_space
+import compressed_io
+import parse_qfilter_log
+import metrics
+
+'''
+This script does the quality filtering of the merged reads (fastq) of one sample in a single pass,
+it replaces the chain of:
+vsearch --fastx_filter --fastq_maxee 1 (fasta output) -> parse_qfilter_log.py -> remove_space.py
+
+The fastq file is streamed in batches of reads, and the expected errors (EE) of all the reads in a batch
+are calculated at once with numpy (phred score -> error probability lookup). The reads with EE <= maxee
+are written to the fasta file, with the header already compacted (check remove_space.py), and the
+qfilter log csv file (and/or the metrics record, check metrics.py) is written directly.
+
+The filtering follows vsearch (fastq_ascii 33, fastq_qmin 0, fastq_qmax 41, fastq_minlen 1, fasta_width 80),
+so the output is read for read the same as the vsearch chain.
+'''
+
+FASTQ_ASCII = 33
+FASTQ_QMAX = 41
+FASTA_WIDTH = 80
+DEFAULT_BATCH_SIZE = 100000
+
+# error probability of each (ascii) quality character, NaN for the invalid ones
+ERROR_PROBS = np.full(256, np.nan)
+ERROR_PROBS[FASTQ_ASCII:FASTQ_ASCII + FASTQ_QMAX + 1] = [10.0 ** (-q / 10.0) for q in range(FASTQ_QMAX + 1)]
+
+
+def parse_argument():
+
+    parser = argparse.ArgumentParser(prog = 'quality_filter.py')
+    parser.add_argument('-i', '--input', metavar = '', required = True, help = 'Specify input (merged reads) fastq file')
+    parser.add_argument('-o', '--output', metavar = '', required = True, help = 'Specify output fasta file')
+    parser.add_argument('-s', '--sample', metavar = '', required = True, help = 'Specify sample name')
+    parser.add_argument('-l', '--log', metavar = '', help = 'Specify output qfilter log csv file (optional)')
+    parser.add_argument('-e', '--maxee', metavar = '', type = float, default = 1.0,
+                        help = 'Specify the max expected errors of a read (default: 1.0)')
+    parser.add_argument('-j', '--metrics', metavar = '', help = 'Specify output metrics (json lines) file, '
+                        'the qfilter record is appended to it (optional)')
+    parser.add_argument('-b', '--batch_size', metavar = '', type = int, default = DEFAULT_BATCH_SIZE,
+                        help = f'Specify the number of reads processed at a time (default: {DEFAULT_BATCH_SIZE})')
+    return parser.parse_args()
+
+
+def read_batches(fastq_file, batch_size):
+    '''
+    this method reads a fastq file in batches of reads
+
+    Parameters
+    ----------
+    fastq_file: String name of the fastq file
+    batch_size: int, number of reads in a batch
+
+    Returns: generator of lists of (header, sequence, quality) tuples, without the line ends
+    ----------
+    '''
+    with compressed_io.open_file(fastq_file, errors='ignore') as f:
+        while True:
+            lines = list(islice(f, 4 * batch_size))
+            if not lines:
+                break
+            if len(lines) % 4:
+                raise ValueError(f'{fastq_file} is truncated (the number of lines is not a multiple of 4)')
+
+            batch = []
+            for ind in range(0, len(lines), 4):
+                header, seq, quality = lines[ind].rstrip('\r\n'), lines[ind + 1].rstrip('\r\n'), lines[ind + 3].rstrip('\r\n')
+                if not header.startswith('@'):
+                    raise ValueError(f'invalid fastq header: {header}')
+                if len(seq) != len(quality):
+                    raise ValueError(f'sequence and quality lengths differ for read {header[1:]}')
+                batch.append((header, seq, quality))
+            yield batch
+
+
+def expected_errors(qualities):
+    '''
+    this method calculates the expected errors (sum of the error probabilities) of a batch of reads
+
+    Parameters
+    ----------
+    qualities: list of quality strings
+
+    Returns: numpy array of the expected errors (0 for empty reads)
+    ----------
+    '''
+    lengths = np.fromiter((len(quality) for quality in qualities), dtype=np.int64, count=len(qualities))
+    probs = ERROR_PROBS[np.frombuffer(''.join(qualities).encode('latin-1'), dtype=np.uint8)]
+    if np.isnan(probs).any():
+        bad = int(np.flatnonzero(np.isnan(probs))[0])
+        raise ValueError(f'FASTQ quality character {bad_char(qualities, bad)!r} is out of the range ' \
+                         f'(phred score {FASTQ_QMAX} is the maximum, with ascii offset {FASTQ_ASCII})')
+
+    ee = np.zeros(len(qualities))
+    nonempty = lengths > 0
+    if nonempty.any():
+        starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+        ee[nonempty] = np.add.reduceat(probs, starts[nonempty])
+    return ee
+
+
+def bad_char(qualities, position):
+    '''
+    Returns the quality character at the given position of the concatenated quality strings
+    '''
+    for quality in qualities:
+        if position < len(quality):
+            return quality[position]
+        position -= len(quality)
+
+
+def sequential_ee(quality):
+    '''
+    sums up the error probabilities one by one from the start of the read (the same way as vsearch does),
+    to decide the reads whose (vectorized) EE is too close to the threshold
+    '''
+    ee = 0.0
+    for char in quality:
+        ee += ERROR_PROBS[ord(char)]
+    return ee
+
+
+def write_fasta(f, header, seq):
+    f.write(f'>{remove_space.compact_header(header[1:])}\n')
+    for start in range(0, len(seq), FASTA_WIDTH):
+        f.write(f'{seq[start:start + FASTA_WIDTH]}\n')
+
+
+def quality_filter(fastq_file, fasta_file, maxee=1.0, batch_size=DEFAULT_BATCH_SIZE):
+    '''
+    this method filters the reads of a fastq file by their expected errors, and writes the kept
+    reads into a fasta file with their headers compacted
+
+    Parameters
+    ----------
+    fastq_file: String name of the input fastq file
+    fasta_file: String name of the output fasta file
+    maxee: float, the max expected errors of a kept read
+    batch_size: int, number of reads processed at a time
+
+    Returns: tuple of (# of kept reads, # of discarded reads)
+    ----------
+    '''
+    kept, discarded = 0, 0
+    # the vectorized sums can differ from the sequential ones in the last bits
+    tolerance = 1e-9 * max(1.0, maxee)
+    with compressed_io.open_file(fasta_file, 'w') as out:
+        for batch in read_batches(fastq_file, batch_size):
+            qualities = [quality for _, _, quality in batch]
+            ee = expected_errors(qualities)
+            for (header, seq, quality), read_ee in zip(batch, ee.tolist()):
+                if math.isclose(read_ee, maxee, rel_tol=0, abs_tol=tolerance):
+                    read_ee = sequential_ee(quality)
+                if seq and read_ee <= maxee:
+                    write_fasta(out, header, seq)
+                    kept += 1
+                else:
+                    discarded += 1
+
+    return kept, discarded
+
+
+if __name__ == "__main__":
+
+    args = parse_argument()
+
+    kept, discarded = quality_filter(args.input, args.output, args.maxee, args.batch_size)
+    print (f"{kept} sequences kept (of which 0 truncated), {discarded} sequences discarded.")
+    if args.log:
+        parse_qfilter_log.write_to_csv(args.sample, [kept, discarded], args.log)
+    if args.metrics:
+        metrics.write_records(args.metrics, [metrics.make_record(args.sample, 'qfilter', [kept, discarded])])
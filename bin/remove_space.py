@@ -1,7 +1,10 @@
 #!/usr/bin/env python3
 import re
+import os
 import argparse
+import tempfile
 import time
+import compressed_io
 
 '''
 This script is to remove space between seq_id and =adapter
@@ -10,23 +13,46 @@ turn this
 into
 >M03235:53:000000000-K394R:1:1101:16683:11154=OG0000294primerGroup8=AR_0409
 This is necessary because packages like vsearch demarcate the seq_id by space
+
+The file is streamed (in large buffered blocks) line by line, only the header lines are rewritten,
+so the memory stays constant regardless of the sample depth. The result is written to a temp file
+which then atomically replaces the input file, so a crash never leaves a half written file behind.
+A compressed file (i.e. .fasta.gz, check compressed_io.py) is read and rewritten compressed.
 '''
+
+ADAPTER_PATTERN = re.compile(r'\s+adapter=', re.I)
+
 def parse_argument():
 
     parser = argparse.ArgumentParser(prog = 'remove_space.py')
     parser.add_argument('-f', '--input_file', metavar = '', required = True, help = 'Specify input file')
     return parser.parse_args()
 
+def compact_header(header):
+    '''
+    turn a (fasta or fastq) header 'seq_id  adapter=primer=sample' into 'seq_id=primer=sample'
+    '''
+    return ADAPTER_PATTERN.sub('=', header)
+
 def parse(file_to_parse):
     
-    with open(file_to_parse, 'r', errors='ignore') as f:
-        file = f.read()
-        
-    pattern = re.compile(r'\s+adapter=', re.I)
-    file = re.sub(pattern, '=', file)
-    
-    with open(file_to_parse, 'w') as f:
-        f.write(file)
+    # the temp file is in the same directory, so that os.replace() is an atomic rename
+    # (with the same extension, so a compressed file stays compressed)
+    fd, temp_file = tempfile.mkstemp(prefix='.remove_space.', suffix=os.path.splitext(file_to_parse)[1],
+                                     dir=os.path.dirname(os.path.abspath(file_to_parse)))
+    os.close(fd)
+    try:
+        with compressed_io.open_file(file_to_parse, errors='ignore') as f, \
+             compressed_io.open_file(temp_file, 'w') as out:
+            for line in f:
+                # sequence lines are written out as they are
+                out.write(compact_header(line) if line.startswith('>') else line)
+        os.chmod(temp_file, os.stat(file_to_parse).st_mode & 0o7777)
+        os.replace(temp_file, file_to_parse)
+    except BaseException:
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+        raise
     
 if __name__ == "__main__":
 
@@ -35,4 +61,3 @@ if __name__ == "__main__":
     parse(args.input_file)
     # toc = time.perf_counter()
     # print (f"took {toc-tic:.2f} seconds")
-
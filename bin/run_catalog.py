@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+
+import hashlib
+import json
+import math
+import sqlite3
+import pandas as pd
+
+'''
+This module keeps a persistent (sqlite) catalog of the per-sample summary rows (report csv, primer_stats
+and read_length tsv files), keyed by sample and by the content hash of the input file.
+
+When combine_reports.py is re-run (late samples added, or several sequencing runs aggregated), only the
+new or changed files are parsed and upserted, and the run-level reports are made from the catalog.
+
+The catalog is only written by one process at a time: in the pipeline, combine_reports updates a copy of the
+previous run's catalog in its task folder and publishes it (sqlite locking is not reliable on network file
+systems, so a catalog shared by concurrent writers should be on a local disk).
+'''
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS sample_rows (
+    kind    TEXT NOT NULL,
+    sample  TEXT NOT NULL,
+    sha1    TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    PRIMARY KEY (kind, sample)
+);
+CREATE INDEX IF NOT EXISTS sample_rows_sha1 ON sample_rows (kind, sha1);
+'''
+
+
+def file_sha1(file_name):
+    '''
+    Returns the sha1 hex digest of the content of the given file
+    '''
+    sha1 = hashlib.sha1()
+    with open(file_name, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def _to_json(row):
+    '''
+    Returns the JSON payload of one sample row (a dictionary), missing values are saved as null
+    '''
+    def native(value):
+        if hasattr(value, 'item'): # numpy scalar
+            value = value.item()
+        if isinstance(value, float) and math.isnan(value):
+            return None
+        return value
+
+    return json.dumps({str(key): native(value) for key, value in row.items()})
+
+
+class RunCatalog:
+    'Persistent catalog of the per-sample summary rows, keyed by sample and input content hash'
+
+    def __init__(self, db_file):
+        self.db_file = db_file
+        self.conn = sqlite3.connect(db_file)
+        self.conn.executescript(SCHEMA)
+
+    def sync(self, kind, files, reader):
+        '''
+        this method upserts the rows of the new or changed files (by content hash) into the catalog,
+        and returns all the rows of this kind in the catalog
+
+        Parameters
+        ----------
+        kind: String, the kind of the files (i.e. report, primer_stats, read_length)
+        files: list of per-sample file names
+        reader: function which reads one file into a DataFrame (index: sample)
+
+        Returns: DataFrame (index: sample), in the order the samples were first added to the catalog
+        ----------
+        '''
+        parsed = 0
+        with self.conn:
+            for file_name in files:
+                sha1 = file_sha1(file_name)
+                if self.conn.execute('SELECT 1 FROM sample_rows WHERE kind = ? AND sha1 = ?',
+                                     (kind, sha1)).fetchone():
+                    continue
+
+                df = reader(file_name)
+                parsed += 1
+                for sample, row in zip(df.index, df.to_dict(orient='records')):
+                    self.conn.execute('INSERT INTO sample_rows (kind, sample, sha1, payload) VALUES (?, ?, ?, ?) '
+                                      'ON CONFLICT (kind, sample) DO UPDATE SET sha1 = excluded.sha1, payload = excluded.payload',
+                                      (kind, str(sample), sha1, _to_json(row)))
+
+        print (f"run catalog {self.db_file}: {parsed} of {len(files)} {kind} files are new or changed")
+        return self.load(kind)
+
+    def load(self, kind):
+        '''
+        this method loads all the rows of the given kind from the catalog
+
+        Parameters
+        ----------
+        kind: String, the kind of the files (i.e. report, primer_stats, read_length)
+
+        Returns: DataFrame (index: sample), in the order the samples were first added to the catalog
+        ----------
+        '''
+        rows = self.conn.execute('SELECT sample, payload FROM sample_rows WHERE kind = ? ORDER BY rowid',
+                                 (kind,)).fetchall()
+        return pd.DataFrame.from_records([json.loads(payload) for _, payload in rows],
+                                         index=[sample for sample, _ in rows])
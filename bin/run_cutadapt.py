@@ -1,6 +1,10 @@
 #!/usr/bin/env python3
-import sys, os, shutil, subprocess, argparse
+import sys, os, shutil, subprocess, argparse, json, tempfile, copy
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice, zip_longest
 import utilities
+import exact_demux
+import compressed_io
 import pandas as pd
 from os.path import isfile
 from os import access, R_OK
@@ -57,10 +61,246 @@ def parse_argument():
     parser.add_argument('-l', '--min_length', metavar = '', required = True, help = 'min length')
     parser.add_argument('-t', '--thread', metavar = '', required = True, help = 'thread')
     parser.add_argument('-b', '--mode', metavar = '', required = True, help = 'boolean value if reads are shorter than amplicons')
+    parser.add_argument('-x', '--exact', metavar = '', default = 'false', help = 'boolean value to remove the primers with the '
+                        'exact demultiplexer (exact_demux.py) instead of cutadapt, when max error is 0')
+    parser.add_argument('-n', '--shards', metavar = '', type = int, default = 1, help = 'Specify number of chunks the reads are '
+                        'split into and trimmed concurrently (default: 1, no sharding)')
     
     
     return parser.parse_args()
 
+def cutadapt_adapters(oligo_file, flag):
+	"""
+	builds the cutadapt adapter options of all our primer pairs
+
+	Params
+	------
+	oligo_file: String
+		Name of the oligo file
+	flag: boolean
+		if reads are longer than amplicons (use a linked adapter)
+
+	Returns
+	------
+	list of the adapter options (['-a', adapter, '-A', adapter, ...])
+
+	"""
+	panel = utilities.load_panel(oligo_file)
+
+	# go through all our primer pairs and concatenate all the primer sequences in a single cutadapt command
+	# (the primers are listed in the reverse order of the oligo file, the order cutadapt breaks the ties in)
+	adapters = []
+	for key in reversed(panel.pnames):
+		fprimer = panel.forward[key]
+		rc_fprimer = panel.rc_forward[key]
+		rc_rprimer = panel.reverse[key] # by default we use reverse complement of reverse_primer in primer file
+		rprimer = panel.rc_reverse[key]
+
+		if flag: # reads longer than amplicons (use a linked adapter)
+			adapters.extend(['-a', f'{key}=^{fprimer}...{rc_rprimer}', '-A', f'{key}=^{rprimer}...{rc_fprimer}'])
+		else: # reads shorter than amplicons
+			adapters.extend(['-g', f'{key}=^{fprimer}', '-G', f'{key}=^{rprimer}'])
+	return adapters
+
+def trim_reads(R1_gz, R2_gz, out_dir, sample, oligo_file, max_error, min_length, thread, flag, exact):
+	"""
+	removes the primers of a pair of fastq files, into {out_dir}/{sample}.trimmed.1/2.fastq 
+	and the {out_dir}/{sample}.cutadapt.json report
+
+	Params
+	------
+	R1_gz, R2_gz: String
+		Names of the R1 and R2 fastq files
+	out_dir: String
+		Name of the output folder
+	sample: String
+		Sample name
+	oligo_file: String
+		Name of the oligo file
+	max_error, min_length, thread: String
+		cutadapt -e, -m and -j
+	flag: boolean
+		if reads are longer than amplicons (use a linked adapter)
+	exact: boolean
+		remove the primers with exact_demux.py (instead of cutadapt) if max_error is 0
+
+	"""
+	# with exact matching (max error 0), the primers are removed in process, with the same result as cutadapt
+	if exact and float(max_error) == 0:
+		exact_demux.demultiplex(R1_gz, R2_gz, f'{out_dir}/{sample}.trimmed.1.fastq', f'{out_dir}/{sample}.trimmed.2.fastq',
+			oligo_file, sample, int(min_length), flag, f'{out_dir}/{sample}.cutadapt.json')
+		return
+
+	#1. prep for cutadapt commands
+	cutadapt_cmd = cmd_exists('cutadapt')
+
+	cutadapt_commands = [cutadapt_cmd] + cutadapt_adapters(oligo_file, flag) + ['-o',
+		f'{out_dir}/{sample}.trimmed.1.fastq', '-p', 
+		f'{out_dir}/{sample}.trimmed.2.fastq',
+		R1_gz, R2_gz,
+		f"--rename={{id}}  adapter={{adapter_name}}={sample} {{comment}}",
+		#'--quiet', '--discard-untrimmed', '-e', f'{max_error}', '-m', f'{min_length}', '-j', f'{thread}']
+		f'--json={out_dir}/{sample}.cutadapt.json', '--discard-untrimmed', '-e', f'{max_error}', '-m', f'{min_length}', '-j', f'{thread}']
+
+	run_cutadapt(cutadapt_commands)
+
+def trim_shard(shard):
+	"""
+	trim_reads() of one shard (a tuple of the trim_reads() arguments), for the process pool
+	"""
+	trim_reads(*shard)
+
+def split_fastq(R1_gz, R2_gz, shard_dirs):
+	"""
+	splits a pair of fastq files into record-aligned (contiguous) chunks, one per shard folder,
+	as {shard_dir}/R1.fastq and {shard_dir}/R2.fastq
+
+	Params
+	------
+	R1_gz, R2_gz: String
+		Names of the R1 and R2 fastq (or fastq.gz) files
+	shard_dirs: list
+		Names of the shard folders
+
+	Returns
+	------
+	list of the shard folders with reads (there are fewer shards than folders if there are fewer reads)
+
+	"""
+	with compressed_io.open_file(R1_gz, 'rb') as f:
+		lines = sum(block.count(b'\n') for block in iter(lambda: f.read(1 << 20), b''))
+	records = -(-lines // 4)
+	chunk = -(-records // len(shard_dirs))
+	if not chunk:
+		return []
+
+	used = []
+	with compressed_io.open_file(R1_gz, 'rb') as f1, compressed_io.open_file(R2_gz, 'rb') as f2:
+		for shard_dir in shard_dirs:
+			# the lines are streamed into the shard files (the first line tells if there is anything left)
+			first1, first2 = f1.readline(), f2.readline()
+			if not first1 and not first2:
+				break
+			with open(f'{shard_dir}/R1.fastq', 'wb') as o1, open(f'{shard_dir}/R2.fastq', 'wb') as o2:
+				o1.write(first1)
+				o1.writelines(islice(f1, 4 * chunk - 1))
+				o2.write(first2)
+				o2.writelines(islice(f2, 4 * chunk - 1))
+			used.append(shard_dir)
+		# the rest of R2 (if it's longer than R1) goes to the last shard, so cutadapt reports the improper pairs
+		rest = f2.readline()
+		if rest and used:
+			with open(f'{used[-1]}/R2.fastq', 'ab') as o2:
+				o2.write(rest)
+				shutil.copyfileobj(f2, o2)
+	return used
+
+def sum_counts(counts, other):
+	"""
+	adds the (nested) numeric counters of a cutadapt json section to another one, in place
+	"""
+	for key, value in other.items():
+		if isinstance(value, dict) and isinstance(counts.get(key), dict):
+			sum_counts(counts[key], value)
+		elif isinstance(value, (int, float)) and not isinstance(value, bool) and counts.get(key) is not None:
+			counts[key] += value
+
+def merge_end(end, other, reads):
+	"""
+	merges the statistics of one (5' or 3') end of an adapter of a shard's cutadapt json into another one, in place
+	(reads is the number of input reads of the shard, the expected counts are rescaled to all the reads by finish_end())
+	"""
+	if end is None or other is None:
+		return
+	end['matches'] += other['matches']
+	if end.get('adjacent_bases') is not None and other.get('adjacent_bases') is not None:
+		for base, count in other['adjacent_bases'].items():
+			end['adjacent_bases'][base] = end['adjacent_bases'].get(base, 0) + count
+
+	lengths = {row['len']: row for row in end['trimmed_lengths']}
+	for row in other['trimmed_lengths']:
+		merged = lengths.setdefault(row['len'], {'len': row['len'], 'expect': 0, 'counts': [], 'reads': 0})
+		merged['expect'] += row['expect']
+		merged['reads'] += reads
+		merged['counts'] = [a + b for a, b in zip_longest(merged['counts'], row['counts'], fillvalue=0)]
+	end['trimmed_lengths'] = [lengths[length] for length in sorted(lengths)]
+
+def finish_end(end, reads):
+	"""
+	rescales the expected counts of the trimmed lengths (only reported by the shards where the length was seen) to all the reads
+	"""
+	if end is None:
+		return
+	for row in end['trimmed_lengths']:
+		seen = row.pop('reads')
+		row['expect'] = round(row['expect'] * reads / seen, 1) if seen else 0.0
+
+def merge_json(json_files, json_file, R1_gz, R2_gz):
+	"""
+	merges the cutadapt json reports of the shards into one report (for MultiQC),
+	the read/basepair counts and the statistics of each adapter are summed across the shards
+
+	Params
+	------
+	json_files: list
+		Names of the cutadapt json reports of the shards (in order)
+	json_file: String
+		Name of the merged json report
+	R1_gz, R2_gz: String
+		Names of the (unsharded) R1 and R2 fastq files
+
+	"""
+	reports = []
+	for name in json_files:
+		with open(name) as f:
+			reports.append(json.load(f))
+
+	# the adapter statistics of the first report are reset, then every report is merged into it
+	report = copy.deepcopy(reports[0])
+	for read in ['adapters_read1', 'adapters_read2']:
+		for adapter in report.get(read) or []:
+			for end in ['five_prime_end', 'three_prime_end']:
+				if adapter.get(end) is not None:
+					adapter[end] = dict(adapter[end], matches=0, trimmed_lengths=[],
+										adjacent_bases={base: 0 for base in adapter[end]['adjacent_bases']}
+										if adapter[end].get('adjacent_bases') is not None else None)
+			adapter['total_matches'] = 0
+
+	reads = 0
+	for ind, other in enumerate(reports):
+		if ind:
+			sum_counts(report['read_counts'], other['read_counts'])
+			sum_counts(report['basepair_counts'], other['basepair_counts'])
+		reads += other['read_counts']['input']
+		for read in ['adapters_read1', 'adapters_read2']:
+			adapters = {adapter['name']: adapter for adapter in report.get(read) or []}
+			for adapter in other.get(read) or []:
+				merged = adapters.get(adapter['name'])
+				if merged is None:
+					continue
+				merged['total_matches'] += adapter['total_matches']
+				merge_end(merged.get('five_prime_end'), adapter.get('five_prime_end'), other['read_counts']['input'])
+				merge_end(merged.get('three_prime_end'), adapter.get('three_prime_end'), other['read_counts']['input'])
+
+	for read in ['adapters_read1', 'adapters_read2']:
+		for adapter in report.get(read) or []:
+			finish_end(adapter.get('five_prime_end'), reads)
+			finish_end(adapter.get('three_prime_end'), reads)
+
+	report['input'].update({'path1': R1_gz, 'path2': R2_gz})
+	report['cores'] = len(reports)
+	with open(json_file, 'w') as f:
+		json.dump(report, f, indent=2)
+
+def concatenate(files, output_file):
+	"""
+	concatenates the files (in order) into the output file
+	"""
+	with open(output_file, 'wb') as out:
+		for name in files:
+			with open(name, 'rb') as f:
+				shutil.copyfileobj(f, out, 1 << 22)
+
 def remove_primer(args):
 	"""
 	takes in all arguments and run cutadapt to remove primres concurrently
@@ -80,40 +320,38 @@ def remove_primer(args):
 	min_length = args.min_length
 	thread = args.thread
 	flag = args.mode.lower() == 'true' #convert string to boolean
-    
-	#1. prep for cutadapt commands
-	# cutadapt_commands = []
-	primers = utilities.Primers(oligo_file)
-	cutadapt_cmd = cmd_exists('cutadapt')
+	exact = args.exact.lower() == 'true'
 
-	cutadapt_commands = [cutadapt_cmd, '-o',
-		f'{out_dir}/{sample}.trimmed.1.fastq', '-p', 
-		f'{out_dir}/{sample}.trimmed.2.fastq',
-		R1_gz, R2_gz,
-		f"--rename={{id}}  adapter={{adapter_name}}={sample} {{comment}}",
-		#'--quiet', '--discard-untrimmed', '-e', f'{max_error}', '-m', f'{min_length}', '-j', f'{thread}']
-		f'--json={out_dir}/{sample}.cutadapt.json', '--discard-untrimmed', '-e', f'{max_error}', '-m', f'{min_length}', '-j', f'{thread}']
+	if args.shards <= 1:
+		trim_reads(R1_gz, R2_gz, out_dir, sample, oligo_file, max_error, min_length, thread, flag, exact)
+		return
 
-	# go through all our primer pairs and concatenate all the primer sequences in a single cutadapt command
-	for key in primers.pseqs:
-		fprimer = primers.pseqs[key][0]
-		rc_fprimer = utilities.revcomp(fprimer)
-		rc_rprimer = primers.pseqs[key][1] # by default we use reverse complement of reverse_primer in primer file
-		rprimer = utilities.revcomp(rc_rprimer)
+	# sharded mode: the reads are split into chunks, which are trimmed concurrently (the threads are shared by the shards)
+	# and the trimmed reads and the json reports of the chunks are merged back, in order
+	with tempfile.TemporaryDirectory(dir=out_dir) as tmp_dir:
+		shard_dirs = [f'{tmp_dir}/{ind}' for ind in range(args.shards)]
+		for shard_dir in shard_dirs:
+			os.makedirs(shard_dir)
+		shard_dirs = split_fastq(R1_gz, R2_gz, shard_dirs)
+		if not shard_dirs:
+			trim_reads(R1_gz, R2_gz, out_dir, sample, oligo_file, max_error, min_length, thread, flag, exact)
+			return
 
-		if flag: # reads longer than amplicons (use a linked adapter)
-			cutadapt_commands.insert(1,f'{key}=^{rprimer}...{rc_fprimer}')
-			cutadapt_commands.insert(1,'-A')
-			cutadapt_commands.insert(1,f'{key}=^{fprimer}...{rc_rprimer}')
-			cutadapt_commands.insert(1,'-a')
-		else: # reads shorter than amplicons
-			cutadapt_commands.insert(1,f'{key}=^{rprimer}')
-			cutadapt_commands.insert(1,'-G')
-			cutadapt_commands.insert(1,f'{key}=^{fprimer}')
-			cutadapt_commands.insert(1,'-g')
-		
+		shard_thread = max(1, int(thread) // len(shard_dirs))
+		shards = [(f'{shard_dir}/R1.fastq', f'{shard_dir}/R2.fastq', shard_dir, sample, oligo_file,
+				   max_error, min_length, shard_thread, flag, exact) for shard_dir in shard_dirs]
+		with ProcessPoolExecutor(max_workers=len(shards)) as executor:
+			list(executor.map(trim_shard, shards))
 
-	run_cutadapt(cutadapt_commands)
+		json_files = [f'{shard_dir}/{sample}.cutadapt.json' for shard_dir in shard_dirs]
+		if not all(isfile(name) for name in json_files):
+			print(f"the primers of {sample} could not be removed in every shard")
+			return
+
+		for read in ['1', '2']:
+			concatenate([f'{shard_dir}/{sample}.trimmed.{read}.fastq' for shard_dir in shard_dirs],
+						f'{out_dir}/{sample}.trimmed.{read}.fastq')
+		merge_json(json_files, f'{out_dir}/{sample}.cutadapt.json', R1_gz, R2_gz)
 
 
             
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+
+import argparse
+import os
+import subprocess
+import threading
+import run_cutadapt
+import quality_filter
+import parse_pear_log
+import parse_qfilter_log
+import metrics
+
+'''
+This script runs the primer removal, the pair merging and the quality filtering of one sample as one pipelined
+task (streaming mode), instead of the cutadapt, pair_merging and quality_filtering processes:
+1. the primers are removed (check run_cutadapt.py), into the trimmed R1/R2 fastq files in the task folder
+2. pear merges the trimmed reads, its assembled reads are written into a named pipe (fifo), and its
+   other outputs (unassembled and discarded reads) go to /dev/null
+3. the assembled reads are quality filtered (check quality_filter.py) as pear writes them into the pipe
+
+So the merged reads ({sample}.fastq) are never written to disk, and the trimmed reads are deleted once pear is done.
+The outputs are the same as the 3 processes: {sample}.cutadapt.json, {sample}_pear.log, {sample}_pear_log.csv,
+{sample}.fasta (.gz with -z) and {sample}_qfilter_log.csv; with -k (debug), the stages are run one after the other and all
+the intermediate files ({sample}.trimmed.1/2.fastq, {sample}.fastq and the pear outputs) are kept.
+'''
+
+
+def parse_argument():
+
+    parser = argparse.ArgumentParser(prog = 'stream_merge_filter.py')
+    parser.add_argument('-f', '--read1', metavar = '', required = True, help = 'Specify R1 read')
+    parser.add_argument('-r', '--read2', metavar = '', required = True, help = 'Specify R2 read')
+    parser.add_argument('-s', '--sample', metavar = '', required = True, help = 'Specify sample name')
+    parser.add_argument('-p', '--oligo_file', metavar = '', required = True, help = 'Specify oligo file')
+    parser.add_argument('-e', '--max_error', metavar = '', required = True, help = 'Specify cutadapt max error')
+    parser.add_argument('-l', '--min_length', metavar = '', required = True, help = 'Specify cutadapt min length')
+    parser.add_argument('-t', '--thread', metavar = '', required = True, help = 'Specify number of cutadapt threads')
+    parser.add_argument('-b', '--mode', metavar = '', required = True, help = 'boolean value if reads are longer than amplicons')
+    parser.add_argument('-x', '--exact', metavar = '', default = 'false', help = 'boolean value to remove the primers with the '
+                        'exact demultiplexer (exact_demux.py) instead of cutadapt, when max error is 0')
+    parser.add_argument('-q', '--merging_minquality', metavar = '', required = True, help = 'Specify pear -q')
+    parser.add_argument('-m', '--merging_maxlength', metavar = '', required = True, help = 'Specify pear -m')
+    parser.add_argument('-n', '--merging_minlength', metavar = '', required = True, help = 'Specify pear -n')
+    parser.add_argument('-v', '--merging_minoverlap', metavar = '', required = True, help = 'Specify pear -v')
+    parser.add_argument('-j', '--merging_thread', metavar = '', default = '1', help = 'Specify number of pear threads')
+    parser.add_argument('-a', '--maxee', metavar = '', type = float, default = 1.0,
+                        help = 'Specify the max expected errors of a read (default: 1.0)')
+    parser.add_argument('-o', '--metrics', metavar = '', help = 'Specify output metrics (json lines) file, '
+                        'the pear and qfilter records are appended to it (optional)')
+    parser.add_argument('-z', '--compress', action = 'store_true', help = 'Write the filtered reads compressed ({sample}.fasta.gz)')
+    parser.add_argument('-k', '--keep_intermediates', action = 'store_true',
+                        help = 'Keep the intermediate files, and run the stages one after the other (debug)')
+    return parser.parse_args()
+
+
+# pear output files (besides the assembled reads) of a sample
+PEAR_OTHERS = ['unassembled.forward.fastq', 'unassembled.reverse.fastq', 'discarded.fastq']
+
+
+def pear_command(args, reads1, reads2):
+    return ['pear', '-f', reads1, '-r', reads2, '-o', args.sample, '-q', args.merging_minquality,
+            '-m', args.merging_maxlength, '-n', args.merging_minlength, '-v', args.merging_minoverlap,
+            '-j', args.merging_thread]
+
+
+def filtered_fasta(args):
+    return f"{args.sample}.fasta{'.gz' if args.compress else ''}"
+
+
+def unblock_fifo(fifo):
+    '''
+    this method opens (and closes) the writing end of a fifo, so a reader blocked on opening it gets an EOF
+    '''
+    try:
+        os.close(os.open(fifo, os.O_WRONLY | os.O_NONBLOCK))
+    except OSError:
+        pass
+
+
+def merge_filter(args, reads1, reads2):
+    '''
+    this method runs pear on the trimmed reads and quality filters its assembled reads
+
+    Parameters
+    ----------
+    args: argparse.Namespace object, holding all the arguments
+    reads1, reads2: String names of the trimmed R1 and R2 fastq files
+
+    Returns: tuple of (# of kept reads, # of discarded reads) of the quality filtering, None if pear failed
+    ----------
+    '''
+    sample = args.sample
+    assembled = f'{sample}.assembled.fastq'
+    merged = f'{sample}.fastq'
+    fasta = filtered_fasta(args)
+
+    if args.keep_intermediates:
+        with open(f'{sample}_pear.log', 'w') as log:
+            p = subprocess.run(pear_command(args, reads1, reads2), stdout=log)
+        if p.returncode != 0 or not os.path.exists(assembled):
+            return None
+        os.replace(assembled, merged)
+        return quality_filter.quality_filter(merged, fasta, args.maxee)
+
+    for name in [assembled] + [f'{sample}.{other}' for other in PEAR_OTHERS]:
+        if os.path.lexists(name):
+            os.remove(name)
+    os.mkfifo(assembled)
+    for other in PEAR_OTHERS:
+        os.symlink(os.devnull, f'{sample}.{other}')
+
+    # the quality filtering reads the fifo in a thread, while pear writes into it
+    result = {}
+    def consume():
+        try:
+            result['counts'] = quality_filter.quality_filter(assembled, fasta, args.maxee)
+        except Exception as error:
+            result['error'] = error
+            # keep draining the pipe, so pear doesn't block on it
+            with open(assembled, 'rb') as f:
+                while f.read(1 << 20):
+                    pass
+    reader = threading.Thread(target=consume)
+    reader.start()
+
+    try:
+        with open(f'{sample}_pear.log', 'w') as log:
+            p = subprocess.run(pear_command(args, reads1, reads2), stdout=log)
+    finally:
+        # in case pear exits without ever opening its output
+        unblock_fifo(assembled)
+        reader.join()
+        os.remove(assembled)
+        for other in PEAR_OTHERS:
+            os.remove(f'{sample}.{other}')
+
+    if 'error' in result:
+        raise result['error']
+    return result.get('counts') if p.returncode == 0 else None
+
+
+if __name__ == "__main__":
+
+    args = parse_argument()
+    sample = args.sample
+
+    #1. primer removal (the trimmed reads are in the task folder, not published unless they're kept)
+    run_cutadapt.trim_reads(args.read1, args.read2, '.', sample, args.oligo_file, args.max_error, args.min_length,
+                            args.thread, args.mode.lower() == 'true', args.exact.lower() == 'true')
+    reads1, reads2 = f'{sample}.trimmed.1.fastq', f'{sample}.trimmed.2.fastq'
+
+    #2. pair merging and quality filtering
+    if os.path.exists(reads1) and os.path.getsize(reads1) > 0 and os.path.getsize(reads2) > 0:
+        counts = merge_filter(args, reads1, reads2)
+        if counts is None:
+            print (f"pear failed on {reads1} and {reads2} !")
+            if os.path.exists(filtered_fasta(args)):
+                os.remove(filtered_fasta(args))
+        else:
+            with open(f'{sample}_pear.log', 'r') as f:
+                pear_values = parse_pear_log.parse_input(f.read())
+            parse_pear_log.write_to_csv(sample, pear_values, f'{sample}_pear_log.csv')
+            kept, discarded = counts
+            print (f"{kept} sequences kept (of which 0 truncated), {discarded} sequences discarded.")
+            parse_qfilter_log.write_to_csv(sample, [kept, discarded], f'{sample}_qfilter_log.csv')
+            if args.metrics:
+                metrics.write_records(args.metrics, [metrics.make_record(sample, 'pear', pear_values),
+                                                     metrics.make_record(sample, 'qfilter', [kept, discarded])])
+    else:
+        print (f"either {reads1} or {reads2} is empty !")
+
+    if not args.keep_intermediates:
+        for name in [reads1, reads2]:
+            if os.path.exists(name):
+                os.remove(name)
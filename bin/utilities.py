@@ -1,8 +1,155 @@
+import os
+import hashlib
+import json
+import tempfile
+from itertools import product
+from concurrent.futures import ThreadPoolExecutor
+import compressed_io
+
+
+# complement of the (IUPAC) bases, the non-IUPAC codes stay as is
+REVCOMP_TABLE = str.maketrans('ATGCUYRKMBDHVN', 'TACGARYMKVHDBN')
+
+IUPAC = {'A': 'A', 'C': 'C', 'G': 'G', 'T': 'T', 'U': 'T', 'R': 'AG', 'Y': 'CT', 'S': 'CG', 'W': 'AT', 'K': 'GT',
+         'M': 'AC', 'B': 'CGT', 'D': 'AGT', 'H': 'ACT', 'V': 'ACG', 'N': 'ACGT'}
+
+# bump it when PrimerPanel changes, so the old cache files are not loaded
+PANEL_VERSION = 2
+
+
 def revcomp(myseq):
-    rc = {'A' : 'T', 'T' : 'A', 'G' : 'C', 'C' : 'G', 'U' : 'A', 'Y' : 'R', 'R' : 'Y', 'K':'M', 'M':'K','B':'V',\
-            'D':'H', 'H':'D', 'V':'B', 'N':'N'}
-    seq = [rc[n] if n in rc else n for n in myseq] # allow non-IUPAC code to stay as is
-    return("".join(list(reversed(seq))))
+    return myseq.translate(REVCOMP_TABLE)[::-1]
+
+
+def expand_iupac(seq):
+    '''
+    Returns the list of all the (A/C/G/T) sequences a primer with IUPAC codes stands for
+    '''
+    return [''.join(bases) for bases in product(*[IUPAC.get(base, base) for base in seq.upper()])]
+
+
+class PrimerPanel:
+    '''
+    Compiled primer panel of a mothur oligos file (primer / forward_seq / rc_reverse_seq / primer_name per line):
+    the primer names (in the order of the file) and their integer IDs, the forward and reverse primers and their
+    reverse complements, and their IUPAC expanded variants.
+    Check load_panel() to build it once and load it from a cache file afterwards
+    '''
+
+    def __init__(self, fname):
+        self.fname = fname
+        self.pnames = []
+        self.forward = {}     # key: primer name; value: forward primer
+        self.rc_reverse = {}  # key: primer name; value: reverse complement of the reverse primer (as in the oligos file)
+        with open(fname, 'r') as infile:
+            for line in infile:
+                if line.startswith("primer"):
+                    tmp = line.split('\t')
+                    name = tmp[3].strip('\n')
+                    if name not in self.forward:
+                        self.pnames.append(name)
+                    self.forward[name] = tmp[1]
+                    self.rc_reverse[name] = tmp[2]
+
+        self.ids = {name: ind for ind, name in enumerate(self.pnames)}
+        self.reverse = {name: revcomp(seq) for name, seq in self.rc_reverse.items()}
+        self.rc_forward = {name: revcomp(seq) for name, seq in self.forward.items()}
+        self.forward_variants = {name: expand_iupac(seq) for name, seq in self.forward.items()}
+        self.reverse_variants = {name: expand_iupac(seq) for name, seq in self.reverse.items()}
+        self.tags = {}
+
+    # the compiled attributes of the panel, as written to (and read from) its json cache file
+    CACHED = ['pnames', 'forward', 'rc_reverse', 'ids', 'reverse', 'rc_forward', 'forward_variants', 'reverse_variants']
+
+    @classmethod
+    def from_cache(cls, fname, cached):
+        '''
+        Returns the panel of an oligos file from the (json) dictionary of its compiled attributes
+        '''
+        panel = cls.__new__(cls)
+        panel.fname = fname
+        for name in cls.CACHED:
+            setattr(panel, name, cached[name])
+        panel.tags = {}
+        return panel
+
+    @property
+    def pseqs(self):
+        '''
+        Returns a dictionary of primer name: [forward primer, reverse primer], as Primers.pseqs
+        '''
+        return {name: [self.forward[name], self.reverse[name]] for name in self.pnames}
+
+    def tagged(self, keyword):
+        '''
+        Returns the names of the primers tagged by a keyword (i.e. a genus, like typhi), in the order of the panel
+        '''
+        keyword = keyword.lower()
+        if keyword not in self.tags:
+            self.tags[keyword] = [name for name in self.pnames if keyword in name.lower()]
+        return self.tags[keyword]
+
+
+def panel_cache_dir():
+    '''
+    Returns the folder of the primer panel cache files ($HMAS_PANEL_CACHE, or hmas_panel_cache_{uid} in the temp
+    folder, one per user)
+    '''
+    return os.environ.get('HMAS_PANEL_CACHE') or os.path.join(tempfile.gettempdir(), f'hmas_panel_cache_{os.getuid()}')
+
+
+def private_dir(path):
+    '''
+    this method makes the folder (only the user can access it) if it doesn't exist yet, and checks it's owned
+    by the user and not writable by the others, so nobody else can plant a cache file in it
+
+    Returns True if the folder is private
+    '''
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    stat = os.stat(path)
+    return stat.st_uid == os.getuid() and not stat.st_mode & 0o022
+
+
+def load_panel(fname, cache_dir=None):
+    '''
+    this method loads the compiled primer panel of an oligos file from its (json) cache file, named after the hash
+    of the oligos file content (so an edited oligos file never loads a stale panel), the panel is built
+    and cached if there is no cache file yet (or it can't be read/written); the cache is only used in a private
+    folder (check private_dir())
+
+    Parameters
+    ----------
+    fname: String name of the oligos file
+    cache_dir: String name of the cache folder, optional (check panel_cache_dir())
+
+    Returns a PrimerPanel
+
+    '''
+    with open(fname, 'rb') as f:
+        digest = hashlib.sha256(f.read() + f'panel-v{PANEL_VERSION}'.encode()).hexdigest()
+    cache_dir = cache_dir or panel_cache_dir()
+    cache_file = os.path.join(cache_dir, f'{digest}.panel.json')
+    try:
+        if not private_dir(cache_dir):
+            return PrimerPanel(fname)
+    except OSError:
+        return PrimerPanel(fname)
+
+    try:
+        with open(cache_file, 'r') as f:
+            return PrimerPanel.from_cache(fname, json.load(f))
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+
+    panel = PrimerPanel(fname)
+    try:
+        # write then rename, so a concurrent reader never sees a partial cache file
+        with tempfile.NamedTemporaryFile('w', dir=cache_dir, delete=False) as f:
+            json.dump({name: getattr(panel, name) for name in PrimerPanel.CACHED}, f)
+        os.replace(f.name, cache_file)
+    except OSError:
+        pass
+    return panel
 
 
 class Primers:
@@ -10,16 +157,9 @@ class Primers:
     
     def __init__(self, fname):
         self.fname = fname
-        self.pseqs = dict()
-        Primers.reader(self, self.fname, self.pseqs)
+        self.panel = load_panel(fname)
+        self.pseqs = self.panel.pseqs
         self.pnames = self.pseqs.keys()
-    
-    def reader(self, fname, pseqs):
-        with open(fname, 'r') as infile:
-            for line in infile:
-                if line.startswith("primer"):
-                    tmp = line.split('\t')
-                    pseqs[tmp[3].strip('\n')] = [tmp[1], revcomp(tmp[2])]
 
 
 def create_fasta_dict(fasta):
@@ -37,7 +177,7 @@ def create_fasta_dict(fasta):
 
     '''
     seq_dict = {}
-    with open(fasta, 'r') as f:
+    with compressed_io.open_file(fasta) as f:
         for ind, row in enumerate(f.readlines(), start=1):
             if ind%2 == 1:
                 last_seqID = row.strip().split()[0][1:] #removes the '>'
@@ -48,3 +188,72 @@ def create_fasta_dict(fasta):
                 else:
                     seq_dict[last_seqID] = last_seq
     return seq_dict
+
+
+def iter_fasta(fasta):
+    '''
+    this method reads a fasta file record by record (sequences can span multiple lines)
+
+    Parameters
+    ----------
+    fasta: String name of the fasta file
+
+    Returns a generator of (header, sequence) tuples, header is without the '>'
+
+    '''
+    header, seq_lines = None, []
+    with compressed_io.open_file(fasta) as f:
+        for line in f:
+            if line.startswith('>'):
+                if header is not None:
+                    yield header, ''.join(seq_lines)
+                header, seq_lines = line[1:].rstrip('\n'), []
+            else:
+                seq_lines.append(line.strip())
+    if header is not None:
+        yield header, ''.join(seq_lines)
+
+
+def read_manifest(manifest):
+    '''
+    this method reads a manifest file, a 2 columns (tab delimited) plain text file listing the inputs, i.e.,
+    report	sample1.csv
+    report	sample2.csv
+    sample	sample1
+
+    Parameters
+    ----------
+    manifest: String name of the manifest file
+
+    Returns a dictionary, with the kind (1st column) being the key and a list of values (2nd column, 
+    in the order of the file) being the value
+
+    '''
+    inputs = {}
+    with open(manifest, 'r') as f:
+        for line in f:
+            line = line.rstrip('\r\n')
+            if line:
+                kind, value = line.split('\t', 1)
+                inputs.setdefault(kind, []).append(value)
+    return inputs
+
+
+def parallel_map(func, items, threads=1):
+    '''
+    this method applies func to every item concurrently in a thread pool (i.e. to read many small files
+    on a network file system), the results are in the same order as the items
+
+    Parameters
+    ----------
+    func: the function to apply
+    items: list of the items
+    threads: int, number of threads
+
+    Returns a list of results
+
+    '''
+    if threads <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        return list(executor.map(func, items))
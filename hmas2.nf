@@ -82,14 +82,14 @@ Channel.fromPath(params.primer, checkIfExists: true).set { ch_primer_file }
 include { FASTQC as FASTQC_RAW } from './modules/fastqc/main.nf' 
 include { cutadapt } from './modules/cutadapt/main.nf' 
 include { pair_merging } from './modules/pair_merging/main.nf' 
-include { quality_filtering; dereplication; denoising; search_exact } from './modules/vsearch/main.nf'
+include { stream_merge_filter } from './modules/local/stream_merge_filter.nf' 
+include { quality_filtering; dereplication; denoising; pooled_denoising; search_exact } from './modules/vsearch/main.nf'
 // include { hashing } from './modules/local/hash' 
 include { combine_reports } from './modules/local/combine_reports.nf'
-include { combine_logs as combine_logs_pear } from './modules/local/combine_logs.nf'
-include { combine_logs as combine_logs_qfilter } from './modules/local/combine_logs.nf' 
-include { combine_logs as combine_logs_derep } from './modules/local/combine_logs.nf' 
-include { combine_logs as combine_logs_denoise } from './modules/local/combine_logs.nf' 
+include { combine_metrics } from './modules/local/combine_metrics.nf' 
 include { make_count_table } from './modules/local/make_count_table.nf' 
+include { postmerge } from './modules/local/postmerge.nf' 
+include { combine_count_tables } from './modules/local/combine_count_tables.nf' 
 include { multiqc } from './modules/multiqc/main.nf' 
 
 workflow {
@@ -109,33 +109,88 @@ workflow {
     FASTQC_RAW(paired_reads)
  // removed_primer_reads_ch = cutadapt(paired_reads)
     paired_reads.combine(ch_primer_file).set{ ch_for_cutadapt }
-    removed_primer_reads_ch = cutadapt(ch_for_cutadapt)
-    merged_reads_ch = pair_merging(removed_primer_reads_ch.cutadapt_fastq)
-    filered_reads_ch = quality_filtering(merged_reads_ch.fastq)
-    unique_reads_ch = dereplication(filered_reads_ch.fasta)
-
-    unique_reads_ch.fasta.combine(ch_primer_file).set{ ch_for_denoising }
-    denoisded_reads_ch = denoising(ch_for_denoising)
-
-
-    // hashing(denoisded_reads_ch.unique)
-    before_search_ch = filered_reads_ch.fasta.join(denoisded_reads_ch.unique)
-    match_file_ch = search_exact(before_search_ch)
-    // collectFile will instead concatenate all the file contents and write it into a single file
-    // which is not what we want.  We want to read each file separately, for all the files
-    before_count_table_ch = match_file_ch.join(denoisded_reads_ch.unique)
-    before_count_table_ch.combine(ch_primer_file).set{ ch_for_make_count_table }
-    reports_file_ch = make_count_table(ch_for_make_count_table)
+    // the fused mode runs the whole post-merge chain of a sample in one task (not with pooled denoising,
+    // which needs the dereplicated reads of all the samples)
+    def fused = params.fused_postmerge && !params.pooled_denoising
+    if (params.streaming) {
+        // primer removal, pair merging and quality filtering in one pipelined task per sample
+        streamed_ch = stream_merge_filter(ch_for_cutadapt)
+        cutadapt_json_ch = streamed_ch.cutadapt_json
+        filtered_fasta_ch = streamed_ch.fasta
+        metrics_ch = streamed_ch.metrics
+        filter_versions_ch = streamed_ch.versions
+    } else {
+        removed_primer_reads_ch = cutadapt(ch_for_cutadapt)
+        merged_reads_ch = pair_merging(removed_primer_reads_ch.cutadapt_fastq)
+        cutadapt_json_ch = removed_primer_reads_ch.cutadapt_json
+        metrics_ch = merged_reads_ch.metrics
+        filter_versions_ch = merged_reads_ch.versions
+        if (!fused) {
+            filered_reads_ch = quality_filtering(merged_reads_ch.fastq)
+            filtered_fasta_ch = filered_reads_ch.fasta
+            metrics_ch = metrics_ch.mix(filered_reads_ch.metrics)
+            filter_versions_ch = filter_versions_ch.mix(filered_reads_ch.versions)
+        }
+    }
+
+    if (fused) {
+        // quality filtering (unless it's streamed) -> dereplication -> denoising -> counting in one task per sample
+        postmerge_input_ch = params.streaming ? filtered_fasta_ch : merged_reads_ch.fastq
+        reports_file_ch = postmerge(postmerge_input_ch.combine(ch_primer_file))
+        metrics_ch = metrics_ch.mix(reports_file_ch.metrics)
+        filter_versions_ch = filter_versions_ch.mix(reports_file_ch.versions)
+    } else {
+        unique_reads_ch = dereplication(filtered_fasta_ch)
+        metrics_ch = metrics_ch.mix(unique_reads_ch.metrics)
+
+        if (params.pooled_denoising) {
+            // denoise the reads of all the samples together (once per primer), then split the centroids by sample
+            pooled_ch = pooled_denoising(unique_reads_ch.fasta.map { it[1] }.collect(), ch_primer_file)
+            denoised_unique_ch = pooled_ch.unique.flatten()
+                .map { file -> tuple(file.name.replaceAll(/\.final\.unique\.fasta$/, ''), file) }
+                .filter { it[0] != 'pooled' }
+            metrics_ch = metrics_ch.mix(pooled_ch.metrics)
+            // the depth cap is on the pooled reads, there are no per-sample depths
+            depth_log_ch = denoised_unique_ch.map { tuple(it[0], []) }
+        } else {
+            unique_reads_ch.fasta.combine(ch_primer_file).set{ ch_for_denoising }
+            denoisded_reads_ch = denoising(ch_for_denoising)
+            denoised_unique_ch = denoisded_reads_ch.unique
+            metrics_ch = metrics_ch.mix(denoisded_reads_ch.metrics)
+            // with the depth cap, the raw and the capped depths (per-primer log) are added to the read_length report
+            depth_log_ch = params.denoising_max_depth ? denoisded_reads_ch.primer_log : denoised_unique_ch.map { tuple(it[0], []) }
+        }
+
+
+        // hashing(denoisded_reads_ch.unique)
+        before_search_ch = filtered_fasta_ch.join(denoised_unique_ch)
+        if (params.hash_join_count) {
+            // make_count_table matches the filtered reads to the final unique seqs itself (exact hash join)
+            before_count_table_ch = before_search_ch
+        } else {
+            match_file_ch = search_exact(before_search_ch)
+            // collectFile will instead concatenate all the file contents and write it into a single file
+            // which is not what we want.  We want to read each file separately, for all the files
+            before_count_table_ch = match_file_ch.join(denoised_unique_ch)
+        }
+        before_count_table_ch.join(depth_log_ch).combine(ch_primer_file).set{ ch_for_make_count_table }
+        reports_file_ch = make_count_table(ch_for_make_count_table)
+    }
     // reports_file_ch = make_count_table(before_count_table_ch)
+    // the run catalog of a previous run (if any) is staged into combine_reports, which publishes the updated copy
+    previous_catalog_ch = params.run_catalog && file(params.run_catalog).exists() ? \
+                          Channel.fromPath(params.run_catalog) : Channel.value([])
     combined_report_ch = combine_reports(reports_file_ch.report.collect(), \
                                          reports_file_ch.primer_stats.collect(), \
                                          reports_file_ch.read_length.collect(), \
-                                         ch_primer_file, sample_id_ch.collect())
+                                         ch_primer_file, sample_id_ch.collect(), previous_catalog_ch)
+    if (params.run_matrix) {
+        // merge all the per-sample count tables into one run-level sequence x (sample, primer) matrix
+        combine_count_tables(reports_file_ch.count_npz.collect())
+    }
 
-    pear_log_ch = combine_logs_pear(merged_reads_ch.log_csv.collect(), Channel.value('pear'))
-    qfilter_log_ch = combine_logs_qfilter(filered_reads_ch.log_csv.collect(), Channel.value('qfilter'))
-    derep_log_ch = combine_logs_derep(unique_reads_ch.log_csv.collect(), Channel.value('dereplication'))
-    denoise_log_ch = combine_logs_denoise(denoisded_reads_ch.log_csv.collect(), Channel.value('denoise'))
+    // the per-sample metrics of all the stages into the 4 MultiQC tables (pear, qfilter, dereplication and denoise)
+    combined_metrics_ch = combine_metrics(metrics_ch.collect())
 
     process make_command_yaml {
 
@@ -156,8 +211,7 @@ workflow {
     // mix all the version files into one channel
     all_versions = Channel
         .empty()
-        .mix(merged_reads_ch.versions)
-        .mix(filered_reads_ch.versions)
+        .mix(filter_versions_ch)
         .mix(combined_report_ch.versions)
 
     collected_versions = all_versions
@@ -168,7 +222,7 @@ workflow {
     // add fastqc and cutadapt log files (these are existing modules in MultiQC)
     Channel.empty()
         .mix( FASTQC_RAW.out.fastqc_results )
-        .mix( removed_primer_reads_ch.cutadapt_json )
+        .mix( cutadapt_json_ch )
         .map { sample, files -> files }
         .collect().ifEmpty([])
         .set { log_files }
@@ -176,10 +230,10 @@ workflow {
     // add custom content log files
     multiqc(log_files
         .combine(ch_logo_for_multiqc)
-        .combine(pear_log_ch.log)
-        .combine(qfilter_log_ch.log)
-        .combine(derep_log_ch)
-        .combine(denoise_log_ch)
+        .combine(combined_metrics_ch.pear)
+        .combine(combined_metrics_ch.qfilter)
+        .combine(combined_metrics_ch.dereplication)
+        .combine(combined_metrics_ch.denoise)
         .combine(combined_report_ch.primer_stats_mqc)
         .combine(combined_report_ch.genus_primer_stats_mqc)
         .combine(combined_report_ch.read_length_mqc)
@@ -22,7 +22,8 @@ process cutadapt {
     run_cutadapt.py -f !{reads[0]} -r !{reads[1]} \
                     -o cutadapt -s !{sample} -p !{ch_primer_file} \
                     -e !{params.cutadapt_maxerror} -l !{params.cutadapt_minlength} \
-                    -t !{params.cutadapt_thread} -b !{params.cutadapt_long}
+                    -t !{params.cutadapt_thread} -b !{params.cutadapt_long} \
+                    -x !{params.exact_demux} -n !{params.cutadapt_shards}
 
     '''
 
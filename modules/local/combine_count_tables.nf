@@ -0,0 +1,20 @@
+process combine_count_tables {
+    publishDir "${params.final_outdir}", mode: 'copy'
+    tag "combine count tables"
+    memory = "${params.medmems}"
+
+    input:
+    path (count_tables)
+
+    output:
+    path ("run_matrix${params.file_extension}.npz"), emit: run_matrix, optional: true
+
+    shell:
+    '''
+    # list the binary count tables in a manifest file instead of the command line (which has a size limit)
+    for f in !{count_tables}; do printf 'count_table\t%s\n' "$f"; done > manifest.tsv
+    combine_count_tables.py -o "run_matrix!{params.file_extension}.npz" -m manifest.tsv
+
+    '''
+
+}
@@ -0,0 +1,28 @@
+process combine_metrics {
+    // publishDir "${params.final_outdir}", mode: 'copy'
+    tag "combine metrics"
+    // debug true
+
+    input:
+    path (metrics_file)
+
+    output:
+    path ("pear_mqc.out"), emit: pear
+    path ("qfilter_mqc.out"), emit: qfilter
+    path ("dereplication_mqc.out"), emit: dereplication
+    path ("denoise_mqc.out"), emit: denoise
+
+    shell:
+    '''
+    # list the metrics (json lines) files and the stage logs in a manifest file instead of the command line (which has a size limit)
+    for f in !{metrics_file}; do
+        case "$f" in
+            *.jsonl) printf 'metrics\\t%s\\n' "$f" ;;
+            *) printf 'log\\t%s\\n' "$f" ;;
+        esac
+    done > manifest.tsv
+    combine_metrics.py -m manifest.tsv
+
+    '''
+
+}
@@ -1,6 +1,7 @@
 process combine_reports {
-    publishDir "${params.final_outdir}", mode: 'copy', pattern: "*.csv"
+    publishDir "${params.final_outdir}", mode: 'copy', pattern: "*.{csv,sqlite}"
     tag "combine reports"
+    cpus = "${params.mincpus}"
     // debug true
 
     input:
@@ -9,24 +10,42 @@ process combine_reports {
     path (read_length)
     path (ch_primer_file)
     val (sample_ids)
+    // staged under its own name, as the catalog published by a previous run is named run_catalog.sqlite too
+    path (previous_catalog, stageAs: 'previous_catalog.sqlite')
 
     output:
     path ("report*.csv"), emit: csv, optional:true
-    path ("report_mqc.yaml"), emit: report_mqc, optional:true
-    path ("primer_stats_mqc.yaml"), emit: primer_stats_mqc, optional:true
-    path ("read_length_mqc.yaml"), emit: read_length_mqc, optional:true
+    path ("report_mqc.json"), emit: report_mqc, optional:true
+    path ("primer_stats_mqc.json"), emit: primer_stats_mqc, optional:true
+    path ("read_length_mqc.json"), emit: read_length_mqc, optional:true
     path ("versions.yml"), emit: versions, optional: true
-    path ("genus_primer_stats_mqc.yaml"), emit: genus_primer_stats_mqc, optional:true
+    path ("genus_primer_stats_mqc.json"), emit: genus_primer_stats_mqc, optional:true
     path ("genus_primer_stats.csv"), emit: genus_primer_stats_csv, optional:true
+    path ("run_catalog.sqlite"), emit: catalog, optional:true
 
     shell:
     '''
-    # use inspect() to prepare a stringified representation of a list, and pass that to a python script
-    # in python script, use ast.literal_eval() to safely evaluate a string containing a Python literal (a list in this case)
-    combine_reports.py -o "report!{params.file_extension}.csv" -p "!{reports_file}" -i "!{sample_ids.inspect()}" -y report_mqc.yaml \
-                       -q "!{primer_stats}" -z primer_stats_mqc.yaml -l !{ch_primer_file} \
-                       -r "!{read_length}" -x read_length_mqc.yaml \
-                       -g genus_primer_stats_mqc.yaml -c genus_primer_stats.csv
+    # list all the inputs and sample IDs in a manifest file instead of the command line (which has a size limit)
+    # the loops and the heredoc are bash builtins, so they are not subject to that limit either
+    for f in !{reports_file}; do printf 'report\\t%s\\n' "$f"; done > manifest.tsv
+    for f in !{primer_stats}; do printf 'primer_stats\\t%s\\n' "$f"; done >> manifest.tsv
+    for f in !{read_length}; do printf 'read_length\\t%s\\n' "$f"; done >> manifest.tsv
+    cat <<'END_SAMPLES' >> manifest.tsv
+!{sample_ids.collect { "sample\\t" + it }.join("\\n")}
+END_SAMPLES
+
+    # the run catalog is only ever written in the task folder: a copy of the previous run's catalog (if any)
+    # is updated here, and published for the next run
+    if [ -e previous_catalog.sqlite ]; then
+        cp -L previous_catalog.sqlite run_catalog.sqlite
+        chmod u+w run_catalog.sqlite
+    fi
+
+    combine_reports.py -o "report!{params.file_extension}.csv" -m manifest.tsv -t !{task.cpus} -y report_mqc.json \
+                       -z primer_stats_mqc.json -l !{ch_primer_file} \
+                       -x read_length_mqc.json \
+                       -g genus_primer_stats_mqc.json -c genus_primer_stats.csv \
+                       !{params.run_catalog ? "-d run_catalog.sqlite" : ""}
 
     echo "!{task.process}:" > versions.yml
     echo "  python: $(python --version 2>&1 | awk '{print $2}')" >> versions.yml
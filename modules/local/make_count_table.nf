@@ -1,16 +1,19 @@
 process make_count_table {
-    publishDir "${params.final_outdir}/${sample}/temp", pattern: "*.count_table", mode: 'copy'
+    publishDir "${params.final_outdir}/${sample}/temp", pattern: "*.count_table*", mode: 'copy'
     publishDir "${params.final_outdir}/${sample}", pattern: "*.csv", mode: 'copy'
     tag "${sample}"
     // debug true
     cpus = "${params.mincpus}"
-    memory = "${params.maxmems}"
+    memory = "${params.medmems}"
 
     input:
-    tuple val(sample), path (match_file), path (fasta_file), path (ch_primer_file)
+    // match_file is the vsearch --search_exact match file, or the quality-filtered reads (fasta) with hash_join_count
+    // depth_log is the per-primer denoising log with the depth cap (the raw and capped depths go to the read_length report)
+    tuple val(sample), path (match_file), path (fasta_file), path (depth_log), path (ch_primer_file)
 
     output:
     path ("${sample}.final.count_table"), emit:count, optional:true
+    path ("${sample}.final.count_table.npz"), emit:count_npz, optional:true
     path ("${sample}.csv"), emit:report, optional:true
     path ("${sample}.primer_stats.tsv"), emit:primer_stats, optional:true
     path ("${sample}.read_length.tsv"), emit:read_length, optional:true
@@ -18,9 +21,15 @@ process make_count_table {
     shell:
     '''
     if [ -s !{match_file} ]; then
-        make_count_table.py -o !{sample}.final.count_table -m !{match_file}
-        create_report.py -s !{sample} -c !{sample}.final.count_table -p !{ch_primer_file} -o !{sample}.csv \
-                         -q !{sample}.primer_stats.tsv -f !{fasta_file} -l !{sample}.read_length.tsv
+        # the binary count table is always made (for the reports), the text count_table is an optional export
+        make_count_table.py -b !{sample}.final.count_table.npz !{params.hash_join_count ? "-q" : "-m"} !{match_file} \
+                            -f !{fasta_file} -k !{params.count_chunk_size} \
+                            !{params.export_count_table ? "-o " + sample + ".final.count_table" : ""}
+        if [ -s !{sample}.final.count_table.npz ]; then
+            create_report.py -s !{sample} -c !{sample}.final.count_table.npz -p !{ch_primer_file} -o !{sample}.csv \
+                             -q !{sample}.primer_stats.tsv -f !{fasta_file} -l !{sample}.read_length.tsv \
+                             !{depth_log ? "-d " + depth_log : ""}
+        fi
     else
         echo "!{match_file} is empty !"
     fi
@@ -0,0 +1,43 @@
+process postmerge {
+    // the same files are published to the same places as by the separate processes
+    publishDir "${params.final_outdir}/${sample}", mode: 'copy', pattern: "*.{fasta,tsv,csv}", \
+        saveAs: { it in ["${sample}.final.unique.fasta", "${sample}_denoise_primer_log.tsv", "${sample}.csv"]*.toString() ? it : null }
+    publishDir "${params.final_outdir}/${sample}/temp", mode: 'copy', pattern: "*.{fasta,fasta.gz,txt,count_table,npz}", \
+        saveAs: { it == "${sample}.final.unique.fasta".toString() ? null : it }
+    tag "${sample}"
+    // debug true
+    cpus = "${params.medcpus}"
+    memory = "${params.medmems}"
+
+    input:
+    // the merged reads (fastq), or the quality filtered reads (fasta) in streaming mode
+    tuple val(sample), path (reads), path (ch_primer_file)
+
+    output:
+    tuple val(sample), path ("${sample}.final.unique.fasta"), emit: unique, optional: true
+    path ("${sample}.final.count_table"), emit: count, optional: true
+    path ("${sample}.final.count_table.npz"), emit: count_npz, optional: true
+    path ("${sample}.csv"), emit: report, optional: true
+    path ("${sample}.primer_stats.tsv"), emit: primer_stats, optional: true
+    path ("${sample}.read_length.tsv"), emit: read_length, optional: true
+    path ("${sample}_postmerge_metrics.jsonl"), emit: metrics, optional: true
+    path ("${sample}_denoise_primer_log.tsv"), emit: primer_log, optional: true
+    path ("${sample}.{fasta,fasta.gz,unique.fasta,output.match.final.txt}"), emit: intermediates, optional: true
+    path "versions.yml", emit: versions, optional: true
+
+    shell:
+    '''
+    postmerge.py -i !{reads} -s !{sample} -p !{ch_primer_file} !{params.streaming ? "-q" : ""} \
+                 !{params.compress_intermediates ? "-z" : ""} \
+                 -m !{params.denoising_minsize} -a !{params.denoising_alpha} -t !{task.cpus} \
+                 -w !{params.denoising_inprocess_max} -d !{params.denoising_max_depth} -e !{params.denoising_seed} \
+                 !{params.chimera_per_primer ? "-c" : ""} !{params.hash_join_count ? "-j" : ""} \
+                 -k !{params.count_chunk_size} !{params.export_count_table ? "-x" : ""} \
+                 -o !{sample}_postmerge_metrics.jsonl
+
+    echo "!{task.process}:" > versions.yml
+    echo "  vsearch: $(vsearch 2>&1 | head -n 1 | cut -d ' ' -f2 | cut -d '_' -f1 | sed 's/^v//')" >> versions.yml
+    echo "  python: $(python3 --version 2>&1 | cut -d ' ' -f2)" >> versions.yml
+    '''
+
+}
@@ -0,0 +1,38 @@
+process stream_merge_filter {
+    publishDir "${params.final_outdir}/${sample}", mode: 'copy', pattern: "*.trimmed.{1,2}.fastq"
+    publishDir "${params.final_outdir}/${sample}/temp", mode: 'copy', pattern: "*.{fastq,fasta,fasta.gz}", saveAs: { it.contains('.trimmed.') ? null : it }
+    tag "${sample}"
+    cpus = "${params.maxcpus}"
+    memory = "${params.medmems}"
+    // debug true
+
+    maxForks = "${params.maxcutadapts}"
+
+    input:
+    tuple val(sample), path(reads), path(ch_primer_file)
+
+    output:
+    tuple val(sample), path ("${sample}.cutadapt.json"), emit: cutadapt_json, optional: true
+    tuple val(sample), path ("${sample}.fasta*"), emit: fasta, optional: true
+    path ("${sample}_metrics.jsonl"), emit: metrics, optional: true
+    path ("*.fastq"), emit: intermediates, optional: true
+    path "versions.yml", emit: versions, optional: true
+
+    shell:
+    // primer removal -> pair merging -> quality filtering as one pipelined task (the merged reads are streamed
+    // through a named pipe), the intermediate fastq files are only kept with params.keep_intermediates
+    '''
+    stream_merge_filter.py -f !{reads[0]} -r !{reads[1]} -s !{sample} -p !{ch_primer_file} \
+                           -e !{params.cutadapt_maxerror} -l !{params.cutadapt_minlength} \
+                           -t !{params.cutadapt_thread} -b !{params.cutadapt_long} -x !{params.exact_demux} \
+                           -q !{params.merging_minquality} -m !{params.merging_maxlength} \
+                           -n !{params.merging_minlength} -v !{params.merging_minoverlap} -j !{params.medcpus} \
+                           -o !{sample}_metrics.jsonl \
+                           !{params.compress_intermediates ? "-z" : ""} !{params.keep_intermediates ? "-k" : ""}
+
+    echo "!{task.process}:" > versions.yml
+    echo "  pear: $(pear 2>&1 | sed -n 's/^PEAR v\\([0-9.]*\\).*/\\1/p')" >> versions.yml
+    echo "  python: $(python3 --version 2>&1 | cut -d ' ' -f2)" >> versions.yml
+    '''
+
+}
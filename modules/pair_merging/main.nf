@@ -10,7 +10,8 @@ process pair_merging {
     output:
     tuple val(sample), path ("${sample}.fastq"), emit: fastq, optional: true
     tuple val(sample), path ("${sample}_pear.log"), emit: log, optional: true
-    path ("${sample}_pear_log.csv"), emit: log_csv, optional: true
+    // the pear log is parsed by combine_metrics (with the metrics of all the samples)
+    path ("${sample}_pear.log"), emit: metrics, optional: true
     path ("versions.yml"), emit: versions, optional: true
 
     shell:
@@ -22,7 +23,6 @@ process pair_merging {
                                                 -v !{params.merging_minoverlap} -j !{{params.medcpus}} \
                                                 > !{sample}_pear.log
         mv !{sample}.assembled.fastq !{sample}.fastq
-        parse_pear_log.py -p !{sample}_pear.log -s !{sample} -o !{sample}_pear_log.csv
     else
         echo "either !{reads1} or !{reads2} is empty !"
     fi
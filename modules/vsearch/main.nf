@@ -1,5 +1,5 @@
 process quality_filtering {
-    publishDir "${params.final_outdir}/${sample}/temp", mode: 'copy', pattern: "*.fasta"
+    publishDir "${params.final_outdir}/${sample}/temp", mode: 'copy', pattern: "*.{fasta,fasta.gz}"
     tag "${sample}"
     // debug true
 
@@ -7,15 +7,25 @@ process quality_filtering {
     tuple val(sample), path (fastq)
 
     output:
-    tuple val(sample), path ("${sample}.fasta"), emit: fasta, optional:true
-    path ("${sample}_qfilter_log.csv"), emit: log_csv, optional: true
+    tuple val(sample), path ("${sample}.fasta*"), emit: fasta, optional:true
+    // the metrics record (native), or the vsearch log parsed by combine_metrics
+    path ("${sample}_qfilter{_metrics.jsonl,.log}"), emit: metrics, optional: true
     path "versions.yml"         , emit: versions, optional: true
 
     shell:
+    if (params.native_qfilter)
+    // single pass: EE filtering, header compaction and the qfilter log (same output as the vsearch chain below)
+    // with compress_intermediates, the filtered reads are gzipped (vsearch and the python stages read them as is)
+    """
+    quality_filter.py -i !{fastq} -o !{sample}.fasta!{params.compress_intermediates ? ".gz" : ""} -s !{sample} -j !{sample}_qfilter_metrics.jsonl -e 1
+
+    echo "!{task.process}:" > versions.yml
+    echo "  python: \$(python3 --version 2>&1 | cut -d ' ' -f2)" >> versions.yml
+    """
+    else
     """
     vsearch --fastx_filter !{fastq} --fastq_maxee 1 --fastaout !{sample}.fasta \
                             --log !{sample}_qfilter.log
-    parse_qfilter_log.py -p !{sample}_qfilter.log -s !{sample} -o !{sample}_qfilter_log.csv
 
     #remove space between seq_id and =adapter 
     #choose not to use linux sed , because it could be very slow
@@ -36,65 +46,49 @@ process dereplication {
 
     output:
     tuple val(sample), path ("${sample}.unique.fasta"), emit: fasta, optional:true
-    path ("${sample}_dereplication_log.csv"), emit: log_csv, optional: true
-
+    // the vsearch log is parsed by combine_metrics (with the metrics of all the samples)
+    path ("${sample}_dereplication.log"), emit: metrics, optional: true
 
     shell:
     '''
     vsearch --derep_fulllength !{fasta} --output !{sample}.unique.fasta --sizeout --relabel_keep \
             --log !{sample}_dereplication.log
-    parse_derep_log.py -p !{sample}_dereplication.log -s !{sample} -o !{sample}_dereplication_log.csv
 
     '''
 
 }
 
 process denoising {
-    publishDir "${params.final_outdir}/${sample}", mode: 'copy', pattern: "*.fasta"
+    publishDir "${params.final_outdir}/${sample}", mode: 'copy', pattern: "*.{fasta,tsv}"
     tag "${sample}"
     // debug true
-    cpus = "${params.mincpus}"
+    cpus = "${params.medcpus}"
 
     input:
     tuple val(sample), path (fasta), path(ch_primer_file)
 
     output:
     tuple val(sample), path ("${sample}.final.unique.fasta"), emit:unique, optional:true
-    path ("${sample}_denoise_log.csv"), emit: log_csv, optional: true
+    path ("${sample}_denoise_metrics.jsonl"), emit: metrics, optional: true
+    tuple val(sample), path ("${sample}_denoise_primer_log.tsv"), emit: primer_log, optional: true
 
     shell:
     '''
-    run_cluster_unoise.sh !{fasta} !{ch_primer_file} !{sample}.unique.unoise.fasta \
-                            !{params.denoising_minsize} !{params.denoising_alpha}
+    #denoise the reads primer by primer (in parallel), and merge the centroids sorted by size
+    #with chimera_per_primer, the chimeras are removed within each primer's centroids in the same workers
+    denoise_primers.py -i !{fasta} -p !{ch_primer_file} -o !{sample}.unique.unoise.fasta \
+                       -m !{params.denoising_minsize} -a !{params.denoising_alpha} -t !{task.cpus} \
+                       -s !{params.denoising_inprocess_max} -l !{sample}_denoise_primer_log.tsv \
+                       -d !{params.denoising_max_depth} -e !{params.denoising_seed} \
+                       !{params.chimera_per_primer ? "-f " + sample + ".final.unique.fasta" : ""}
     
-    #remove potential chimeras
-    if [  -s "!{sample}.unique.unoise.fasta" ]; then
+    #remove potential chimeras (of all the primers at once)
+    if [ "!{params.chimera_per_primer}" != "true" ] && [  -s "!{sample}.unique.unoise.fasta" ]; then
         vsearch --uchime3_denovo !{sample}.unique.unoise.fasta --nonchimeras !{sample}.final.unique.fasta
     fi
 
-    #generate denoise_log.csv file
-    # Check if the fasta file exists and is not empty
-    if [ ! -s "!{fasta}" ]; then
-        seq_count_before="n/a"
-        seq_count_removed="n/a"
-    else
-        seq_count_before=$(grep -c '>' "!{fasta}")
-    fi
-
-    # Check if the final unique fasta file exists and is not empty
-    if [ ! -s "!{sample}.final.unique.fasta" ]; then
-        seq_count_after=0
-    else
-        seq_count_after=$(grep -c '>' "!{sample}.final.unique.fasta")
-    fi
-
-    # Calculate seq_count_removed if seq_count_before is a number
-    if [[ "$seq_count_before" =~ ^[0-9]+$ ]]; then
-        seq_count_removed=$((seq_count_before - seq_count_after))
-    fi
-    
-    echo "Sample name, Total Reads, Removed Reads" > !{sample}_denoise_log.csv
-    echo "!{sample},$seq_count_before,$seq_count_removed" >> !{sample}_denoise_log.csv
+    #the denoise metrics record (the unique reads before/after the denoising, n/a if there was nothing to denoise)
+    metrics.py -s !{sample} -k denoise -b !{fasta} -a !{sample}.final.unique.fasta -o !{sample}_denoise_metrics.jsonl
 
     '''
 
@@ -118,4 +112,33 @@ process search_exact {
 
     '''
 
-}
\ No newline at end of file
+}
+
+process pooled_denoising {
+    publishDir "${params.final_outdir}/pooled", mode: 'copy', pattern: "pooled*.{fasta,tsv}"
+    cpus = "${params.maxcpus}"
+    memory = "${params.maxmems}"
+
+    input:
+    path (fasta)
+    path (ch_primer_file)
+
+    output:
+    path ("*.final.unique.fasta"), emit: unique, optional: true
+    path ("pooled_denoise_metrics.jsonl"), emit: metrics, optional: true
+    path ("pooled*.{fasta,tsv}"), emit: pooled, optional: true
+
+    shell:
+    '''
+    # list the dereplicated fasta files (named {sample}.unique.fasta) in a manifest file
+    for f in !{fasta}; do printf 'fasta\\t%s\\n' "$f"; done > manifest.tsv
+
+    #pool the reads of all the samples, denoise them once per primer and map the centroids back to the samples
+    pool_denoise.py -m manifest.tsv -p !{ch_primer_file} -n !{params.denoising_minsize} -a !{params.denoising_alpha} \
+                    -t !{task.cpus} -s !{params.denoising_inprocess_max} \
+                    -d !{params.denoising_max_depth} -e !{params.denoising_seed} -j pooled_denoise_metrics.jsonl \
+                    !{params.chimera_per_primer ? "-c" : ""}
+
+    '''
+
+}
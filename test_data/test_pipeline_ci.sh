@@ -33,3 +33,20 @@ fi
 # Clean up sorted temporary files
 rm "$generated_csv" "$expected_csv"
 
+# Re-run the denoising with the in-process UNOISE short-cut on (the upstream tasks are cached),
+# the final unique seqs of every sample must be the same as with vsearch --cluster_unoise
+nextflow run hmas2.nf -profile test,git_action,singularity -resume --outdir test_output_inprocess --denoising_inprocess_max 1000
+inprocess_testoutput=$(find . -maxdepth 1 -type d -name 'test_output_inprocess*' | sort -r | head -n 1)
+echo "$(cat work/*/*/.command.out | grep -c 'denoised in process') primer partitions denoised in process"
+
+inprocess_diff=0
+for fasta in "$latest_testoutput"/*/*.final.unique.fasta; do
+  if ! cmp -s "$fasta" "$inprocess_testoutput/${fasta#"$latest_testoutput"/}"; then
+    echo "WARNING ! *** $(basename "$fasta") differs with the in-process denoising ***"
+    inprocess_diff=1
+  fi
+done
+if [ $inprocess_diff -eq 0 ]; then
+  echo "PASSED ! in-process denoising matches vsearch"
+fi
+